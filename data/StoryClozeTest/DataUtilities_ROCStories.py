@@ -2,7 +2,21 @@ import sys
 from __builtin__ import staticmethod
 
 from utils.common_utilities import CommonUtilities
+from data.common.corenlp_parser_pool import CoreNLPParserPool, parse_story_item
+from data.common.corenlp_annotation_cache import CoreNLPAnnotationCache
+from data.StoryClozeTest.columnar_dataset import ColumnarStoryDataset, is_columnar_dataset, save_columnar_dataset, \
+    build_columnar_dataset
+from data.StoryClozeTest.csr_inverted_index import CSRInvertedIndex
+from utils.ann_index import IVFIndex
+from utils.mmap_embeddings import get_source_file_meta
+from data.StoryClozeTest.story_references import StoryReferenceDataset, StoryReferenceResolver, is_story_refs_file, \
+    make_story_ref, make_story_refs_header
+from utils.json_helpers import iter_data_from_json_lines_file, repair_json_lines_file, JsonLinesWriter
 import time
+import os
+import hashlib
+
+import numpy as np
 
 import json
 import codecs
@@ -11,12 +25,55 @@ import logging
 from copy import deepcopy
 
 import random
+import multiprocessing
 
 
 # from random import random
 def init_obj_raw_text(text):
     return {'raw_text': text}
 
+
+class StoryRecord(object):
+    """
+    Compact story record used by the streaming readers.
+    Sentences, endings and title are kept as plain raw text lists (no per-sentence dicts) until
+    the record is parsed or converted to the json dict format with to_dict().
+    """
+    __slots__ = ('id', 'title', 'sentences', 'endings', 'right_end_id')
+
+    def __init__(self, id, sentences, title=None, endings=None, right_end_id=None):
+        self.id = id
+        self.sentences = sentences
+        self.title = title
+        self.endings = endings
+        self.right_end_id = right_end_id
+
+    def text_fields(self):
+        """
+        Yields (field_name, list of raw texts) for the text fields that are set, in the order used by the parser
+        """
+        for list_field in ["sentences", "endings", "title"]:
+            texts = getattr(self, list_field)
+            if texts is not None:
+                yield list_field, texts
+
+    def to_dict(self):
+        """
+        Converts the record to the dict format produced by read_stories_data/read_stories_annotated_data
+        """
+        item = {}
+        item['id'] = self.id
+        if self.title is not None:
+            item['title'] = [init_obj_raw_text(x) for x in self.title]
+        item['sentences'] = [init_obj_raw_text(x) for x in self.sentences]
+        if self.endings is not None:
+            item['endings'] = [init_obj_raw_text(x) for x in self.endings]
+        if self.right_end_id is not None:
+            item['right_end_id'] = self.right_end_id
+
+        return item
+
+
 ####################
 #####FEATS#########
 ####################
@@ -66,129 +123,217 @@ def extract_features(token, lemma, pos, pos_2):
 
     return features
 
-class InvertedIndex(dict):
-    def add_features(self, doc_id, features):
-        for feat in features:
-            if feat not in self:
-                self[feat] = []
-            self[feat].append(doc_id)
-
-    def rank_similar_sentences(self, ending_item, include_features_fn):
-        # get with similar PRP or NNP or NN
-        feats = []
-        for i in range(len(ending_item["tokens"])):
-            token = ending_item["tokens"][i].lower()
-            lemma = ending_item["lemmas"][i].lower()
-            pos = ending_item["pos"][i].lower()
-            pos_2 = pos[:min(2, len(pos))]
-
-            curr_feats = include_features_fn(token, lemma, pos, pos_2)
-            feats.extend(curr_feats)
-
-        feats = list(set(feats))
-        # logging.info("----------------------------------------------")
-        # logging.info("rank_similar_sentences feats: %s" % (str(feats)))
-        docs_ranking = {}
-        for feat in feats:
-            if feat in self:
-                found_docs = list(set(self[feat]))
-                for di in found_docs:
-                    if di in docs_ranking:
-                        docs_ranking[di] += 1
-                    else:
-                        docs_ranking[di] = 1
-            # else:
-            #     logging.info("feat %s is not presented!")
-
-        if len(docs_ranking) == 0:
-            return []
-        # logging.info("docs found: %s" % (len(docs_ranking)))
-        docs = [(k, v) for k, v in docs_ranking.items()]
-        # logging.info("docs found tuple : %s" % (len(docs)))
-        docs = sorted(docs, key=lambda arg: arg[1], reverse=True)
-        # logging.info("docs found sorted : %s" % (len(docs)))
-        return docs
 
-class DataUtilities_ROCStories(object):
-    @staticmethod
-    def read_stories_data(input_file, max_items=0):
-        # storyid	storytitle	sentence1	sentence2	sentence3	sentence4	sentence5
-        # 9a51198e-96f1-42c3-b09d-a3e1e067d803	Overweight Kid	Dan's parents were overweight.	Dan was overweight as well.	The doctors told his parents it was unhealthy.	His parents understood and decided to make a change.	They got themselves and Dan on a diet.
+def get_features_pr_nn(token, lemma, pos, pos_2):
+    feats = []
+    if pos.startswith('pr') or pos.startswith('nn'):
+        feats.append(get_lemma_pos_key(lemma, pos))
+    return feats
 
-        f = codecs.open(input_file, mode='rb', encoding='utf-8')
-        line_id = 0
 
-        items_list = []
-        for line in f:
-            if line_id == 0:  # skip header
-                line_id += 1
-                continue
+def extract_sentence_features(sentence):
+    sent_feats = []
+    for i in range(len(sentence["tokens"])):
+        token = sentence["tokens"][i].lower()
+        lemma = sentence["lemmas"][i].lower()
+        pos = sentence["pos"][i].lower()
+        pos_2 = pos[:min(2, len(pos))]
 
-            if max_items > 0 and line_id > max_items:
-                break
+        sent_feats.extend(extract_features(token, lemma, pos, pos_2))
+
+    return sent_feats
+
+
+# search indexes used by the generation commands
+SEARCH_INDEX_WRONG_ENDINGS = "wrong_endings"  # wrong endings of stories with ending choice (mutate_train_smart_1)
+SEARCH_INDEX_LAST_SENTENCES = "last_sentences"  # fifth sentences of raw stories (mutate_rocstories_data_pos_v1)
+SEARCH_INDEX_LAST_SENTENCES_EMB = "last_sentences_emb"  # fifth sentence vectors (mutate_rocstories_data_emb_nn)
+SEARCH_INDEX_FEATURES_VERSION = 1  # increase when extract_features changes
 
-            line_cols = line.split("\t")
 
-            item = {}
-            item['id'] = line_cols[0]  # storyid
-            item['title'] = [init_obj_raw_text(line_cols[1])]
-            item['sentences'] = []
-            item['sentences'].append(init_obj_raw_text(line_cols[2]))  # InputSentence1
-            item['sentences'].append(init_obj_raw_text(line_cols[3]))  # InputSentence2
-            item['sentences'].append(init_obj_raw_text(line_cols[4]))  # InputSentence3
-            item['sentences'].append(init_obj_raw_text(line_cols[5]))  # InputSentence4
-            item['sentences'].append(init_obj_raw_text(line_cols[6]))  # InputSentence4
+# data, search index and params of the sharded generation.
+# Set before the worker processes are forked so the workers share them with the parent process.
+_pos_v1_shard_state = {}
 
-            items_list.append(item)
-            line_id += 1
 
-        return items_list
+def _generate_pos_v1_shard(shard_id):
+    """
+    Generates the reference records of the stories in a shard of iter_mutate_rocstories_data_pos_v1_sharded
+    """
+    state = _pos_v1_shard_state
+    data = state["data"]
+    rand = random.Random(DataUtilities_ROCStories.get_shard_seed(state["seed"], shard_id))
 
+    shard_refs = []
+    for curr_item_id in xrange(shard_id * state["shard_size"], min(len(data), (shard_id + 1) * state["shard_size"])):
+        shard_refs.extend(DataUtilities_ROCStories.generate_pos_v1_story_refs(data, state["search_index"],
+                                                                            curr_item_id, rand,
+                                                                            state["take_number"]))
+    return shard_refs
+
+
+class DataUtilities_ROCStories(object):
     @staticmethod
-    def read_stories_annotated_data(input_file, max_items=0):
-        # InputStoryid	InputSentence1	InputSentence2	InputSentence3	InputSentence4	RandomFifthSentenceQuiz1	RandomFifthSentenceQuiz2	AnswerRightEnding
-        # b929f263-1dcd-4a0b-b267-5d5ff2fe65bb	My friends all love to go to the club to dance.	They think it's a lot of fun and always invite.	I finally decided to tag along last Saturday.	I danced terribly and broke a friend's toe.	My friends decided to keep inviting me out as I am so much fun.	The next weekend, I was asked to please stay home.	2
-        f = codecs.open(input_file, mode='rb', encoding='utf-8')
-        line_id = 0
+    def iter_tsv_lines(input_file, max_items=0):
+        """
+        Yields the columns of each data line of a ROCStories tsv file. The header line is skipped.
+        :param input_file: Input tsv file
+        :param max_items: Max number of items to read. 0 for all
+        :return: Generator of lists with the line columns
+        """
+        with codecs.open(input_file, mode='rb', encoding='utf-8') as f:
+            line_id = 0
+            for line in f:
+                if line_id == 0:  # skip header
+                    line_id += 1
+                    continue
+
+                if max_items > 0 and line_id > max_items:
+                    break
 
-        items_list = []
-        for line in f:
-            if line_id == 0:  # skip header
+                yield line.split("\t")
                 line_id += 1
-                continue
 
-            if max_items > 0 and line_id > max_items:
-                break
+    @staticmethod
+    def iter_stories_data(input_file, max_items=0):
+        """
+        Lazily reads a ROCStories file (5 sentence stories)
+        :param input_file: Input tsv file
+        :param max_items: Max number of items to read. 0 for all
+        :return: Generator of StoryRecord
+        """
+        # storyid	storytitle	sentence1	sentence2	sentence3	sentence4	sentence5
+        # 9a51198e-96f1-42c3-b09d-a3e1e067d803	Overweight Kid	Dan's parents were overweight.	Dan was overweight as well.	The doctors told his parents it was unhealthy.	His parents understood and decided to make a change.	They got themselves and Dan on a diet.
+        for line_cols in DataUtilities_ROCStories.iter_tsv_lines(input_file, max_items):
+            yield StoryRecord(id=line_cols[0],  # storyid
+                              title=[line_cols[1]],
+                              sentences=line_cols[2:7])  # InputSentence1..5
 
-            line_cols = line.split("\t")
+    @staticmethod
+    def iter_stories_annotated_data(input_file, max_items=0):
+        """
+        Lazily reads a Story Cloze file (4 sentence stories with 2 ending choices)
+        :param input_file: Input tsv file
+        :param max_items: Max number of items to read. 0 for all
+        :return: Generator of StoryRecord
+        """
+        # InputStoryid	InputSentence1	InputSentence2	InputSentence3	InputSentence4	RandomFifthSentenceQuiz1	RandomFifthSentenceQuiz2	AnswerRightEnding
+        # b929f263-1dcd-4a0b-b267-5d5ff2fe65bb	My friends all love to go to the club to dance.	They think it's a lot of fun and always invite.	I finally decided to tag along last Saturday.	I danced terribly and broke a friend's toe.	My friends decided to keep inviting me out as I am so much fun.	The next weekend, I was asked to please stay home.	2
+        for line_cols in DataUtilities_ROCStories.iter_tsv_lines(input_file, max_items):
+            yield StoryRecord(id=line_cols[0],  # InputStoryid
+                              sentences=line_cols[1:5],  # InputSentence1..4
+                              endings=line_cols[5:7],  # RandomFifthSentenceQuiz1, RandomFifthSentenceQuiz2
+                              right_end_id=int(line_cols[7]) - 1)  # AnswerRightEnding
 
-            item = {}
-            item['id'] = line_cols[0]  # InputStoryid
-            item['sentences'] = []
-            item['sentences'].append(init_obj_raw_text(line_cols[1]))  # InputSentence1
-            item['sentences'].append(init_obj_raw_text(line_cols[2]))  # InputSentence2
-            item['sentences'].append(init_obj_raw_text(line_cols[3]))  # InputSentence3
-            item['sentences'].append(init_obj_raw_text(line_cols[4]))  # InputSentence4
+    @staticmethod
+    def iter_raw_stories_data(input_files_list, input_type):
+        """
+        Reads the stories of several tsv files as a single stream
+        :param input_files_list: List of tsv files
+        :param input_type: with_ending_choice or raw_stories
+        :return: Generator of StoryRecord
+        """
+        for curr_input_file in input_files_list:
+            print "curr_input_file: %s" % curr_input_file
+            if input_type == "with_ending_choice":
+                curr_file_raw_data = DataUtilities_ROCStories.iter_stories_annotated_data(curr_input_file)
+            elif input_type == "raw_stories":
+                curr_file_raw_data = DataUtilities_ROCStories.iter_stories_data(curr_input_file)
+            else:
+                raise Exception("input_type not supported: %s" % input_type)
 
-            item['endings'] = []
-            item['endings'].append(init_obj_raw_text(line_cols[5]))  # RandomFifthSentenceQuiz1
-            item['endings'].append(init_obj_raw_text(line_cols[6]))  # RandomFifthSentenceQuiz2
-            item['right_end_id'] = int(line_cols[7]) - 1  # AnswerRightEnding
+            for story_record in curr_file_raw_data:
+                yield story_record
 
-            items_list.append(item)
+    @staticmethod
+    def skip_committed_stories(raw_data, committed_cnt, last_committed_id):
+        """
+        Skips the stories that are already written to the output of a previous (interrupted) run
+        :param raw_data: Iterable of StoryRecord in the order of the previous run
+        :param committed_cnt: Number of stories in the output
+        :param last_committed_id: Id of the last story in the output
+        :return: Generator of the stories that are not parsed yet
+        """
+        data_iter = iter(raw_data)
+        skipped_cnt = 0
+        last_skipped_id = None
+        while skipped_cnt < committed_cnt:
+            story_record = next(data_iter, None)
+            if story_record is None:
+                break
+            last_skipped_id = story_record.id
+            skipped_cnt += 1
 
-            line_id += 1
+        if skipped_cnt < committed_cnt or last_skipped_id != last_committed_id:
+            raise Exception("Can not resume: output ends with story %s (item %s) but the input has story %s there. "
+                            "Check input_files or start over with -resume:False" % (last_committed_id, committed_cnt,
+                                                                                     last_skipped_id))
 
-        return items_list
+        for story_record in data_iter:
+            yield story_record
+
+    @staticmethod
+    def read_stories_data(input_file, max_items=0):
+        return [x.to_dict() for x in DataUtilities_ROCStories.iter_stories_data(input_file, max_items)]
+
+    @staticmethod
+    def read_stories_annotated_data(input_file, max_items=0):
+        return [x.to_dict() for x in DataUtilities_ROCStories.iter_stories_annotated_data(input_file, max_items)]
 
     @staticmethod
     def load_data_from_json_file(json_file):
+        if json_file.endswith(".jsonl"):
+            return list(iter_data_from_json_lines_file(json_file))
+
         data_file = codecs.open(json_file, mode='r', encoding="utf-8")
         data = json.load(data_file)
         data_file.close()
 
         return data
 
+    @staticmethod
+    def load_dataset(data_file, intern_vocab=False):
+        """
+        Loads a processed dataset
+        :param data_file: Columnar dataset directory (see convert_to_columnar), reference records file
+         (see -story_refs), .jsonl or .json file
+        :param intern_vocab: Intern the tokens, lemmas and pos of json data into integer vocabularies
+        :return: ColumnarStoryDataset, StoryReferenceDataset or list of story dicts
+        """
+        if is_columnar_dataset(data_file):
+            return ColumnarStoryDataset(data_file)
+
+        if is_story_refs_file(data_file):
+            # the source stories are loaded once, the items are resolved on access
+            return StoryReferenceDataset.load(data_file, lambda source_files: DataUtilities_ROCStories.load_datasets(
+                source_files, intern_vocab=intern_vocab))
+
+        data = DataUtilities_ROCStories.load_data_from_json_file(data_file)
+        if intern_vocab:
+            data = build_columnar_dataset(data)
+
+        return data
+
+    @staticmethod
+    def load_datasets(data_files, intern_vocab=False):
+        """
+        Loads and concatenates processed datasets
+        :param data_files: List of files accepted by load_dataset
+        :param intern_vocab: Intern the data of all files into one ColumnarStoryDataset
+        :return: ColumnarStoryDataset or list of story dicts
+        """
+        if len(data_files) == 1:
+            return DataUtilities_ROCStories.load_dataset(data_files[0], intern_vocab=intern_vocab)
+
+        data = []
+        for data_file in data_files:
+            data.extend(DataUtilities_ROCStories.load_dataset(data_file))
+
+        if intern_vocab:
+            data = build_columnar_dataset(data)
+
+        return data
+
     @staticmethod
     def save_data_to_json_file(data, output_json_file):
         data_file = codecs.open(output_json_file, mode='wb', encoding="utf-8")
@@ -196,393 +341,544 @@ class DataUtilities_ROCStories(object):
         data_file.close()
 
     @staticmethod
-    def mutate_train_data_smart_1(data_in, seed=42):
-        data = data_in
+    def save_data_items(data, output_file, log_every=100000, header=None):
+        """
+        Saves story items. Items are streamed to .jsonl files as they come (only one item in memory),
+        other files get a single json list.
+        :param data: Iterable of story items (list or generator)
+        :param output_file: Output file
+        :param log_every: Log the number of written items every log_every items
+        :param header: Dict written as the first line of a .jsonl file (not counted as an item)
+        :return: Number of saved items
+        """
+        if not output_file.endswith(".jsonl"):
+            if header is not None:
+                raise Exception("A header can be written only to .jsonl files: %s" % output_file)
+            data = list(data)
+            DataUtilities_ROCStories.save_data_to_json_file(data, output_json_file=output_file)
+            return len(data)
+
+        writer = JsonLinesWriter(output_file, flush_every=1000)
+        if header is not None:
+            writer.write(header)
+
+        items_cnt = 0
+        for story_item in data:
+            writer.write(story_item)
+            items_cnt += 1
+            if log_every > 0 and items_cnt % log_every == 0:
+                logging.info("%s items written to %s" % (items_cnt, output_file))
+        writer.close()
 
-        words_stories_inverted_index = InvertedIndex()
-        words_end_good_inverted_index = InvertedIndex()
-        words_end_bad_inverted_index = InvertedIndex()
+        return items_cnt
+
+    @staticmethod
+    def get_data_fingerprint(data):
+        """
+        Identifies the data a search index is built from: number of items and sha1 of the content that is indexed -
+        the item ids, the right ending ids and the tokens, lemmas and pos tags of the sentences and the endings.
+        A dataset that is parsed again with the same ids gets a different fingerprint.
+        """
+        content_hash = hashlib.sha1()
+        for story_item in data:
+            content_hash.update(unicode(story_item["id"]).encode("utf-8"))
+            content_hash.update("\x01%s\x01" % story_item.get("right_end_id", -1))
+            for field in ["sentences", "endings"]:
+                for sentence in story_item.get(field, []):
+                    for key in ["tokens", "lemmas", "pos"]:
+                        content_hash.update(u"\x00".join(sentence.get(key, [])).encode("utf-8"))
+                        content_hash.update("\x02")
+                content_hash.update("\x03")
+            content_hash.update("\n")
+
+        return {"items_cnt": len(data), "content_sha1": content_hash.hexdigest()}
+
+    @staticmethod
+    def build_search_index(data, index_type):
+        """
+        Builds the inverted index of the sentences that are searched for similar wrong endings
+        :param data: List of parsed stories
+        :param index_type: SEARCH_INDEX_WRONG_ENDINGS or SEARCH_INDEX_LAST_SENTENCES
+        :return: CSRInvertedIndex with the positions of the stories in data as documents
+        """
+        search_index = CSRInvertedIndex()
 
         logging.info("Building search...")
         for st_item_id in range(len(data)):
-            if (st_item_id+1) % 1000 == 0:
-                logging.info("Processed %s of %s" % (st_item_id+1, len(data)))
+            if (st_item_id + 1) % 1000 == 0:
+                logging.info("Processed %s of %s" % (st_item_id + 1, len(data)))
             st_item = data[st_item_id]
-            # extract story
-            for sent_i, sentence in st_item['sentences']:
-                for i in range(len(sentence["tokens"])):
-                    token = sentence["tokens"][i].lower()
-                    lemma = sentence["lemmas"][i].lower()
-                    pos = sentence["pos"][i].lower()
-                    pos_2 = pos[:min(2, len(pos))]
-
-                    feats = extract_features(token, lemma, pos, pos_2)
-                    words_stories_inverted_index.add_features(st_item_id, feats)
-
-            # extract endings
-            for ending_i in range(len(st_item['endings'])):
-                for i in range(len(st_item['endings'][ending_i]["tokens"])):
-                    inverted_index = None
-                    if ending_i == st_item["right_end_id"]:
-                        inverted_index = words_end_good_inverted_index
-                    else:
-                        inverted_index = words_end_bad_inverted_index
-
-                    token = st_item['endings'][ending_i]["tokens"][i].lower()
-                    lemma = st_item['endings'][ending_i]["lemmas"][i].lower()
-                    pos = st_item['endings'][ending_i]["pos"][i].lower()
-                    pos_2 = pos[:min(2, len(pos))]
-
-                    feats = extract_features(token, lemma, pos, pos_2)
-                    if (st_item_id + 1) % 1000 == 0:
-                        logging.info("Item: %s : feats:" % (str(st_item['endings'][ending_i]["raw_text"]), str(feats)))
-                    inverted_index.add_features(st_item_id, feats)
-            # print words_end_bad_inverted_index
+
+            if index_type == SEARCH_INDEX_WRONG_ENDINGS:
+                for ending_i in range(len(st_item['endings'])):
+                    if ending_i != st_item["right_end_id"]:
+                        search_index.add_features(st_item_id, extract_sentence_features(st_item['endings'][ending_i]))
+            elif index_type == SEARCH_INDEX_LAST_SENTENCES:
+                if len(st_item['sentences']) > 4:
+                    search_index.add_features(st_item_id, extract_sentence_features(st_item['sentences'][4]))
+            else:
+                raise Exception("Search index type not supported: %s" % index_type)
+
+        search_index.build()
         logging.info("Search built...")
 
-        def get_features_pr_nn(token, lemma, pos, pos_2):
-            feats = []
-            if pos.startswith('pr') or pos.startswith('nn'):
-                feats.append(get_lemma_pos_key(lemma, pos))
-            return feats
+        return search_index
+
+    @staticmethod
+    def load_or_build_search_index(data, index_type, search_index_dir=""):
+        """
+        Loads the search index from search_index_dir/index_type if it is built for the same data.
+        Otherwise builds it and saves it there (if search_index_dir is set).
+        """
+        meta = {"index_type": index_type,
+                "features_version": SEARCH_INDEX_FEATURES_VERSION,
+                "data": DataUtilities_ROCStories.get_data_fingerprint(data)}
+
+        if search_index_dir:
+            search_index_dir = os.path.join(search_index_dir, index_type)
+
+        if search_index_dir and CSRInvertedIndex.exists(search_index_dir):
+            search_index, saved_meta = CSRInvertedIndex.load(search_index_dir)
+            if all([saved_meta.get(k) == v for k, v in meta.iteritems()]):
+                logging.info("Search index loaded from %s" % search_index_dir)
+                return search_index
+
+            logging.info("Search index in %s is built for other data (%s), rebuilding" % (search_index_dir, saved_meta))
+
+        search_index = DataUtilities_ROCStories.build_search_index(data, index_type)
+        if search_index_dir:
+            search_index.save(search_index_dir, meta=meta)
+            logging.info("Search index saved to %s" % search_index_dir)
+
+        return search_index
+
+    @staticmethod
+    def get_sentence_vectors(sentences, embeddings_model, index2word_set):
+        """
+        Average word vectors of sentences. Tokens that are not in the model are looked up lowercased.
+        :param sentences: List of parsed sentences
+        :param embeddings_model: Word embeddings model (gensim Word2Vec interface)
+        :param index2word_set: Set of the words in the model
+        :return: float32 matrix with a vector per sentence
+        """
+        from utils.embedding_vector_utilities import AverageVectorsUtilities
+
+        num_features = embeddings_model.syn0.shape[1]
+        sentence_vectors = np.zeros((len(sentences), num_features), dtype=np.float32)
+        batch_size = 10000
+        for batch_start in range(0, len(sentences), batch_size):
+            words_lists = [[x if x in index2word_set else x.lower() for x in sentence["tokens"]]
+                           for sentence in sentences[batch_start:batch_start + batch_size]]
+            sentence_vectors[batch_start:batch_start + len(words_lists)] = \
+                AverageVectorsUtilities.makeFeatureVecs(words_lists, embeddings_model, num_features, index2word_set)
+            logging.info("Sentence vectors: %s of %s" % (batch_start + len(words_lists), len(sentences)))
+
+        return sentence_vectors
+
+    @staticmethod
+    def load_or_build_ann_index(data, emb_model_file, emb_model_bin=True, search_index_dir="", n_lists=0, n_probe=8):
+        """
+        Loads the nearest neighbour index of the fifth sentence vectors from search_index_dir/last_sentences_emb
+        if it is built for the same data and embeddings. Otherwise loads the embeddings, builds the index and
+        saves it there (if search_index_dir is set).
+        :param data: List of parsed raw stories
+        :param emb_model_file: Word2vec format embeddings file
+        :param emb_model_bin: The embeddings file is in binary format
+        :param search_index_dir: Directory with the saved search indexes
+        :param n_lists: Number of IVF lists. 0 for sqrt(number of stories)
+        :param n_probe: Number of lists searched for a story
+        :return: IVFIndex with the positions of the stories in data as documents
+        """
+        # the embeddings are identified by path, size and modification time
+        meta = {"index_type": SEARCH_INDEX_LAST_SENTENCES_EMB,
+                "emb_model": get_source_file_meta(emb_model_file),
+                "emb_model_bin": bool(emb_model_bin),
+                "n_lists": n_lists,
+                "data": DataUtilities_ROCStories.get_data_fingerprint(data)}
+
+        if search_index_dir:
+            search_index_dir = os.path.join(search_index_dir, SEARCH_INDEX_LAST_SENTENCES_EMB)
+
+        if search_index_dir and IVFIndex.exists(search_index_dir):
+            ann_index, saved_meta = IVFIndex.load(search_index_dir)
+            if all([saved_meta.get(k) == v for k, v in meta.iteritems()]):
+                ann_index.n_probe = n_probe
+                logging.info("Embeddings index loaded from %s" % search_index_dir)
+                return ann_index
+
+            logging.info("Embeddings index in %s is built for other data (%s), rebuilding" % (search_index_dir,
+                                                                                            saved_meta))
+
+        from gensim.models.word2vec import Word2Vec
+
+        logging.info("Loading embeddings from %s..." % emb_model_file)
+        embeddings_model = Word2Vec.load_word2vec_format(emb_model_file, binary=emb_model_bin)
+        index2word_set = set(embeddings_model.index2word)
+
+        last_sentences = [st_item["sentences"][-1] for st_item in data]
+        sentence_vectors = DataUtilities_ROCStories.get_sentence_vectors(last_sentences, embeddings_model,
+                                                                         index2word_set)
+        del embeddings_model
+
+        ann_index = IVFIndex(n_lists=n_lists, n_probe=n_probe)
+        ann_index.build(sentence_vectors)
+        if search_index_dir:
+            ann_index.save(search_index_dir, meta=meta)
+            logging.info("Embeddings index saved to %s" % search_index_dir)
+
+        return ann_index
+
+    @staticmethod
+    def mutate_train_data_smart_1(data_in, seed=42):
+        return list(DataUtilities_ROCStories.iter_mutate_train_data_smart_1(data_in, seed=seed))
+
+    @staticmethod
+    def iter_mutate_train_data_smart_1(data_in, seed=42, story_refs=False, search_index=None):
+        """
+        Generates train items from stories with ending choice: the right ending is paired with the wrong ending
+        and with wrong endings of similar stories. Items are yielded as they are generated.
+        :param data_in: List of parsed stories with endings
+        :param seed: Random seed
+        :param story_refs: Yield reference records (see make_story_ref) instead of story items
+        :param search_index: Index built with build_search_index. Built from data_in if not set
+        :return: Generator of story items
+        """
+        data = data_in
+
+        if search_index is None:
+            search_index = DataUtilities_ROCStories.build_search_index(data, SEARCH_INDEX_WRONG_ENDINGS)
+        words_end_bad_inverted_index = search_index
+
+        resolver = StoryReferenceResolver(data)
 
-        parsed_data = []
+        generated_cnt = 0
         random.seed(seed)
         items_cnt = len(data)
         for curr_item_id in range(len(data)):
             story_item = data[curr_item_id]
-            story_item_copy = deepcopy(story_item)
-            item = {}
-            item['id'] = story_item_copy['id']  # InputStoryid
-            item['sentences'] = []
-            item['sentences'].append(story_item_copy['sentences'][0])  # InputSentence1
-            item['sentences'].append(story_item_copy['sentences'][1])  # InputSentence2
-            item['sentences'].append(story_item_copy['sentences'][2])  # InputSentence3
-            item['sentences'].append(story_item_copy['sentences'][3])  # InputSentence4
-
-            item['right_end_id'] = story_item_copy['right_end_id']
-            right_ending_item = story_item_copy['endings'][story_item_copy['right_end_id']]
-            wrong_ending_item = story_item_copy['endings'][int(not(bool(story_item_copy['right_end_id'])))]
+            story_id = story_item['id']  # InputStoryid
+
+            # endings are kept as (story id, field, position) references
+            right_ending_ref = (story_id, 'endings', story_item['right_end_id'])
+            wrong_ending_pos = int(not(bool(story_item['right_end_id'])))
+            wrong_ending_item = story_item['endings'][wrong_ending_pos]
 
             selected_endings = []
             for ri in range(9):
-                selected_endings.append(wrong_ending_item)
+                selected_endings.append((story_id, 'endings', wrong_ending_pos))
 
-            similar_wrong_endings = words_end_bad_inverted_index.rank_similar_sentences(wrong_ending_item, get_features_pr_nn)
+            get_top = 3
+            similar_wrong_endings = words_end_bad_inverted_index.rank_similar_sentences(wrong_ending_item, get_features_pr_nn,
+                                                                                        top_k=get_top)
             if (curr_item_id+1) % 1000 == 0:
                 logging.info("")
                 logging.info("Story %s - similar: %s" %(curr_item_id, str(similar_wrong_endings)))
                 logging.info("story:%s" % wrong_ending_item["raw_text"])
 
-            get_top = 3
             if len(similar_wrong_endings) > 0:
                 for doc in similar_wrong_endings[:min(get_top, len(similar_wrong_endings))]:
                     sim_doc_id = doc[0]
                     if sim_doc_id != curr_item_id:
                         full_doc = data[sim_doc_id]
-                        curr_sim_ending = full_doc["endings"][int(not(bool(full_doc['right_end_id'])))]
-                        selected_endings.append(curr_sim_ending)
-                        logging.info("Sim:%s" % curr_sim_ending["raw_text"])
+                        sim_ending_pos = int(not(bool(full_doc['right_end_id'])))
+                        selected_endings.append((full_doc['id'], 'endings', sim_ending_pos))
+                        logging.info("Sim:%s" % full_doc["endings"][sim_ending_pos]["raw_text"])
             logging.info("-----------------")
-            item['endings'] = []
 
             gold = True
-            for sel_ending in selected_endings:
-                new_item = deepcopy(item)
-                new_item["gold"] = gold
-                gold = False
-
+            for sel_ending_ref in selected_endings:
                 # get random ending
                 right_end_id = random.randint(0, 1)
 
                 if right_end_id == 0:
-                    new_item['endings'].append(right_ending_item)
-                    new_item['endings'].append(deepcopy(sel_ending))
+                    endings = [right_ending_ref, sel_ending_ref]
                 else:
-                    new_item['endings'].append(deepcopy(sel_ending))
-                    new_item['endings'].append(right_ending_item)
+                    endings = [sel_ending_ref, right_ending_ref]
 
-                new_item['right_end_id'] = right_end_id  # AnswerRightEnding
+                new_item = make_story_ref(story_id, story_id, endings, right_end_id, gold=gold)
+                gold = False
 
-                parsed_data.append(new_item)
+                generated_cnt += 1
+                yield new_item if story_refs else resolver.resolve(new_item)
 
-        print "Generated data %s" % (len(parsed_data))
-        return parsed_data
+        print "Generated data %s" % generated_cnt
 
     @staticmethod
     def mutate_rocstories_data_pos_v1(data_in, seed=42, take_number=20):
-        data = data_in
-
-        words_stories_inverted_index = InvertedIndex()
-        words_end_last_sent_inverted_index = InvertedIndex()
+        return list(DataUtilities_ROCStories.iter_mutate_rocstories_data_pos_v1(data_in, seed=seed,
+                                                                                take_number=take_number))
 
-        logging.info("Building search...")
-        for st_item_id in range(len(data)):
-            if (st_item_id + 1) % 1000 == 0:
-                logging.info("Processed %s of %s" % (st_item_id + 1, len(data)))
-            st_item = data[st_item_id]
-            # extract story
-            for sent_i, sentence in enumerate(st_item['sentences']):
-                sent_feats = []
-                for i in range(len(sentence["tokens"])):
-                    token = sentence["tokens"][i].lower()
-                    lemma = sentence["lemmas"][i].lower()
-                    pos = sentence["pos"][i].lower()
-                    pos_2 = pos[:min(2, len(pos))]
-
-                    feats = extract_features(token, lemma, pos, pos_2)
-                    sent_feats.extend(feats)
-
-                # if (st_item_id + 1) % 1000 == 0:
-                #     logging.info("Item: %s : feats:%s" % (str(sentence["raw_text"]), str(sent_feats)))
-
-                if sent_i == 4:
-                    words_end_last_sent_inverted_index.add_features(st_item_id, sent_feats)
-                else:
-                    words_stories_inverted_index.add_features(st_item_id, sent_feats)
+    @staticmethod
+    def iter_mutate_rocstories_data_pos_v1(data_in, seed=42, take_number=20, story_refs=False, search_index=None):
+        """
+        Generates train items from raw stories: the fifth sentence is paired with fifth sentences of up to
+        take_number similar stories. Items are yielded as they are generated.
+        :param data_in: List of parsed stories
+        :param seed: Random seed
+        :param take_number: Number of wrong endings for a story
+        :param story_refs: Yield reference records (see make_story_ref) instead of story items
+        :param search_index: Index built with build_search_index. Built from data_in if not set
+        :return: Generator of story items
+        """
+        data = data_in
 
-        logging.info("Search built...")
+        if search_index is None:
+            search_index = DataUtilities_ROCStories.build_search_index(data, SEARCH_INDEX_LAST_SENTENCES)
 
-        def get_features_pr_nn(token, lemma, pos, pos_2):
-            feats = []
-            if pos.startswith('pr') or pos.startswith('nn'):
-                feats.append(get_lemma_pos_key(lemma, pos))
-            return feats
+        resolver = StoryReferenceResolver(data)
 
-        parsed_data = []
+        generated_cnt = 0
         random.seed(seed)
-        items_cnt = len(data)
         for curr_item_id in range(len(data)):
-            story_item = data[curr_item_id]
-            story_item_copy = deepcopy(story_item)
-            item = {}
-            item['id'] = story_item_copy['id']  # InputStoryid
-            item['sentences'] = []
-            item['sentences'].append(story_item_copy['sentences'][0])  # InputSentence1
-            item['sentences'].append(story_item_copy['sentences'][1])  # InputSentence2
-            item['sentences'].append(story_item_copy['sentences'][2])  # InputSentence3
-            item['sentences'].append(story_item_copy['sentences'][3])  # InputSentence4
-
-            right_ending_item = story_item_copy['sentences'][-1]
-
-
-            selected_endings = []
+            for new_item in DataUtilities_ROCStories.generate_pos_v1_story_refs(data, search_index, curr_item_id,
+                                                                              random, take_number):
+                generated_cnt += 1
+                yield new_item if story_refs else resolver.resolve(new_item)
 
-            sent_to_check = deepcopy(right_ending_item)
+        print "Generated data %s" % generated_cnt
 
-            include_sents = True
-            if include_sents:
-                for sent in story_item_copy['sentences'][:4]:
-                    sent_to_check["tokens"].extend(sent["tokens"])
-                    sent_to_check["lemmas"].extend(sent["lemmas"])
-                    sent_to_check["pos"].extend(sent["pos"])
+    @staticmethod
+    def iter_mutate_rocstories_data_pos_v1_sharded(data_in, seed=42, take_number=20, story_refs=False,
+                                                   search_index=None, num_workers=1, shard_size=1000):
+        """
+        Sharded version of iter_mutate_rocstories_data_pos_v1. The stories are split in shards of shard_size stories
+        and each shard is generated with its own random generator seeded with get_shard_seed(seed, shard_id),
+        so the output depends only on seed and shard_size - not on num_workers.
+        The shards are generated in a process pool that shares the data and the search index with the parent process
+        (fork, a memory mapped index is not copied) and the shard outputs are merged in the shard order.
+        :param data_in: List of parsed stories
+        :param seed: Random seed
+        :param take_number: Number of wrong endings for a story
+        :param story_refs: Yield reference records (see make_story_ref) instead of story items
+        :param search_index: Index built with build_search_index. Built from data_in if not set
+        :param num_workers: Number of worker processes. 1 generates the shards in this process
+        :param shard_size: Number of stories in a shard
+        :return: Generator of story items
+        """
+        data = data_in
 
-            similar_wrong_endings = words_end_last_sent_inverted_index.rank_similar_sentences(sent_to_check,
-                                                                                              get_features_pr_nn)
+        if search_index is None:
+            search_index = DataUtilities_ROCStories.build_search_index(data, SEARCH_INDEX_LAST_SENTENCES)
+        # build the pending postings before the fork so the workers do not build their own copies
+        search_index.build()
 
-            if (curr_item_id + 1) % 1000 == 0:
-                logging.info("Processed %s of %s" % (curr_item_id + 1, len(data)))
-                logging.info("Story %s - similar: %s" % (curr_item_id, str(len(similar_wrong_endings))))
-                logging.info("story:%s" % right_ending_item["raw_text"])
+        resolver = StoryReferenceResolver(data)
 
-            get_top = take_number
-            get_top_sorted = 500
-            endings_top_sorted = similar_wrong_endings[:min(get_top_sorted, len(similar_wrong_endings))]
-            random_top = random.sample(xrange(len(endings_top_sorted)), min(get_top, len(endings_top_sorted)))
-            random_top_docs = [endings_top_sorted[x] for x in random_top]
-            if len(similar_wrong_endings) > 0:
-                # shuffle(similar_wrong_endings)
-                for doc in random_top_docs:
-                    sim_doc_id = doc[0]
-                    if sim_doc_id != curr_item_id:
-                        full_doc = data[sim_doc_id]
-                        curr_sim_ending = full_doc["sentences"][-1]
-                        selected_endings.append((full_doc['id'], curr_sim_ending))
-                        if (curr_item_id + 1) % 1000 == 0:
-                            logging.info("Sim:%s" % curr_sim_ending["raw_text"])
-                            logging.info("-----------------")
-            item['endings'] = []
-
-            for sel_ending_with_id in selected_endings:
-                sel_ending_doc_id, sel_ending = sel_ending_with_id
-                new_item = deepcopy(item)
-                new_item["gold_story_id"] = new_item['id']
-                new_item['id'] = "s_%s_e_%s" % (new_item['id'], sel_ending_doc_id)
+        shard_size = max(1, shard_size)
+        shards_cnt = (len(data) + shard_size - 1) // shard_size
 
-                # get random ending
-                right_end_id = random.randint(0, 1)
+        _pos_v1_shard_state.clear()
+        _pos_v1_shard_state.update({"data": data, "search_index": search_index, "seed": seed,
+                                    "take_number": take_number, "shard_size": shard_size})
 
-                if right_end_id == 0:
-                    new_item['endings'].append(deepcopy(right_ending_item))
-                    new_item['endings'].append(deepcopy(sel_ending))
-                else:
-                    new_item['endings'].append(deepcopy(sel_ending))
-                    new_item['endings'].append(deepcopy(right_ending_item))
+        pool = None
+        if num_workers > 1 and shards_cnt > 1:
+            pool = multiprocessing.Pool(processes=min(num_workers, shards_cnt))
+            shards_refs = pool.imap(_generate_pos_v1_shard, range(shards_cnt))
+        else:
+            shards_refs = (_generate_pos_v1_shard(shard_id) for shard_id in range(shards_cnt))
 
-                new_item['right_end_id'] = right_end_id  # AnswerRightEnding
+        logging.info("Generating %s shards of %s stories with %s workers" % (shards_cnt, shard_size, num_workers))
+        generated_cnt = 0
+        try:
+            for shard_id, shard_refs in enumerate(shards_refs):
+                for new_item in shard_refs:
+                    generated_cnt += 1
+                    yield new_item if story_refs else resolver.resolve(new_item)
 
-                parsed_data.append(new_item)
+                logging.info("Shard %s of %s done" % (shard_id + 1, shards_cnt))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            _pos_v1_shard_state.clear()
 
-        print "Generated data %s" % (len(parsed_data))
-        return parsed_data
+        print "Generated data %s" % generated_cnt
 
     @staticmethod
-    def mutate_train_data_smart_1(data_in, seed=42):
+    def iter_mutate_rocstories_data_emb_nn(data_in, ann_index, seed=42, take_number=20, story_refs=False,
+                                           query_batch_size=1024):
+        """
+        Generates train items from raw stories: the fifth sentence is paired with the fifth sentences of the
+        take_number stories with the most similar fifth sentence vectors (hard negatives by embeddings).
+        The neighbours are retrieved from the nearest neighbour index in batches of stories.
+        :param data_in: List of parsed stories
+        :param ann_index: IVFIndex of the fifth sentence vectors (see load_or_build_ann_index)
+        :param seed: Random seed
+        :param take_number: Number of wrong endings for a story
+        :param story_refs: Yield reference records (see make_story_ref) instead of story items
+        :param query_batch_size: Number of stories searched at once
+        :return: Generator of story items
+        """
         data = data_in
 
-        words_stories_inverted_index = InvertedIndex()
-        words_end_good_inverted_index = InvertedIndex()
-        words_end_bad_inverted_index = InvertedIndex()
+        resolver = StoryReferenceResolver(data)
 
-        logging.info("Building search...")
-        for st_item_id in range(len(data)):
-            st_item = data[st_item_id]
-            # extract story
-            for sent_i, sentence in st_item['sentences']:
-                for i in range(len(sentence["tokens"])):
-                    token = sentence["tokens"][i].lower()
-                    lemma = sentence["lemmas"][i].lower()
-                    pos = sentence["pos"][i].lower()
-                    pos_2 = pos[:min(2, len(pos))]
-
-                    feats = extract_features(token, lemma, pos, pos_2)
-                    words_stories_inverted_index.add_features(st_item_id, feats)
-
-            # extract endings
-            for ending_i in range(len(st_item['endings'])):
-                for i in range(len(st_item['endings'][ending_i]["tokens"])):
-                    inverted_index = None
-                    if ending_i == st_item["right_end_id"]:
-                        inverted_index = words_end_good_inverted_index
-                    else:
-                        inverted_index = words_end_bad_inverted_index
-
-                    token = st_item['endings'][ending_i]["tokens"][i].lower()
-                    lemma = st_item['endings'][ending_i]["lemmas"][i].lower()
-                    pos = st_item['endings'][ending_i]["pos"][i].lower()
-                    pos_2 = pos[:min(2, len(pos))]
-
-                    feats = extract_features(token, lemma, pos, pos_2)
-                    inverted_index.add_features(st_item_id, feats)
-                    # print words_end_bad_inverted_index
-        logging.info("Search built...")
-
-        def get_features_pr_nn(token, lemma, pos, pos_2):
-            feats = []
-            if pos.startswith('pr') or pos.startswith('nn'):
-                feats.append(get_lemma_pos_key(lemma, pos))
-            return feats
-
-        parsed_data = []
+        generated_cnt = 0
         random.seed(seed)
-        items_cnt = len(data)
-        for curr_item_id in range(len(data)):
-            story_item = data[curr_item_id]
-            story_item_copy = deepcopy(story_item)
-            item = {}
-            item['id'] = story_item_copy['id']  # InputStoryid
-            item['sentences'] = []
-            item['sentences'].append(story_item_copy['sentences'][0])  # InputSentence1
-            item['sentences'].append(story_item_copy['sentences'][1])  # InputSentence2
-            item['sentences'].append(story_item_copy['sentences'][2])  # InputSentence3
-            item['sentences'].append(story_item_copy['sentences'][3])  # InputSentence4
-
-            item['right_end_id'] = story_item_copy['right_end_id']
-            right_ending_item = story_item_copy['endings'][story_item_copy['right_end_id']]
-            wrong_ending_item = story_item_copy['endings'][int(not (bool(story_item_copy['right_end_id'])))]
+        for batch_start in range(0, len(data), query_batch_size):
+            batch_end = min(len(data), batch_start + query_batch_size)
+            # the index vectors are the story vectors, the story itself is excluded from its neighbours
+            neighbour_ids, _ = ann_index.search(ann_index.vectors[batch_start:batch_end], top_k=take_number,
+                                                exclude_ids=np.arange(batch_start, batch_end))
+            logging.info("Processed %s of %s" % (batch_end, len(data)))
+
+            for curr_item_id in range(batch_start, batch_end):
+                story_item = data[curr_item_id]
+                story_id = story_item['id']
+
+                right_ending_ref = (story_id, 'sentences', len(story_item['sentences']) - 1)
+                for sim_doc_id in neighbour_ids[curr_item_id - batch_start]:
+                    if sim_doc_id < 0:
+                        break
+
+                    full_doc = data[sim_doc_id]
+                    sel_ending_ref = (full_doc['id'], 'sentences', len(full_doc['sentences']) - 1)
+
+                    # get random ending
+                    right_end_id = random.randint(0, 1)
+
+                    if right_end_id == 0:
+                        endings = [right_ending_ref, sel_ending_ref]
+                    else:
+                        endings = [sel_ending_ref, right_ending_ref]
 
-            selected_endings = []
-            for ri in range(9):
-                selected_endings.append(wrong_ending_item)
+                    new_item = make_story_ref("s_%s_e_%s" % (story_id, full_doc['id']), story_id, endings,
+                                              right_end_id, gold_story_id=story_id)
 
-            similar_wrong_endings = words_end_bad_inverted_index.rank_similar_sentences(wrong_ending_item,
-                                                                                        get_features_pr_nn)
-            logging.info("Story %s - similar: %s" % (curr_item_id, str(similar_wrong_endings)))
-            logging.info("story:%s" % wrong_ending_item["raw_text"])
+                    generated_cnt += 1
+                    yield new_item if story_refs else resolver.resolve(new_item)
 
-            get_top = 3
-            if len(similar_wrong_endings) > 0:
-                for doc in similar_wrong_endings[:min(get_top, len(similar_wrong_endings))]:
-                    sim_doc_id = doc[0]
-                    if sim_doc_id != curr_item_id:
-                        full_doc = data[sim_doc_id]
-                        curr_sim_ending = full_doc["endings"][int(not (bool(full_doc['right_end_id'])))]
-                        selected_endings.append(curr_sim_ending)
-                        logging.info("Sim:%s" % curr_sim_ending["raw_text"])
-            logging.info("-----------------")
-            item['endings'] = []
+        print "Generated data %s" % generated_cnt
 
-            gold = True
-            for sel_ending in selected_endings:
-                new_item = deepcopy(item)
-                new_item["gold"] = gold
-                gold = False
+    @staticmethod
+    def get_shard_seed(seed, shard_id):
+        """
+        Seed of the random generator of a shard. Does not depend on the python hash seed or the process
+        """
+        return int(hashlib.sha1("%s_%s" % (seed, shard_id)).hexdigest()[:8], 16)
 
-                # get random ending
-                right_end_id = random.randint(0, 1)
+    @staticmethod
+    def generate_pos_v1_story_refs(data, search_index, curr_item_id, rand, take_number=20):
+        """
+        Generates the items of mutate_rocstories_data_pos_v1 for a single story
+        :param data: List of parsed stories
+        :param search_index: Index built with build_search_index for SEARCH_INDEX_LAST_SENTENCES
+        :param curr_item_id: Position of the story in data
+        :param rand: Random generator (random module or random.Random)
+        :param take_number: Number of wrong endings for the story
+        :return: List of reference records (see make_story_ref)
+        """
+        words_end_last_sent_inverted_index = search_index
+
+        story_item = data[curr_item_id]
+        story_id = story_item['id']  # InputStoryid
+
+        right_ending_ref = (story_id, 'sentences', len(story_item['sentences']) - 1)
+        right_ending_item = story_item['sentences'][-1]
 
-                if right_end_id == 0:
-                    new_item['endings'].append(right_ending_item)
-                    new_item['endings'].append(deepcopy(sel_ending))
-                else:
-                    new_item['endings'].append(deepcopy(sel_ending))
-                    new_item['endings'].append(right_ending_item)
+        selected_endings = []
 
-                new_item['right_end_id'] = right_end_id  # AnswerRightEnding
+        sent_to_check = {"tokens": list(right_ending_item["tokens"]),
+                         "lemmas": list(right_ending_item["lemmas"]),
+                         "pos": list(right_ending_item["pos"])}
+
+        include_sents = True
+        if include_sents:
+            for sent in story_item['sentences'][:4]:
+                sent_to_check["tokens"].extend(sent["tokens"])
+                sent_to_check["lemmas"].extend(sent["lemmas"])
+                sent_to_check["pos"].extend(sent["pos"])
+
+        get_top = take_number
+        get_top_sorted = 500
+        similar_wrong_endings = words_end_last_sent_inverted_index.rank_similar_sentences(sent_to_check,
+                                                                                          get_features_pr_nn,
+                                                                                          top_k=get_top_sorted)
+
+        if (curr_item_id + 1) % 1000 == 0:
+            logging.info("Processed %s of %s" % (curr_item_id + 1, len(data)))
+            logging.info("Story %s - similar: %s" % (curr_item_id, str(len(similar_wrong_endings))))
+            logging.info("story:%s" % right_ending_item["raw_text"])
+
+        endings_top_sorted = similar_wrong_endings[:min(get_top_sorted, len(similar_wrong_endings))]
+        random_top = rand.sample(xrange(len(endings_top_sorted)), min(get_top, len(endings_top_sorted)))
+        random_top_docs = [endings_top_sorted[x] for x in random_top]
+        if len(similar_wrong_endings) > 0:
+            # shuffle(similar_wrong_endings)
+            for doc in random_top_docs:
+                sim_doc_id = doc[0]
+                if sim_doc_id != curr_item_id:
+                    full_doc = data[sim_doc_id]
+                    selected_endings.append((full_doc['id'], 'sentences', len(full_doc['sentences']) - 1))
+                    if (curr_item_id + 1) % 1000 == 0:
+                        logging.info("Sim:%s" % full_doc["sentences"][-1]["raw_text"])
+                        logging.info("-----------------")
+
+        new_items = []
+        for sel_ending_ref in selected_endings:
+            sel_ending_doc_id = sel_ending_ref[0]
+
+            # get random ending
+            right_end_id = rand.randint(0, 1)
+
+            if right_end_id == 0:
+                endings = [right_ending_ref, sel_ending_ref]
+            else:
+                endings = [sel_ending_ref, right_ending_ref]
 
-                parsed_data.append(new_item)
+            new_items.append(make_story_ref("s_%s_e_%s" % (story_id, sel_ending_doc_id), story_id, endings,
+                                            right_end_id, gold_story_id=story_id))
 
-        print "Generated data %s" % (len(parsed_data))
-        return parsed_data
+        return new_items
 
     @staticmethod
     def generate_random_train_data_from_raw_stories_json(data, random_number=3, seed=42):
+        return list(DataUtilities_ROCStories.iter_generate_random_train_data_from_raw_stories_json(
+            data, random_number=random_number, seed=seed))
 
-        selected_endings = []
+    @staticmethod
+    def iter_generate_random_train_data_from_raw_stories_json(data, random_number=3, seed=42, story_refs=False):
+        """
+        Generates train items from raw stories: the fifth sentence is paired with the fifth sentences of
+        random_number random stories. Items are yielded as they are generated.
+        :param data: List of parsed stories
+        :param random_number: Number of wrong endings for a story
+        :param seed: Random seed
+        :param story_refs: Yield reference records (see make_story_ref) instead of story items
+        :return: Generator of story items
+        """
+        selected_endings_cnt = 0
+        selected_endings_distinct = set()
+
+        resolver = StoryReferenceResolver(data)
 
-        parsed_data = []
         random.seed(seed)
         items_cnt = len(data)
         for story_item in data:
-            story_item_copy = story_item
-
-            item = {}
-            item['id'] = story_item_copy['id']  # InputStoryid
-            item['sentences'] = []
-            item['sentences'].append(story_item_copy['sentences'][0])  # InputSentence1
-            item['sentences'].append(story_item_copy['sentences'][1])  # InputSentence2
-            item['sentences'].append(story_item_copy['sentences'][2])  # InputSentence3
-            item['sentences'].append(story_item_copy['sentences'][3])  # InputSentence4
+            story_id = story_item['id']  # InputStoryid
+            right_ending_ref = (story_id, 'sentences', 4)
 
-            item['endings'] = []
             for i in range(random_number):
-                new_item = deepcopy(item)
-
-                right_ending_item = deepcopy(story_item_copy['sentences'][4])
-
                 # get random ending
                 rand_story_idx = random.randint(0, items_cnt-1)
-                selected_endings.append(rand_story_idx)
+                selected_endings_cnt += 1
+                selected_endings_distinct.add(rand_story_idx)
 
-                rand_story_ending_cp = deepcopy(data[rand_story_idx]['sentences'][4])
+                rand_story_ending_ref = (data[rand_story_idx]['id'], 'sentences', 4)
 
                 right_end_id = random.randint(0, 1)
 
                 if right_end_id == 0:
-                    new_item['endings'].append(right_ending_item)
-                    new_item['endings'].append(rand_story_ending_cp)
+                    endings = [right_ending_ref, rand_story_ending_ref]
                 else:
-                    new_item['endings'].append(rand_story_ending_cp)
-                    new_item['endings'].append(right_ending_item)
+                    endings = [rand_story_ending_ref, right_ending_ref]
 
-                new_item['right_end_id'] = right_end_id  # AnswerRightEnding
+                new_item = make_story_ref(story_id, story_id, endings, right_end_id)
 
-                parsed_data.append(new_item)
+                yield new_item if story_refs else resolver.resolve(new_item)
 
-        selected_endings_distinct = list(set(selected_endings))
-
-        print "Distinct wrong endings:%s of %s" % (len(selected_endings_distinct), len(selected_endings))
-        return parsed_data
+        print "Distinct wrong endings:%s of %s" % (len(selected_endings_distinct), selected_endings_cnt)
 
     # @staticmethod
     # def generate_stories_with_random_data(data):
@@ -606,29 +902,36 @@ class DataUtilities_ROCStories(object):
     #     return parsed_data
 
     @staticmethod
-    def parse_stories_data_with_stanford_parser(data, parser):
-        parsed_data = []
+    def iter_parse_stories_data_with_stanford_parser(data, parser, batch_story=False, cache=None):
+        """
+        Parses stories one by one. Accepts dict items or StoryRecord items (from the iter_* readers).
+        :param data: Iterable of stories
+        :param parser: CoreNLP parser
+        :param batch_story: Parse all texts of a story with a single parser call
+        :param cache: CoreNLPAnnotationCache to look up the texts in before parsing them
+        :return: Generator of parsed story dicts
+        """
         for story_item in data:
-            story_item_copy = deepcopy(story_item)
-            for list_field in ["sentences", "endings", "title"]:
-                if not list_field in story_item_copy:
-                    continue
-                for i in range(0, len(story_item_copy[list_field])):
-                    raw_text = story_item_copy[list_field][i]["raw_text"]
+            if isinstance(story_item, StoryRecord):
+                story_item = story_item.to_dict()
 
-                    data_source_parse = parser.parse_doc(raw_text)
-                    # print "Raw text:%s"%raw_text
-                    # logging.info(data_source_parse)
-                    # print data_source_parse
+            yield parse_story_item(story_item, parser, batch_story=batch_story, cache=cache)
 
-                    sent_processed = deepcopy(data_source_parse["sentences"][0])
-                    sent_processed["raw_text"] = raw_text
-
-                    story_item_copy[list_field][i] = sent_processed
+    @staticmethod
+    def iter_parse_stories_data_with_parser_pool(data, parser_pool):
+        """
+        Parses stories in parallel with a CoreNLPParserPool. Accepts dict items or StoryRecord items.
+        :param data: Iterable of stories
+        :param parser_pool: CoreNLPParserPool
+        :return: Generator of parsed story dicts in the input order
+        """
+        story_dicts = (x.to_dict() if isinstance(x, StoryRecord) else x for x in data)
 
-            parsed_data.append(story_item_copy)
+        return parser_pool.imap_parse(story_dicts)
 
-        return parsed_data
+    @staticmethod
+    def parse_stories_data_with_stanford_parser(data, parser):
+        return list(DataUtilities_ROCStories.iter_parse_stories_data_with_stanford_parser(data, parser))
 
     @staticmethod
     def parse_stories_annotated_data_with_stanford_parser(data, parser):
@@ -696,43 +999,157 @@ if __name__ == "__main__":
 
     parse_mode = "pos"  # "pos", "parse"
     parse_mode = CommonUtilities.get_param_value("parse_mode", sys.argv, parse_mode)
+
+    parse_workers = 0  # 0 - single parser, sentence by sentence; N - pool of N parsers
+    parse_workers = CommonUtilities.get_param_value_int("parse_workers", sys.argv, parse_workers)
+    print "parse_workers:%s" % parse_workers
+
+    parse_batch_story = True  # one parser call per story when parse_workers > 0
+    parse_batch_story = CommonUtilities.get_param_value_bool("parse_batch_story", sys.argv, parse_batch_story)
+    print "parse_batch_story:%s" % parse_batch_story
+
+    parse_cache_file = ""  # sqlite file with cached parses. Empty for no cache
+    parse_cache_file = CommonUtilities.get_param_value("parse_cache_file", sys.argv, parse_cache_file)
+    print "parse_cache_file:%s" % parse_cache_file
+
+    parse_cache_max_entries = 10000000
+    parse_cache_max_entries = CommonUtilities.get_param_value_int("parse_cache_max_entries", sys.argv, parse_cache_max_entries)
+    print "parse_cache_max_entries:%s" % parse_cache_max_entries
+
+    resume = True  # continue an interrupted run when output_file is a .jsonl file
+    resume = CommonUtilities.get_param_value_bool("resume", sys.argv, resume)
+    print "resume:%s" % resume
+
+    checkpoint_every = 100  # stories written to the .jsonl output between flushes to disk
+    checkpoint_every = CommonUtilities.get_param_value_int("checkpoint_every", sys.argv, checkpoint_every)
+    print "checkpoint_every:%s" % checkpoint_every
+
+    story_refs = False  # generation commands write (story id, ending source) references instead of copied items
+    story_refs = CommonUtilities.get_param_value_bool("story_refs", sys.argv, story_refs)
+    print "story_refs:%s" % story_refs
+    story_refs_header = make_story_refs_header(input_files_list) if story_refs else None
+
+    search_index_dir = ""  # saved search index for the mutate commands. Built and saved there if missing or stale
+    search_index_dir = CommonUtilities.get_param_value("search_index_dir", sys.argv, search_index_dir)
+    print "search_index_dir:%s" % search_index_dir
+
+    gen_workers = 0  # 0 - single random seed for all stories; N - sharded generation (per shard seeds) in N processes
+    gen_workers = CommonUtilities.get_param_value_int("gen_workers", sys.argv, gen_workers)
+    print "gen_workers:%s" % gen_workers
+
+    gen_shard_size = 1000  # stories in a generation shard. The sharded output depends on it, not on gen_workers
+    gen_shard_size = CommonUtilities.get_param_value_int("gen_shard_size", sys.argv, gen_shard_size)
+    print "gen_shard_size:%s" % gen_shard_size
+
+    emb_model_file = ""  # word2vec format embeddings for mutate_rocstories_data_emb_nn
+    emb_model_file = CommonUtilities.get_param_value("emb_model_file", sys.argv, emb_model_file)
+    print "emb_model_file:%s" % emb_model_file
+
+    emb_model_bin = True  # the embeddings file is in binary format (GoogleNews)
+    emb_model_bin = CommonUtilities.get_param_value_bool("emb_model_bin", sys.argv, emb_model_bin)
+    print "emb_model_bin:%s" % emb_model_bin
+
+    ann_lists = 0  # number of nearest neighbour index lists. 0 for sqrt(number of stories)
+    ann_lists = CommonUtilities.get_param_value_int("ann_lists", sys.argv, ann_lists)
+    print "ann_lists:%s" % ann_lists
+
+    ann_probe = 8  # number of nearest neighbour index lists searched for a story
+    ann_probe = CommonUtilities.get_param_value_int("ann_probe", sys.argv, ann_probe)
+    print "ann_probe:%s" % ann_probe
+
     if(command=="convert_to_json_with_parse"):
         data_format = "tac2014"
         print "Data format:%s" % data_format
 
+        parse_cache = None
+        if parse_cache_file:
+            parse_cache = CoreNLPAnnotationCache(parse_cache_file, parse_mode=parse_mode,
+                                                 max_entries=parse_cache_max_entries)
+
+        parser = None
+        parser_pool = None
+        if parse_workers > 0:
+            parser_pool = CoreNLPParserPool(lambda: CoreNLP(parse_mode, corenlp_jars=coreNlpPath.split(';')),
+                                            num_workers=parse_workers,
+                                            batch_story=parse_batch_story,
+                                            cache=parse_cache)
+        else:
+            parser = CoreNLP(parse_mode, corenlp_jars=coreNlpPath.split(';'))
 
-        parser = CoreNLP(parse_mode, corenlp_jars=coreNlpPath.split(';'))
+        start = time.time()
 
+        # stories are read, parsed and collected one at a time
+        raw_data = DataUtilities_ROCStories.iter_raw_stories_data(input_files_list, input_type)
+
+        if output_file.endswith(".jsonl"):
+            # parsed stories are appended to the output as they are done so an interrupted run can be resumed
+            committed_cnt = 0
+            if resume and os.path.exists(output_file):
+                committed_cnt, last_committed_item = repair_json_lines_file(output_file)
+                if committed_cnt > 0:
+                    print "Resuming after %s stories in %s (last story id: %s)" % (committed_cnt, output_file,
+                                                                                  last_committed_item["id"])
+                    raw_data = DataUtilities_ROCStories.skip_committed_stories(raw_data, committed_cnt,
+                                                                              last_committed_item["id"])
+
+            if parser_pool is not None:
+                parsed_data = DataUtilities_ROCStories.iter_parse_stories_data_with_parser_pool(raw_data, parser_pool=parser_pool)
+            else:
+                parsed_data = DataUtilities_ROCStories.iter_parse_stories_data_with_stanford_parser(raw_data, parser=parser,
+                                                                                                   cache=parse_cache)
+
+            writer = JsonLinesWriter(output_file, append=committed_cnt > 0, flush_every=checkpoint_every)
+            parsed_cnt = 0
+            for parsed_item in parsed_data:
+                writer.write(parsed_item)
+                parsed_cnt += 1
+                if checkpoint_every > 0 and parsed_cnt % checkpoint_every == 0:
+                    print "%s stories parsed, %.2f stories/sec" % (parsed_cnt, parsed_cnt / (time.time() - start))
+            writer.close()
+            items_cnt = committed_cnt + parsed_cnt
+        else:
+            if parser_pool is not None:
+                data = list(DataUtilities_ROCStories.iter_parse_stories_data_with_parser_pool(raw_data, parser_pool=parser_pool))
+            else:
+                data = list(DataUtilities_ROCStories.iter_parse_stories_data_with_stanford_parser(raw_data, parser=parser,
+                                                                                                  cache=parse_cache))
+            parsed_cnt = len(data)
+            items_cnt = len(data)
+            DataUtilities_ROCStories.save_data_to_json_file(data, output_json_file=output_file)
+
+        if parser_pool is not None:
+            parser_pool.close()
+        if parse_cache is not None:
+            print "Parse cache: %s" % parse_cache.stats_str()
+            parse_cache.close()
+        end = time.time()
+        print("Done in %s s" % (end - start))
+        print("%s stories parsed, %.2f stories/sec" % (parsed_cnt, parsed_cnt / max(end - start, 1e-6)))
+
+        print items_cnt
+        print("Data exported to %s" % output_file)
+
+    elif (command == "convert_to_columnar"):
         start = time.time()
 
-        data = []
-        for dir_idx in range(len(input_files_list)):
-            curr_input_file = input_files_list[dir_idx]
+        def iter_json_data(input_files_list):
+            for curr_input_file in input_files_list:
+                print "curr_input_file: %s" % curr_input_file
+                if curr_input_file.endswith(".jsonl"):
+                    curr_file_data = iter_data_from_json_lines_file(curr_input_file)
+                else:
+                    curr_file_data = DataUtilities_ROCStories.load_data_from_json_file(curr_input_file)
 
-            json_data = []
-            print "parsing"
-            print "curr_input_file: %s" % curr_input_file
-            if input_type == "with_ending_choice":
-                curr_file_raw_data = DataUtilities_ROCStories.read_stories_annotated_data(curr_input_file)
+                for story_item in curr_file_data:
+                    yield story_item
 
-                print("%s items loaded from %s", (len(curr_file_raw_data), curr_input_file))
-                json_data = DataUtilities_ROCStories.parse_stories_annotated_data_with_stanford_parser(curr_file_raw_data, parser=parser)
-            elif input_type == "raw_stories":
-                curr_file_raw_data = DataUtilities_ROCStories.read_stories_data(curr_input_file)
-                print("%s items loaded from %s", (len(curr_file_raw_data), curr_input_file))
-                json_data = DataUtilities_ROCStories.parse_stories_data_with_stanford_parser(curr_file_raw_data, parser=parser)
-            else:
-                raise Exception("input_type not supported: %s" % input_type)
+        items_cnt = save_columnar_dataset(iter_json_data(input_files_list), output_file)
 
-            data.extend(json_data)
         end = time.time()
         print("Done in %s s" % (end - start))
 
-        print len(data)
-        DataUtilities_ROCStories.save_data_to_json_file(data, output_json_file=output_file)
-        print ("Data exported to %s" % output_file)
+        print items_cnt
         print("Data exported to %s" % output_file)
-
     elif (command == "generate_train_random"):
         start = time.time()
 
@@ -748,16 +1165,37 @@ if __name__ == "__main__":
                 raise Exception("cmd generate_train_random: input_type not supported: %s" % input_type)
             data.extend(json_data)
 
-        data_train = []
-        data_train = DataUtilities_ROCStories.generate_random_train_data_from_raw_stories_json(data, random_number=random_number, seed=422)
+        data_train = DataUtilities_ROCStories.iter_generate_random_train_data_from_raw_stories_json(data, random_number=random_number, seed=422,
+                                                                                                   story_refs=story_refs)
+        items_cnt = DataUtilities_ROCStories.save_data_items(data_train, output_file, header=story_refs_header)
 
         end = time.time()
         print("Done in %s s" % (end - start))
 
         print len(data)
-        DataUtilities_ROCStories.save_data_to_json_file(data_train, output_json_file=output_file)
-        print ("Data exported to %s" % output_file)
-        print("Data exported to %s" % output_file)
+        print("%s items exported to %s" % (items_cnt, output_file))
+    elif (command == "build_search_index"):
+        start = time.time()
+
+        data = []
+        for dir_idx in range(len(input_files_list)):
+            curr_input_file = input_files_list[dir_idx]
+            data.extend(DataUtilities_ROCStories.load_data_from_json_file(curr_input_file))
+
+        if input_type == "with_ending_choice":
+            index_type = SEARCH_INDEX_WRONG_ENDINGS
+        elif input_type == "raw_stories":
+            index_type = SEARCH_INDEX_LAST_SENTENCES
+        else:
+            raise Exception("cmd build_search_index: input_type not supported: %s" % input_type)
+
+        if not search_index_dir:
+            search_index_dir = output_file
+        DataUtilities_ROCStories.load_or_build_search_index(data, index_type, search_index_dir=search_index_dir)
+
+        end = time.time()
+        print("Done in %s s" % (end - start))
+        print("Search index for %s items saved to %s" % (len(data), search_index_dir))
     elif (command == "mutate_train_smart_1"):
         start = time.time()
 
@@ -772,16 +1210,17 @@ if __name__ == "__main__":
 
         data.extend(json_data)
 
-        data_train=[]
-        data_train = DataUtilities_ROCStories.mutate_train_data_smart_1(data, seed=422)
+        search_index = DataUtilities_ROCStories.load_or_build_search_index(data, SEARCH_INDEX_WRONG_ENDINGS,
+                                                                          search_index_dir=search_index_dir)
+        data_train = DataUtilities_ROCStories.iter_mutate_train_data_smart_1(data, seed=422, story_refs=story_refs,
+                                                                            search_index=search_index)
+        items_cnt = DataUtilities_ROCStories.save_data_items(data_train, output_file, header=story_refs_header)
 
         end = time.time()
         print("Done in %s s" % (end - start))
 
         print len(data)
-        DataUtilities_ROCStories.save_data_to_json_file(data_train, output_json_file=output_file)
-        print ("Data exported to %s" % output_file)
-        print("Data exported to %s" % output_file)
+        print("%s items exported to %s" % (items_cnt, output_file))
     elif (command == "randomize_data_90_10"):
         start = time.time()
 
@@ -832,15 +1271,52 @@ if __name__ == "__main__":
 
             data.extend(json_data)
 
-        data_train = []
-        data_train = DataUtilities_ROCStories.mutate_rocstories_data_pos_v1(data, seed=422, take_number = random_number)
+        search_index = DataUtilities_ROCStories.load_or_build_search_index(data, SEARCH_INDEX_LAST_SENTENCES,
+                                                                          search_index_dir=search_index_dir)
+        if gen_workers > 0:
+            data_train = DataUtilities_ROCStories.iter_mutate_rocstories_data_pos_v1_sharded(data, seed=422,
+                                                                                            take_number=random_number,
+                                                                                            story_refs=story_refs,
+                                                                                            search_index=search_index,
+                                                                                            num_workers=gen_workers,
+                                                                                            shard_size=gen_shard_size)
+        else:
+            data_train = DataUtilities_ROCStories.iter_mutate_rocstories_data_pos_v1(data, seed=422, take_number = random_number,
+                                                                                    story_refs=story_refs,
+                                                                                    search_index=search_index)
+        items_cnt = DataUtilities_ROCStories.save_data_items(data_train, output_file, header=story_refs_header)
 
         end = time.time()
         print("Done in %s s" % (end - start))
 
         print len(data)
-        DataUtilities_ROCStories.save_data_to_json_file(data_train, output_json_file=output_file)
-        print ("Data exported to %s" % output_file)
-        print("Data exported to %s" % output_file)
+        print("%s items exported to %s" % (items_cnt, output_file))
+    elif (command == "mutate_rocstories_data_emb_nn"):
+        start = time.time()
+
+        data = []
+        for dir_idx in range(len(input_files_list)):
+            curr_input_file = input_files_list[dir_idx]
+
+            if input_type == "raw_stories":
+                json_data = DataUtilities_ROCStories.load_data_from_json_file(curr_input_file)
+            else:
+                raise Exception("cmd mutate_rocstories_data_emb_nn: input_type not supported: %s" % input_type)
+
+            data.extend(json_data)
+
+        ann_index = DataUtilities_ROCStories.load_or_build_ann_index(data, emb_model_file, emb_model_bin=emb_model_bin,
+                                                                     search_index_dir=search_index_dir,
+                                                                     n_lists=ann_lists, n_probe=ann_probe)
+        data_train = DataUtilities_ROCStories.iter_mutate_rocstories_data_emb_nn(data, ann_index, seed=422,
+                                                                                take_number=random_number,
+                                                                                story_refs=story_refs)
+        items_cnt = DataUtilities_ROCStories.save_data_items(data_train, output_file, header=story_refs_header)
+
+        end = time.time()
+        print("Done in %s s" % (end - start))
+
+        print len(data)
+        print("%s items exported to %s" % (items_cnt, output_file))
     else:
         print "No command param specified: use -cmd:convert_to_json_2014 or -cmd:convert_to_json_2015 "
\ No newline at end of file
@@ -0,0 +1,539 @@
+import json
+import logging
+import os
+from array import array
+
+import numpy as np
+
+COLUMNAR_FORMAT_VERSION = 1
+COLUMNAR_META_FILE = "meta.json"
+
+STORY_LIST_FIELDS = ["sentences", "endings", "title"]
+STORY_KNOWN_KEYS = set(["id", "right_end_id"] + STORY_LIST_FIELDS)
+
+# sentence annotation field -> vocabulary name
+SENTENCE_VOCAB_FIELDS = [("tokens", "tokens"), ("lemmas", "lemmas"), ("pos", "pos")]
+
+
+def is_columnar_dataset(path):
+    """
+    Checks if the path is a directory written by ColumnarStoryDatasetWriter
+    """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, COLUMNAR_META_FILE))
+
+
+def load_array(file_name, mmap_mode="r"):
+    """
+    Loads a .npy array, memory mapped if possible (empty arrays can not be mapped)
+    """
+    if mmap_mode is not None:
+        try:
+            return np.load(file_name, mmap_mode=mmap_mode)
+        except ValueError:
+            pass
+
+    return np.load(file_name)
+
+
+class LazyColumns(object):
+    """
+    Dict-like access to the .npy arrays of a dataset directory
+    """
+
+    def __init__(self, dataset_dir, mmap_mode="r"):
+        self._dataset_dir = dataset_dir
+        self._mmap_mode = mmap_mode
+
+    def __getitem__(self, name):
+        return load_array(os.path.join(self._dataset_dir, "%s.npy" % name), self._mmap_mode)
+
+
+class StringColumn(object):
+    """
+    List of unicode strings stored as one utf-8 byte array and an offsets array.
+    Strings are decoded on access.
+    """
+
+    def __init__(self, data_bytes, offsets):
+        self._data_bytes = data_bytes
+        self._offsets = offsets
+
+    @staticmethod
+    def from_columns(columns, name):
+        return StringColumn(columns["%s_bytes" % name], columns["%s_offsets" % name])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        return self._data_bytes[self._offsets[idx]:self._offsets[idx + 1]].tostring().decode("utf-8")
+
+
+class StringColumnWriter(object):
+    def __init__(self):
+        self._data_bytes = bytearray()
+        self._offsets = array('l', [0])
+
+    def append(self, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        self._data_bytes.extend(value)
+        self._offsets.append(len(self._data_bytes))
+
+    def get_columns(self, name):
+        return {"%s_bytes" % name: np.frombuffer(bytes(self._data_bytes), dtype=np.uint8),
+                "%s_offsets" % name: np.array(self._offsets, dtype=np.int64)}
+
+
+class ColumnarStoryDatasetWriter(object):
+    """
+    Converts story dicts (the json format produced by DataUtilities_ROCStories) to the columnar format:
+     - vocab_<name>.json - token, lemma and pos vocabularies (id is the position in the list)
+     - <tokens|lemmas|pos>_ids.npy - flat int32 ids of all sentence tokens
+     - char_offsets.npy - (tokens_cnt, 2) int32 token char offsets
+     - sent_token_offsets.npy - start of each sentence in the flat token arrays (+ the end of the last one)
+     - <sentences|endings|title>_ranges.npy - (items_cnt, 2) range of the story sentences in the sentence table.
+       Start is -1 if the story does not have the field
+     - right_end_id.npy - int8, -1 if not set
+     - raw_text_*, id_*, extra_* - string columns with the sentence raw texts, story ids and other story fields (json)
+    Only tokens, lemmas, pos, char_offsets and raw_text of a sentence are kept.
+    Usage:
+        writer = ColumnarStoryDatasetWriter("train.columnar")
+        for story_item in data:
+            writer.append(story_item)
+        writer.close()  # or writer.to_dataset() for an in-memory dataset (dataset_dir=None)
+    """
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        if dataset_dir is not None and not os.path.exists(dataset_dir):
+            os.makedirs(dataset_dir)
+
+        self.items_cnt = 0
+        self._annotated = None
+
+        self._vocabs = dict([(vocab_name, {}) for _, vocab_name in SENTENCE_VOCAB_FIELDS])
+        self._token_ids = dict([(field, array('i')) for field, _ in SENTENCE_VOCAB_FIELDS])
+        self._char_offsets = array('i')
+        self._sent_token_offsets = array('l', [0])
+        self._sent_cnt = 0
+
+        self._field_ranges = dict([(field, array('l')) for field in STORY_LIST_FIELDS])
+        self._right_end_id = array('b')
+        self._raw_text = StringColumnWriter()
+        self._ids = StringColumnWriter()
+        self._extra = StringColumnWriter()
+
+    def _append_sentence(self, sent):
+        if self._annotated is None:
+            self._annotated = "tokens" in sent
+
+        if self._annotated:
+            for field, vocab_name in SENTENCE_VOCAB_FIELDS:
+                vocab = self._vocabs[vocab_name]
+                ids = self._token_ids[field]
+                for value in sent[field]:
+                    value_id = vocab.get(value)
+                    if value_id is None:
+                        value_id = len(vocab)
+                        vocab[value] = value_id
+                    ids.append(value_id)
+
+            tokens_cnt = len(sent["tokens"])
+            char_offsets = sent.get("char_offsets", [])
+            if len(char_offsets) == tokens_cnt:
+                for start, end in char_offsets:
+                    self._char_offsets.append(start)
+                    self._char_offsets.append(end)
+            else:
+                self._char_offsets.extend([-1] * (2 * tokens_cnt))
+
+            self._sent_token_offsets.append(self._sent_token_offsets[-1] + tokens_cnt)
+        else:
+            if "tokens" in sent:
+                raise Exception("Sentences with and without annotations can not be mixed in one dataset")
+            self._sent_token_offsets.append(self._sent_token_offsets[-1])
+
+        self._raw_text.append(sent.get("raw_text", u""))
+        self._sent_cnt += 1
+
+    def append(self, story_item):
+        for field in STORY_LIST_FIELDS:
+            if field not in story_item:
+                self._field_ranges[field].extend([-1, -1])
+                continue
+
+            start = self._sent_cnt
+            for sent in story_item[field]:
+                self._append_sentence(sent)
+            self._field_ranges[field].extend([start, self._sent_cnt])
+
+        self._right_end_id.append(story_item.get("right_end_id", -1))
+        self._ids.append(unicode(story_item["id"]))
+
+        extra = dict([(k, v) for k, v in story_item.iteritems() if k not in STORY_KNOWN_KEYS])
+        self._extra.append(json.dumps(extra) if len(extra) > 0 else "")
+
+        self.items_cnt += 1
+
+    def get_vocabs(self):
+        vocabs = {}
+        for vocab_name, vocab in self._vocabs.iteritems():
+            vocab_list = [None] * len(vocab)
+            for value, value_id in vocab.iteritems():
+                vocab_list[value_id] = value
+            vocabs[vocab_name] = vocab_list
+
+        return vocabs
+
+    def get_meta(self):
+        return {"format_version": COLUMNAR_FORMAT_VERSION,
+                "items_cnt": self.items_cnt,
+                "sentences_cnt": self._sent_cnt,
+                "tokens_cnt": self._sent_token_offsets[-1],
+                "annotated": bool(self._annotated)}
+
+    def get_columns(self):
+        """
+        :return: Dict with the numpy arrays of the dataset, keyed by file name (without .npy)
+        """
+        columns = {}
+        for field, ids in self._token_ids.iteritems():
+            columns["%s_ids" % field] = np.array(ids, dtype=np.int32)
+
+        columns["char_offsets"] = np.array(self._char_offsets, dtype=np.int32).reshape((-1, 2))
+        columns["sent_token_offsets"] = np.array(self._sent_token_offsets, dtype=np.int64)
+        for field, ranges in self._field_ranges.iteritems():
+            columns["%s_ranges" % field] = np.array(ranges, dtype=np.int64).reshape((-1, 2))
+        columns["right_end_id"] = np.array(self._right_end_id, dtype=np.int8)
+
+        for name, string_column in [("raw_text", self._raw_text), ("id", self._ids), ("extra", self._extra)]:
+            columns.update(string_column.get_columns(name))
+
+        return columns
+
+    def to_dataset(self):
+        """
+        Creates an in-memory ColumnarStoryDataset from the appended items without writing files
+        """
+        return ColumnarStoryDataset(None, meta=self.get_meta(), vocabs=self.get_vocabs(), columns=self.get_columns())
+
+    def close(self):
+        dataset_dir = self.dataset_dir
+        for vocab_name, vocab_list in self.get_vocabs().iteritems():
+            with open(os.path.join(dataset_dir, "vocab_%s.json" % vocab_name), mode="wb") as vocab_file:
+                json.dump(vocab_list, vocab_file)
+
+        for name, column in self.get_columns().iteritems():
+            np.save(os.path.join(dataset_dir, "%s.npy" % name), column)
+
+        # meta is written last so an interrupted conversion is not recognized as a dataset
+        with open(os.path.join(dataset_dir, COLUMNAR_META_FILE), mode="wb") as meta_file:
+            json.dump(self.get_meta(), meta_file)
+
+        logging.info("Columnar dataset with %s items saved to %s" % (self.items_cnt, dataset_dir))
+
+
+class ColumnarStoryDataset(object):
+    """
+    Read only list of stories stored in the columnar format (see ColumnarStoryDatasetWriter).
+    The arrays are memory mapped so loading is fast and the pages are shared between processes.
+    Items are materialized as story dicts (the same as the json format) on access.
+    Slices are views that share the arrays.
+    Usage:
+        data = ColumnarStoryDataset("train.columnar")
+        for story_item in data[:1000]:
+            ...
+        token_ids = data.sentence_ids(data.field_sentence_ids(0, "endings")[0], "tokens")
+    """
+
+    def __init__(self, dataset_dir, mmap_mode="r", meta=None, vocabs=None, columns=None):
+        """
+        :param dataset_dir: Directory written by ColumnarStoryDatasetWriter
+        :param mmap_mode: np.load mmap_mode for the arrays. None to read them in memory
+        :param meta, vocabs, columns: Dataset content, used instead of dataset_dir (see ColumnarStoryDatasetWriter.to_dataset)
+        """
+        self.dataset_dir = dataset_dir
+        if dataset_dir is not None:
+            with open(os.path.join(dataset_dir, COLUMNAR_META_FILE), mode="rb") as meta_file:
+                meta = json.load(meta_file)
+
+            if meta["format_version"] != COLUMNAR_FORMAT_VERSION:
+                raise Exception("Columnar dataset format version %s is not supported (expected %s)" % (
+                    meta["format_version"], COLUMNAR_FORMAT_VERSION))
+
+            vocabs = {}
+            for _, vocab_name in SENTENCE_VOCAB_FIELDS:
+                with open(os.path.join(dataset_dir, "vocab_%s.json" % vocab_name), mode="rb") as vocab_file:
+                    vocabs[vocab_name] = json.load(vocab_file)
+
+            columns = LazyColumns(dataset_dir, mmap_mode)
+
+        self.meta = meta
+        self.vocabs = vocabs
+
+        self.token_ids = dict([(field, columns["%s_ids" % field]) for field, _ in SENTENCE_VOCAB_FIELDS])
+        self.char_offsets = columns["char_offsets"]
+        self.sent_token_offsets = columns["sent_token_offsets"]
+        self.field_ranges = dict([(field, columns["%s_ranges" % field]) for field in STORY_LIST_FIELDS])
+        self.right_end_ids = columns["right_end_id"]
+
+        self.raw_texts = StringColumn.from_columns(columns, "raw_text")
+        self.ids = StringColumn.from_columns(columns, "id")
+        self.extras = StringColumn.from_columns(columns, "extra")
+
+        # lowercase vocabularies, built on first use
+        self._vocabs_lowercase = {}
+
+        # positions of the items of this view in the stored dataset. None for all items
+        self._item_idx = None
+
+    def _view(self, item_idx):
+        view = object.__new__(ColumnarStoryDataset)
+        view.__dict__.update(self.__dict__)
+        view._item_idx = item_idx
+        return view
+
+    def _stored_idx(self, idx):
+        if self._item_idx is None:
+            return idx
+        return int(self._item_idx[idx])
+
+    def __len__(self):
+        if self._item_idx is None:
+            return self.meta["items_cnt"]
+        return len(self._item_idx)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            if self._item_idx is None:
+                return self._view(np.arange(self.meta["items_cnt"])[idx])
+            return self._view(self._item_idx[idx])
+
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("ColumnarStoryDataset index out of range")
+
+        return self.get_story(self._stored_idx(idx))
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self.get_story(self._stored_idx(idx))
+
+    def field_sentence_ids(self, idx, field):
+        """
+        :param idx: Item index in this view
+        :param field: sentences, endings or title
+        :return: Sentence ids (positions in the sentence table) of the field or None if the story does not have it
+        """
+        start, end = self.field_ranges[field][self._stored_idx(idx)]
+        if start < 0:
+            return None
+
+        return range(start, end)
+
+    def sentence_ids(self, sent_id, field="tokens"):
+        """
+        :param sent_id: Sentence id (position in the sentence table)
+        :param field: tokens, lemmas or pos
+        :return: Array view with the vocabulary ids of the sentence tokens
+        """
+        return self.token_ids[field][self.sent_token_offsets[sent_id]:self.sent_token_offsets[sent_id + 1]]
+
+    def get_vocab_lowercase(self, vocab_name):
+        """
+        Lowercase vocabulary, computed once per dataset
+        :param vocab_name: tokens, lemmas or pos
+        :return: (list of lowercase values, int32 array mapping the vocabulary ids to lowercase vocabulary ids)
+        """
+        if vocab_name not in self._vocabs_lowercase:
+            vocab_lower = []
+            vocab_lower_to_id = {}
+            lower_ids = np.zeros(len(self.vocabs[vocab_name]), dtype=np.int32)
+            for value_id, value in enumerate(self.vocabs[vocab_name]):
+                value_lower = value.lower()
+                lower_id = vocab_lower_to_id.get(value_lower)
+                if lower_id is None:
+                    lower_id = len(vocab_lower)
+                    vocab_lower_to_id[value_lower] = lower_id
+                    vocab_lower.append(value_lower)
+                lower_ids[value_id] = lower_id
+            self._vocabs_lowercase[vocab_name] = (vocab_lower, lower_ids)
+
+        return self._vocabs_lowercase[vocab_name]
+
+    def _items_sentence_ids(self, fields, max_items=0):
+        """
+        :return: Array with the sentence ids of the fields of the items of this view (items order, then fields order)
+        """
+        items_cnt = len(self) if max_items <= 0 else min(max_items, len(self))
+        if self._item_idx is None:
+            stored_idx = np.arange(items_cnt)
+        else:
+            stored_idx = np.asarray(self._item_idx[:items_cnt])
+
+        # (items_cnt, fields_cnt, 2) -> start, end for each item and field
+        ranges = np.stack([np.asarray(self.field_ranges[field])[stored_idx] for field in fields], axis=1).reshape((-1, 2))
+        ranges = ranges[ranges[:, 0] >= 0]
+
+        return ranges_to_positions(ranges[:, 0], ranges[:, 1])
+
+    def word_frequencies(self, fields, tokens_field="tokens", max_items=0, lowercase=False):
+        """
+        Counts the tokens of the items with np.bincount
+        :param fields: Story fields (sentences, endings, title)
+        :param tokens_field: tokens, lemmas or pos
+        :param max_items: Count only the first max_items items. 0 for all
+        :param lowercase: Count lowercased values
+        :return: List of (value, count) sorted by count, descending
+        """
+        sent_ids = self._items_sentence_ids(fields, max_items)
+        token_positions = ranges_to_positions(np.asarray(self.sent_token_offsets[sent_ids]),
+                                              np.asarray(self.sent_token_offsets[sent_ids + 1]))
+        ids = np.asarray(self.token_ids[tokens_field])[token_positions]
+
+        vocab = self.vocabs[tokens_field]
+        if lowercase:
+            vocab, lower_ids = self.get_vocab_lowercase(tokens_field)
+            ids = lower_ids[ids]
+
+        counts = np.bincount(ids, minlength=len(vocab))
+        word_counts = [(vocab[value_id], int(counts[value_id])) for value_id in np.nonzero(counts)[0]]
+        word_counts.sort(key=lambda x: x[1], reverse=True)
+
+        return word_counts
+
+    def get_vocab_id_map(self, vocab_token_to_id, unknown_token_id=0, tokens_field="tokens", lowercase=True):
+        """
+        Maps the dataset vocabulary to an external vocabulary
+        :param vocab_token_to_id: Dict value -> id
+        :param unknown_token_id: Id for the values that are not in vocab_token_to_id
+        :param tokens_field: tokens, lemmas or pos
+        :param lowercase: Lowercase the values before the lookup
+        :return: int32 array: dataset vocabulary id -> id in vocab_token_to_id
+        """
+        if lowercase:
+            vocab_lower, lower_ids = self.get_vocab_lowercase(tokens_field)
+            lower_id_map = np.array([vocab_token_to_id.get(x, unknown_token_id) for x in vocab_lower], dtype=np.int32)
+            return lower_id_map[lower_ids]
+
+        return np.array([vocab_token_to_id.get(x, unknown_token_id) for x in self.vocabs[tokens_field]], dtype=np.int32)
+
+    def get_sentence(self, sent_id):
+        sent = {}
+        if self.meta["annotated"]:
+            for field, vocab_name in SENTENCE_VOCAB_FIELDS:
+                vocab = self.vocabs[vocab_name]
+                sent[field] = [vocab[x] for x in self.sentence_ids(sent_id, field)]
+
+            char_offsets = self.char_offsets[self.sent_token_offsets[sent_id]:self.sent_token_offsets[sent_id + 1]]
+            if len(char_offsets) == 0 or char_offsets[0][0] >= 0:
+                sent["char_offsets"] = char_offsets.tolist()
+
+        sent["raw_text"] = self.raw_texts[sent_id]
+
+        return sent
+
+    def get_story(self, stored_idx):
+        """
+        Materializes a story dict
+        :param stored_idx: Item position in the stored dataset (not in the view)
+        :return: Story dict
+        """
+        story_item = {}
+        extra = self.extras[stored_idx]
+        if len(extra) > 0:
+            story_item.update(json.loads(extra))
+
+        story_item["id"] = self.ids[stored_idx]
+        for field in STORY_LIST_FIELDS:
+            start, end = self.field_ranges[field][stored_idx]
+            if start >= 0:
+                story_item[field] = [self.get_sentence(sent_id) for sent_id in xrange(start, end)]
+
+        right_end_id = int(self.right_end_ids[stored_idx])
+        if right_end_id >= 0:
+            story_item["right_end_id"] = right_end_id
+
+        return story_item
+
+
+def ranges_to_positions(starts, ends):
+    """
+    Concatenates the ranges [starts[i], ends[i]) without a python loop
+    :return: int64 array with the positions
+    """
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # shift of each position from its index in the result
+    range_shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(total, dtype=np.int64) + range_shifts
+
+
+def iter_stories_token_ids(input_data, vocab_token_to_id, unknown_token_id=0, tokens_field="tokens", lowercase=True):
+    """
+    Converts the story sentences and endings to vocabulary ids.
+    For a ColumnarStoryDataset the lookup is done once per dataset vocabulary entry instead of once per token.
+    :param input_data: ColumnarStoryDataset or list of story dicts
+    :param vocab_token_to_id: Dict value -> id
+    :param unknown_token_id: Id for the values that are not in vocab_token_to_id
+    :param tokens_field: tokens, lemmas or pos
+    :param lowercase: Lowercase the values before the lookup
+    :return: Generator of (story id, list of sentence id lists, list of ending id lists, right_end_id)
+    """
+    if isinstance(input_data, ColumnarStoryDataset):
+        id_map = input_data.get_vocab_id_map(vocab_token_to_id, unknown_token_id, tokens_field, lowercase)
+        token_ids = input_data.token_ids[tokens_field]
+        offsets = input_data.sent_token_offsets
+
+        def sents_ids(sent_ids):
+            return [id_map[token_ids[offsets[x]:offsets[x + 1]]].tolist() for x in sent_ids]
+
+        for idx in xrange(len(input_data)):
+            stored_idx = input_data._stored_idx(idx)
+            sentences_range = input_data.field_ranges["sentences"][stored_idx]
+            endings_range = input_data.field_ranges["endings"][stored_idx]
+            yield (input_data.ids[stored_idx],
+                   sents_ids(xrange(sentences_range[0], sentences_range[1])),
+                   sents_ids(xrange(endings_range[0], endings_range[1])),
+                   int(input_data.right_end_ids[stored_idx]))
+    else:
+        def sents_ids(sents):
+            return [[vocab_token_to_id.get(x, unknown_token_id) for x in
+                     (sent[tokens_field] if not lowercase else [y.lower() for y in sent[tokens_field]])]
+                    for sent in sents]
+
+        for data_item in input_data:
+            yield data_item["id"], sents_ids(data_item["sentences"]), sents_ids(data_item["endings"]), data_item["right_end_id"]
+
+
+def build_columnar_dataset(data):
+    """
+    Interns the tokens, lemmas and pos of story dicts into integer vocabularies (in memory, no files)
+    :param data: Iterable of story dicts
+    :return: ColumnarStoryDataset
+    """
+    writer = ColumnarStoryDatasetWriter(None)
+    for story_item in data:
+        writer.append(story_item)
+
+    return writer.to_dataset()
+
+
+def save_columnar_dataset(data, dataset_dir):
+    """
+    Writes story dicts to a columnar dataset
+    :param data: Iterable of story dicts
+    :param dataset_dir: Output directory
+    :return: Number of items written
+    """
+    writer = ColumnarStoryDatasetWriter(dataset_dir)
+    for story_item in data:
+        writer.append(story_item)
+    writer.close()
+
+    return writer.items_cnt
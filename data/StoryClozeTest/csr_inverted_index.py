@@ -0,0 +1,183 @@
+import json
+import os
+from array import array
+
+import numpy as np
+
+from data.StoryClozeTest.columnar_dataset import load_array, ranges_to_positions
+from utils.json_helpers import remove_meta_file, save_meta_file
+
+CSR_INDEX_META_FILE = "meta.json"
+
+
+class CSRInvertedIndex(object):
+    """
+    Inverted index feature -> documents with the posting lists stored in CSR format:
+    the documents of feature f are indices[indptr[f]:indptr[f + 1]] (sorted, unique).
+    Features are added with add_features and the arrays are built on the first query.
+    Documents are ranked by the number of distinct query features they have, with vectorized counting.
+    Usage:
+        index = CSRInvertedIndex()
+        index.add_features(doc_id, ["lp_john_nnp", "l_john"])
+        ...
+        similar_docs = index.rank_similar_sentences(sentence, include_features_fn, top_k=500)
+        index.save("resources/search_index")
+        index, meta = CSRInvertedIndex.load("resources/search_index")  # memory mapped arrays
+    """
+
+    def __init__(self):
+        self.feature_to_id = {}
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+
+        # (feature id, doc id) pairs added since the last build
+        self._pending_features = array('i')
+        self._pending_docs = array('i')
+
+    def __len__(self):
+        return len(self.feature_to_id)
+
+    def __contains__(self, feat):
+        return feat in self.feature_to_id
+
+    def add_features(self, doc_id, features):
+        for feat in features:
+            feat_id = self.feature_to_id.get(feat)
+            if feat_id is None:
+                feat_id = len(self.feature_to_id)
+                self.feature_to_id[feat] = feat_id
+            self._pending_features.append(feat_id)
+            self._pending_docs.append(doc_id)
+
+    def build(self):
+        """
+        Merges the added features into the CSR arrays
+        """
+        if len(self._pending_features) == 0 and len(self.indptr) == len(self.feature_to_id) + 1:
+            return
+
+        # existing postings as pairs + new pairs
+        feats_cnt = len(self.feature_to_id)
+        old_feature_ids = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int64), np.diff(self.indptr))
+        feature_ids = np.concatenate([old_feature_ids, np.frombuffer(self._pending_features, dtype=np.int32)])
+        doc_ids = np.concatenate([self.indices, np.frombuffer(self._pending_docs, dtype=np.int32)])
+
+        # sort by feature, then doc and drop the duplicate pairs
+        pairs = np.unique(feature_ids.astype(np.int64) * (2 ** 32) + doc_ids.astype(np.int64))
+        feature_ids = pairs // (2 ** 32)
+        self.indices = (pairs % (2 ** 32)).astype(np.int32)
+        self.indptr = np.zeros(feats_cnt + 1, dtype=np.int64)
+        np.cumsum(np.bincount(feature_ids, minlength=feats_cnt), out=self.indptr[1:])
+
+        self._pending_features = array('i')
+        self._pending_docs = array('i')
+
+    @staticmethod
+    def exists(index_dir):
+        return os.path.exists(os.path.join(index_dir, CSR_INDEX_META_FILE))
+
+    def save(self, index_dir, meta=None):
+        """
+        Saves the index to index_dir: indptr.npy, indices.npy, features.json (features in id order) and meta.json
+        :param index_dir: Output directory
+        :param meta: Dict saved in meta.json, ex. what the index is built from
+        """
+        self.build()
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+        # an index saved before in index_dir is not valid while its files are overwritten
+        remove_meta_file(os.path.join(index_dir, CSR_INDEX_META_FILE))
+
+        features = [None] * len(self.feature_to_id)
+        for feat, feat_id in self.feature_to_id.iteritems():
+            features[feat_id] = feat
+
+        np.save(os.path.join(index_dir, "indptr.npy"), self.indptr)
+        np.save(os.path.join(index_dir, "indices.npy"), self.indices)
+        with open(os.path.join(index_dir, "features.json"), mode="wb") as features_file:
+            json.dump(features, features_file)
+
+        # meta is written last so a partially saved index is not loaded
+        save_meta_file(os.path.join(index_dir, CSR_INDEX_META_FILE), meta if meta is not None else {})
+
+    @staticmethod
+    def load(index_dir, mmap_mode="r"):
+        """
+        Loads an index saved with save()
+        :param index_dir: Index directory
+        :param mmap_mode: np.load mmap_mode for the posting arrays. None to read them in memory
+        :return: (CSRInvertedIndex, meta dict)
+        """
+        with open(os.path.join(index_dir, CSR_INDEX_META_FILE), mode="rb") as meta_file:
+            meta = json.load(meta_file)
+
+        with open(os.path.join(index_dir, "features.json"), mode="rb") as features_file:
+            features = json.load(features_file)
+
+        index = CSRInvertedIndex()
+        index.feature_to_id = dict([(feat, feat_id) for feat_id, feat in enumerate(features)])
+        index.indptr = load_array(os.path.join(index_dir, "indptr.npy"), mmap_mode)
+        index.indices = load_array(os.path.join(index_dir, "indices.npy"), mmap_mode)
+
+        return index, meta
+
+    def get_postings(self, feat):
+        """
+        :return: Sorted array with the documents that have the feature
+        """
+        self.build()
+        feat_id = self.feature_to_id.get(feat)
+        if feat_id is None:
+            return self.indices[:0]
+
+        return self.indices[self.indptr[feat_id]:self.indptr[feat_id + 1]]
+
+    def rank_docs(self, feats, top_k=0):
+        """
+        Ranks the documents by the number of the features they have
+        :param feats: Query features (duplicates are counted once)
+        :param top_k: Return only the top_k documents. 0 for all
+        :return: List of (doc id, matched features count) sorted by count desc, then doc id asc
+        """
+        self.build()
+        feat_ids = np.unique(np.array([self.feature_to_id[x] for x in set(feats) if x in self.feature_to_id],
+                                      dtype=np.int64))
+        if len(feat_ids) == 0:
+            return []
+
+        postings = self.indices[ranges_to_positions(self.indptr[feat_ids], self.indptr[feat_ids + 1])]
+        docs, counts = np.unique(postings, return_counts=True)
+
+        if 0 < top_k < len(docs):
+            # the k-th largest count and everything above it
+            kth_count = counts[np.argpartition(-counts, top_k - 1)[top_k - 1]]
+            selected = counts >= kth_count
+            docs = docs[selected]
+            counts = counts[selected]
+
+        # docs are sorted, a stable sort by count keeps the doc id order for equal counts
+        order = np.argsort(-counts, kind="mergesort")
+        if top_k > 0:
+            order = order[:top_k]
+
+        return zip(docs[order].tolist(), counts[order].tolist())
+
+    def rank_similar_sentences(self, ending_item, include_features_fn, top_k=0):
+        """
+        Ranks the documents by the number of distinct query features of the sentence
+        :param ending_item: Parsed sentence (tokens, lemmas, pos)
+        :param include_features_fn: Function (token, lemma, pos, pos_2) -> list of query features
+        :param top_k: Return only the top_k documents. 0 for all
+        :return: List of (doc id, matched features count), see rank_docs
+        """
+        feats = []
+        for i in range(len(ending_item["tokens"])):
+            token = ending_item["tokens"][i].lower()
+            lemma = ending_item["lemmas"][i].lower()
+            pos = ending_item["pos"][i].lower()
+            pos_2 = pos[:min(2, len(pos))]
+
+            feats.extend(include_features_fn(token, lemma, pos, pos_2))
+
+        return self.rank_docs(feats, top_k=top_k)
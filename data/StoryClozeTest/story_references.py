@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+
+from data.StoryClozeTest.columnar_dataset import ColumnarStoryDataset
+
+STORY_REFS_META_KEY = "story_refs_meta"
+STORY_REFS_FORMAT_VERSION = 1
+
+# keys of a reference record that are replaced by the resolved fields
+STORY_REF_KEYS = set(["id", "story_id", "story_sentences", "endings", "right_end_id"])
+
+
+def make_story_ref(item_id, story_id, endings, right_end_id, story_sentences=4, **extra):
+    """
+    Creates a reference record for a generated item. The record holds ids instead of copies of the sentences.
+    :param item_id: Id of the generated item
+    :param story_id: Id of the story that gives the first story_sentences sentences
+    :param endings: List of (source story id, field, sentence position) for the endings,
+     ex. [("st1", "endings", 0), ("st2", "sentences", 4)]
+    :param right_end_id: Position of the right ending in endings
+    :param story_sentences: Number of story sentences
+    :param extra: Other fields copied to the item (gold, gold_story_id...)
+    :return: Reference record (dict)
+    """
+    story_ref = dict(extra)
+    story_ref["id"] = item_id
+    story_ref["story_id"] = story_id
+    story_ref["story_sentences"] = story_sentences
+    story_ref["endings"] = [list(x) for x in endings]
+    story_ref["right_end_id"] = right_end_id
+
+    return story_ref
+
+
+def make_story_refs_header(source_files):
+    """
+    First line of a reference records file: the datasets the records point to
+    :param source_files: Files with the source stories, in the order they are concatenated
+    """
+    return {STORY_REFS_META_KEY: {"format_version": STORY_REFS_FORMAT_VERSION,
+                                  "source_files": source_files}}
+
+
+def read_story_refs_header(refs_file):
+    """
+    :return: Header meta dict or None if the file is not a reference records file
+    """
+    with open(refs_file, mode="rb") as data_file:
+        first_line = data_file.readline()
+
+    if not first_line.startswith("{") or STORY_REFS_META_KEY not in first_line:
+        return None
+
+    return json.loads(first_line).get(STORY_REFS_META_KEY)
+
+
+def is_story_refs_file(path):
+    return path.endswith(".jsonl") and os.path.isfile(path) and read_story_refs_header(path) is not None
+
+
+class StoryReferenceResolver(object):
+    """
+    Materializes reference records as story items.
+    The sentence dicts of the materialized items are the sentence dicts of the source data (not copies).
+    """
+
+    def __init__(self, source_data):
+        """
+        :param source_data: List-like of source story dicts (list or ColumnarStoryDataset)
+        """
+        self.source_data = source_data
+        self._id_to_idx = {}
+        for idx, story_id in enumerate(self._iter_ids(source_data)):
+            if story_id in self._id_to_idx:
+                logging.warning("StoryReferenceResolver: duplicate story id %s, the first story is used" % story_id)
+                continue
+            self._id_to_idx[story_id] = idx
+
+        # the last resolved story, generated items of the same story come one after another
+        self._last_story = (None, None)
+
+    @staticmethod
+    def _iter_ids(source_data):
+        if isinstance(source_data, ColumnarStoryDataset):
+            # read only the ids column
+            for idx in xrange(len(source_data)):
+                yield source_data.ids[source_data._stored_idx(idx)]
+        else:
+            for story_item in source_data:
+                yield story_item["id"]
+
+    def get_story(self, story_id):
+        if self._last_story[0] != story_id:
+            self._last_story = (story_id, self.source_data[self._id_to_idx[story_id]])
+
+        return self._last_story[1]
+
+    def resolve(self, story_ref):
+        item = dict([(k, v) for k, v in story_ref.iteritems() if k not in STORY_REF_KEYS])
+        item["id"] = story_ref["id"]
+        item["sentences"] = self.get_story(story_ref["story_id"])["sentences"][:story_ref["story_sentences"]]
+        item["endings"] = [self.get_story(source_id)[field][sent_pos]
+                           for source_id, field, sent_pos in story_ref["endings"]]
+        item["right_end_id"] = story_ref["right_end_id"]
+
+        return item
+
+
+class StoryReferenceDataset(object):
+    """
+    List of generated items stored as reference records (see make_story_ref).
+    Items are materialized from the source stories on access.
+    Usage:
+        data = StoryReferenceDataset.load("generated.refs.jsonl", load_source_fn=DataUtilities_ROCStories.load_datasets)
+        for story_item in data[:1000]:
+            ...
+    """
+
+    def __init__(self, story_refs, source_data):
+        """
+        :param story_refs: List of reference records
+        :param source_data: List-like of the source stories
+        """
+        self.story_refs = story_refs
+        self.resolver = StoryReferenceResolver(source_data)
+
+    @staticmethod
+    def load(refs_file, load_source_fn):
+        """
+        :param refs_file: Reference records file (.jsonl with a header line)
+        :param load_source_fn: Function that loads and concatenates a list of data files
+        :return: StoryReferenceDataset
+        """
+        header = read_story_refs_header(refs_file)
+        if header["format_version"] != STORY_REFS_FORMAT_VERSION:
+            raise Exception("Story references format version %s is not supported (expected %s)" % (
+                header["format_version"], STORY_REFS_FORMAT_VERSION))
+
+        source_files = []
+        for source_file in header["source_files"]:
+            if not os.path.exists(source_file):
+                # paths relative to the references file
+                source_file = os.path.join(os.path.dirname(refs_file), os.path.basename(source_file))
+            source_files.append(source_file)
+
+        story_refs = []
+        with open(refs_file, mode="rb") as data_file:
+            data_file.readline()
+            for line in data_file:
+                if len(line.strip()) > 0:
+                    story_refs.append(json.loads(line))
+
+        return StoryReferenceDataset(story_refs, load_source_fn(source_files))
+
+    def __len__(self):
+        return len(self.story_refs)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            view = object.__new__(StoryReferenceDataset)
+            view.story_refs = self.story_refs[idx]
+            view.resolver = self.resolver
+            return view
+
+        return self.resolver.resolve(self.story_refs[idx])
+
+    def __iter__(self):
+        for story_ref in self.story_refs:
+            yield self.resolver.resolve(story_ref)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+
+
+class CoreNLPAnnotationCache(object):
+    """
+    Persistent cache with CoreNLP parses of single texts (sentences, endings, titles).
+    Entries are keyed by (sha1 of the raw text, parse_mode) and stored in a sqlite file.
+    When the cache grows over max_entries the least recently used entries are evicted.
+    Usage:
+        cache = CoreNLPAnnotationCache("resources/corenlp_cache.sqlite", parse_mode="pos")
+        parsed_sentence = cache.get(raw_text)
+        if parsed_sentence is None:
+            parsed_sentence = parser.parse_doc(raw_text)["sentences"][0]
+            cache.put(raw_text, parsed_sentence)
+        ...
+        cache.close()
+    """
+
+    def __init__(self, cache_file, parse_mode, max_entries=10000000, evict_fraction=0.1, commit_every=1000):
+        """
+        :param cache_file: sqlite file. Created if it does not exist
+        :param parse_mode: CoreNLP parse mode (pos, parse, ner..). Parses from different modes do not mix.
+        :param max_entries: Max number of entries (for all parse modes). 0 for no limit
+        :param evict_fraction: Fraction of the entries evicted when max_entries is exceeded
+        :param commit_every: Commit after this number of writes
+        """
+        self._cache_file = cache_file
+        self._parse_mode = parse_mode
+        self._max_entries = max_entries
+        self._evict_fraction = evict_fraction
+        self._commit_every = commit_every
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        # the cache is shared by the CoreNLPParserPool worker threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS annotations ("
+                           "text_hash TEXT NOT NULL, "
+                           "parse_mode TEXT NOT NULL, "
+                           "annotation TEXT NOT NULL, "
+                           "last_access INTEGER NOT NULL, "
+                           "PRIMARY KEY (text_hash, parse_mode))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS annotations_last_access ON annotations (last_access)")
+        self._conn.commit()
+
+        self._entries_cnt, max_access = self._conn.execute(
+            "SELECT COUNT(*), MAX(last_access) FROM annotations").fetchone()
+        self._access_tick = max_access if max_access is not None else 0
+        self._uncommitted = 0
+
+        logging.info("CoreNLPAnnotationCache: %s entries in %s" % (self._entries_cnt, cache_file))
+
+    @staticmethod
+    def text_hash(raw_text):
+        if isinstance(raw_text, unicode):
+            raw_text = raw_text.encode("utf-8")
+        return hashlib.sha1(raw_text).hexdigest()
+
+    def _next_tick(self):
+        self._access_tick += 1
+        return self._access_tick
+
+    def _write_done(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self._commit_every:
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def get(self, raw_text):
+        """
+        :param raw_text: Raw text
+        :return: Parsed sentence (dict) or None if the text is not in the cache
+        """
+        text_hash = self.text_hash(raw_text)
+        with self._lock:
+            row = self._conn.execute("SELECT annotation FROM annotations WHERE text_hash=? AND parse_mode=?",
+                                     (text_hash, self._parse_mode)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute("UPDATE annotations SET last_access=? WHERE text_hash=? AND parse_mode=?",
+                               (self._next_tick(), text_hash, self._parse_mode))
+            self._write_done()
+
+        return json.loads(row[0])
+
+    def put(self, raw_text, parsed_sentence):
+        """
+        :param raw_text: Raw text
+        :param parsed_sentence: Parsed sentence (dict) for the text
+        """
+        text_hash = self.text_hash(raw_text)
+        annotation = json.dumps(parsed_sentence)
+        with self._lock:
+            cursor = self._conn.execute("INSERT OR IGNORE INTO annotations VALUES (?, ?, ?, ?)",
+                                        (text_hash, self._parse_mode, annotation, self._next_tick()))
+            if cursor.rowcount > 0:
+                self._entries_cnt += 1
+            self._write_done()
+
+            if 0 < self._max_entries < self._entries_cnt:
+                self._evict()
+
+    def _evict(self):
+        evict_cnt = max(1, int(self._max_entries * self._evict_fraction))
+        cursor = self._conn.execute("DELETE FROM annotations WHERE rowid IN "
+                                    "(SELECT rowid FROM annotations ORDER BY last_access LIMIT ?)",
+                                    (evict_cnt,))
+        self._conn.commit()
+        self._uncommitted = 0
+
+        self._entries_cnt = self._conn.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+        self.evicted += cursor.rowcount
+        logging.info("CoreNLPAnnotationCache: %s entries evicted, %s left" % (cursor.rowcount, self._entries_cnt))
+
+    def hit_rate(self):
+        requests_cnt = self.hits + self.misses
+        return float(self.hits) / requests_cnt if requests_cnt > 0 else 0.0
+
+    def stats_str(self):
+        return "hits=%s, misses=%s, hit_rate=%.4f, evicted=%s, entries=%s" % (
+            self.hits, self.misses, self.hit_rate(), self.evicted, self._entries_cnt)
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
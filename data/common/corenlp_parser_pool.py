@@ -0,0 +1,206 @@
+import itertools
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+# Separator used to put all texts of a story into one document.
+# CoreNLP splits sentences on two consecutive new lines (ssplit.newlineIsSentenceBreak=two by default)
+# so a text never shares a sentence with its neighbours.
+STORY_TEXTS_SEPARATOR = u"\n\n"
+
+STORY_TEXT_FIELDS = ["sentences", "endings", "title"]
+
+
+def rebase_char_offsets(sentence, offset):
+    """
+    Shifts the token char offsets of a parsed sentence so they are relative to the start of the original text
+    :param sentence: Parsed sentence (dict from CoreNLP parse_doc)
+    :param offset: Offset of the original text in the parsed document
+    :return: The same sentence
+    """
+    if offset != 0 and "char_offsets" in sentence:
+        sentence["char_offsets"] = [[x[0] - offset, x[1] - offset] for x in sentence["char_offsets"]]
+
+    return sentence
+
+
+def parse_texts_as_single_doc(texts, parser):
+    """
+    Parses a list of texts with a single parser call.
+    For each text returns the first sentence that starts inside the text - the same sentence that
+    parser.parse_doc(text)["sentences"][0] returns when the text is parsed alone.
+    :param texts: List of raw texts
+    :param parser: CoreNLP parser
+    :return: List with a parsed sentence (or None if nothing was parsed for the text) for each text
+    """
+    text_starts = []
+    curr_start = 0
+    for text in texts:
+        text_starts.append(curr_start)
+        curr_start += len(text) + len(STORY_TEXTS_SEPARATOR)
+
+    doc_parse = parser.parse_doc(STORY_TEXTS_SEPARATOR.join(texts))
+
+    parsed_sents = [None] * len(texts)
+    text_id = 0
+    for sentence in doc_parse["sentences"]:
+        if len(sentence.get("char_offsets", [])) == 0:
+            continue
+
+        sent_start = sentence["char_offsets"][0][0]
+        while text_id + 1 < len(texts) and sent_start >= text_starts[text_id + 1]:
+            text_id += 1
+
+        if parsed_sents[text_id] is None:
+            parsed_sents[text_id] = rebase_char_offsets(sentence, text_starts[text_id])
+
+    return parsed_sents
+
+
+def parse_story_item(story_item, parser, batch_story=True, cache=None):
+    """
+    Parses the sentences, endings and title of a story.
+    The input item is not modified, the parsed item is a new dict.
+    :param story_item: Story dict with raw_text objects in the text fields
+    :param parser: CoreNLP parser
+    :param batch_story: Parse all texts of the story with a single parser call
+    :param cache: CoreNLPAnnotationCache. Only texts that are not in the cache are sent to the parser
+    :return: Parsed story dict
+    """
+    parsed_item = dict(story_item)
+
+    fields = [x for x in STORY_TEXT_FIELDS if x in story_item]
+    texts = [sent["raw_text"] for field in fields for sent in story_item[field]]
+
+    parsed_sents = [None] * len(texts)
+    if cache is not None:
+        parsed_sents = [cache.get(x) for x in texts]
+
+    not_parsed_ids = [i for i in range(len(texts)) if parsed_sents[i] is None]
+    if batch_story and len(not_parsed_ids) > 1:
+        batch_parsed_sents = parse_texts_as_single_doc([texts[i] for i in not_parsed_ids], parser)
+        for i, sent_processed in zip(not_parsed_ids, batch_parsed_sents):
+            parsed_sents[i] = sent_processed
+
+    for i in not_parsed_ids:
+        if parsed_sents[i] is None:
+            # parse the text alone
+            parsed_sents[i] = parser.parse_doc(texts[i])["sentences"][0]
+
+        if cache is not None:
+            cache.put(texts[i], parsed_sents[i])
+
+    text_id = 0
+    for list_field in fields:
+        parsed_item[list_field] = []
+        for sent in story_item[list_field]:
+            sent_processed = parsed_sents[text_id]
+            sent_processed["raw_text"] = sent["raw_text"]
+            parsed_item[list_field].append(sent_processed)
+            text_id += 1
+
+    return parsed_item
+
+
+def close_parser(parser):
+    """
+    Stops the java process of a CoreNLP parser.
+    stanford_corenlp_pywrapper parsers are stopped with kill_proc_if_running(), other parsers with close() if they have it
+    """
+    if hasattr(parser, "kill_proc_if_running"):
+        parser.kill_proc_if_running()
+    elif hasattr(parser, "close"):
+        parser.close()
+
+
+class CoreNLPParserPool(object):
+    """
+    Parses stories with a pool of CoreNLP parsers.
+    Each worker thread owns a parser created by parser_factory (each CoreNLP parser runs its own java process,
+    so the threads only wait on the pipes). Parsed stories are returned in the input order.
+    Usage:
+        pool = CoreNLPParserPool(lambda: CoreNLP("pos", corenlp_jars=jars), num_workers=4)
+        for parsed_story in pool.imap_parse(stories):
+            ...
+        pool.close()
+    """
+
+    def __init__(self, parser_factory, num_workers=1, batch_story=True, chunk_size=1, cache=None):
+        """
+        :param parser_factory: Function without arguments that creates a parser with parse_doc(text) method
+        :param num_workers: Number of parsers working in parallel
+        :param batch_story: Parse all texts of the story with a single parser call
+        :param chunk_size: Number of stories sent to a worker at once
+        :param cache: CoreNLPAnnotationCache shared by the workers
+        """
+        self._parser_factory = parser_factory
+        self._cache = cache
+        self._num_workers = max(1, num_workers)
+        self._batch_story = batch_story
+        self._chunk_size = max(1, chunk_size)
+
+        self._local = threading.local()
+        # all parsers created by the workers, stopped in close()
+        self._parsers = []
+        self._parsers_lock = threading.Lock()
+        self._pool = None
+        if self._num_workers > 1:
+            self._pool = ThreadPool(processes=self._num_workers)
+
+        logging.info("CoreNLPParserPool: num_workers=%s, batch_story=%s" % (self._num_workers, self._batch_story))
+
+    def _get_parser(self):
+        parser = getattr(self._local, "parser", None)
+        if parser is None:
+            parser = self._parser_factory()
+            self._local.parser = parser
+            with self._parsers_lock:
+                self._parsers.append(parser)
+
+        return parser
+
+    def parse_story(self, story_item):
+        return parse_story_item(story_item, self._get_parser(), batch_story=self._batch_story, cache=self._cache)
+
+    def imap_parse(self, data):
+        """
+        Parses stories in parallel
+        :param data: Iterable of story dicts
+        :return: Generator of parsed story dicts in the order of data
+        """
+        if self._pool is None:
+            for story_item in data:
+                yield self.parse_story(story_item)
+        else:
+            # the pool reads its whole input at once so it is fed with bounded windows of stories
+            window_size = self._num_workers * self._chunk_size * 8
+            data_iter = iter(data)
+            while True:
+                window = list(itertools.islice(data_iter, window_size))
+                if len(window) == 0:
+                    break
+
+                for parsed_item in self._pool.imap(self.parse_story, window, self._chunk_size):
+                    yield parsed_item
+
+    def close(self):
+        """
+        Stops the worker threads and the java processes of all parsers created by the pool
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+        with self._parsers_lock:
+            parsers = self._parsers
+            self._parsers = []
+
+        for parser in parsers:
+            close_parser(parser)
+
+        # the closed parsers are not reused by the threads
+        self._local = threading.local()
+
+        if len(parsers) > 0:
+            logging.info("CoreNLPParserPool: %s parsers closed" % len(parsers))
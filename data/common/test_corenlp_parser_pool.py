@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import re
+import unittest
+
+from data.common.corenlp_parser_pool import CoreNLPParserPool, parse_story_item
+
+
+class StubParser(object):
+    """
+    Parser with the parse_doc output format of CoreNLP.
+    Tokens are words and punctuation marks. A sentence ends after . ! ? or at two consecutive new lines.
+    A document without tokens is parsed to a single empty sentence.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.closed = False
+
+    def parse_doc(self, text):
+        self.calls += 1
+
+        sentences = []
+        tokens = []
+        for match in re.finditer(ur"\w+|[^\w\s]|\n\n", text, re.UNICODE):
+            if match.group() != u"\n\n":
+                tokens.append((match.group(), [match.start(), match.end()]))
+
+            if len(tokens) > 0 and (match.group() in [u".", u"!", u"?", u"\n\n"]):
+                sentences.append(self._make_sentence(tokens))
+                tokens = []
+
+        if len(tokens) > 0:
+            sentences.append(self._make_sentence(tokens))
+
+        if len(sentences) == 0:
+            sentences.append(self._make_sentence([]))
+
+        return {"sentences": sentences}
+
+    @staticmethod
+    def _make_sentence(tokens):
+        return {"tokens": [x[0] for x in tokens],
+                "lemmas": [x[0].lower() for x in tokens],
+                "pos": [u"NN" for x in tokens],
+                "char_offsets": [x[1] for x in tokens]}
+
+    def close(self):
+        self.closed = True
+
+
+def make_story(sentences, endings, title=None):
+    story_item = {"id": u"story_1",
+                  "sentences": [{"raw_text": x} for x in sentences],
+                  "endings": [{"raw_text": x} for x in endings],
+                  "right_end_id": 0}
+    if title is not None:
+        story_item["title"] = [{"raw_text": title}]
+
+    return story_item
+
+
+TEST_STORIES = [
+    make_story([u"Tom went to the store.", u"He bought milk.", u"It was cold outside.", u"He walked home.",
+                u"His mother was happy."],
+               [u"She made pancakes.", u"She was angry."],
+               title=u"Milk"),
+    # texts that are split into several sentences
+    make_story([u"Anna ran. She fell!", u"Why? Nobody knew.", u"The end came. Then more. And more."],
+               [u"Yes. No.", u"Maybe"]),
+    # non ascii texts
+    make_story([u"Zoë bought a café crème.", u"Élodie said: « Merci ».",
+                u"Straße – naïve résumé."],
+               [u"日本語. Second.", u"Done ✓"]),
+    # empty texts
+    make_story([u"", u"First text.", u"", u"Last text. Again."],
+               [u"", u"An ending."],
+               title=u""),
+]
+
+
+class ParseStoryItemTest(unittest.TestCase):
+
+    def test_batch_story_is_the_same_as_separate_texts(self):
+        for story_item in TEST_STORIES:
+            parsed_separate = parse_story_item(story_item, StubParser(), batch_story=False)
+
+            parser = StubParser()
+            parsed_batch = parse_story_item(story_item, parser, batch_story=True)
+
+            self.assertEqual(parsed_separate, parsed_batch)
+
+    def test_batch_story_parses_the_texts_in_one_call(self):
+        parser = StubParser()
+        parse_story_item(TEST_STORIES[0], parser, batch_story=True)
+
+        self.assertEqual(1, parser.calls)
+
+    def test_first_sentence_of_the_text(self):
+        parsed_item = parse_story_item(TEST_STORIES[1], StubParser(), batch_story=True)
+
+        self.assertEqual([u"Anna", u"ran", u"."], parsed_item["sentences"][0]["tokens"])
+        self.assertEqual([[0, 4], [5, 8], [8, 9]], parsed_item["sentences"][0]["char_offsets"])
+        self.assertEqual(u"Why? Nobody knew.", parsed_item["sentences"][1]["raw_text"])
+        self.assertEqual([u"Why", u"?"], parsed_item["sentences"][1]["tokens"])
+
+    def test_input_item_is_not_modified(self):
+        story_item = make_story([u"One text."], [u"Two texts."])
+        parse_story_item(story_item, StubParser(), batch_story=True)
+
+        self.assertEqual(make_story([u"One text."], [u"Two texts."]), story_item)
+
+
+class CoreNLPParserPoolTest(unittest.TestCase):
+
+    def test_pool_is_the_same_as_single_parser(self):
+        expected = [parse_story_item(x, StubParser(), batch_story=False) for x in TEST_STORIES]
+
+        pool = CoreNLPParserPool(StubParser, num_workers=3, batch_story=True)
+        parsed = list(pool.imap_parse(TEST_STORIES * 5))
+        pool.close()
+
+        self.assertEqual(expected * 5, parsed)
+
+    def test_close_stops_all_parsers(self):
+        parsers = []
+
+        def parser_factory():
+            parsers.append(StubParser())
+            return parsers[-1]
+
+        pool = CoreNLPParserPool(parser_factory, num_workers=3, batch_story=True)
+        list(pool.imap_parse(TEST_STORIES * 10))
+        pool.close()
+
+        self.assertTrue(len(parsers) > 0)
+        self.assertTrue(all([x.closed for x in parsers]))
+
+
+if __name__ == '__main__':
+    unittest.main()
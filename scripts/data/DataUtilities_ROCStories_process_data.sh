@@ -12,29 +12,30 @@ parse_mode="pos"  # "pos", "parse"
 parse_mode="parse"  # "pos", "parse"
 parse_mode="coref"  # "pos", "parse"
 parse_mode="ner"  # "pos", "parse"
+parse_workers=4  # number of parallel CoreNLP parsers, 0 - single parser, sentence by sentence
 command=convert_to_json_with_parse
 
 input_type=with_ending_choice  #raw_stories
 input_files="resources/roc_stories_data/cloze_test_val__spring2016-cloze_test_ALL_val.tsv"
 output_file="resources/roc_stories_data/processed_${parse_mode}_cloze_test_val__spring2016-cloze_test_ALL_val.tsv.json"
-python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -coreNlpPath:${coreNlpPath} -parse_mode:${parse_mode}
+python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -coreNlpPath:${coreNlpPath} -parse_mode:${parse_mode} -parse_workers:${parse_workers}
 
 input_type=with_ending_choice  #raw_stories
 input_files="resources/roc_stories_data/cloze_test_test__spring2016-cloze_test_ALL_test.tsv"
 output_file="resources/roc_stories_data/processed_${parse_mode}_cloze_test_test__spring2016-cloze_test_ALL_test.tsv.json"
-python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -coreNlpPath:${coreNlpPath} -parse_mode:${parse_mode}
+python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -coreNlpPath:${coreNlpPath} -parse_mode:${parse_mode} -parse_workers:${parse_workers}
 
 # 2017  release
 input_type=raw_stories   #with_ending_choice, raw_stories
 input_files="resources/roc_stories_data/ROCStories_winter2017_ROCStories_winter2017.tsv"
 output_file="resources/roc_stories_data/processed_${parse_mode}_ROCStories_winter2017_ROCStories_winter2017.json"
-python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -coreNlpPath:${coreNlpPath} -parse_mode:${parse_mode}
+python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -coreNlpPath:${coreNlpPath} -parse_mode:${parse_mode} -parse_workers:${parse_workers}
 
 # 2016 naacl release
 input_type=raw_stories   #with_ending_choice, raw_stories
 input_files="resources/roc_stories_data/ROCStories__spring2016-ROC-Stories-naacl-camera-ready.tsv"
 output_file="resources/roc_stories_data/processed_${parse_mode}_ROCStories__spring2016-ROC-Stories-naacl-camera-ready.tsv.json"
-python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -coreNlpPath:${coreNlpPath} -parse_mode:${parse_mode}
+python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -coreNlpPath:${coreNlpPath} -parse_mode:${parse_mode} -parse_workers:${parse_workers}
 
 
 ################################################
@@ -98,8 +99,16 @@ random_number=10
 run_name=${command}_${random_number}_$(date +%y-%m-%d-%H-%M-%S)
 output_file="resources/roc_stories_data/generated_proc_pos_ROCStories_ROC-16-17-${run_name}.json"
 
+search_index_dir=resources/roc_stories_data/search_index_proc_pos_ROCStories_ROC-16-17  # built on the first run, reused after that
+gen_workers=0  # N>0: sharded generation in N processes (same output for any N>0, differs from gen_workers=0)
+
 log_file=gen_${run_name}_roc1617.log
-python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -coreNlpPath:${coreNlpPath} -parse_mode:${parse_mode} -random_number:${random_number} > ${log_file}
+python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -coreNlpPath:${coreNlpPath} -parse_mode:${parse_mode} -random_number:${random_number} -search_index_dir:${search_index_dir} -gen_workers:${gen_workers} > ${log_file}
+
+# Hard negatives by embeddings: nearest fifth sentences by average word vectors (index saved in search_index_dir)
+# command=mutate_rocstories_data_emb_nn
+# emb_model_file=resources/word2vec/GoogleNews-vectors-negative300.bin
+# python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -random_number:${random_number} -search_index_dir:${search_index_dir} -emb_model_file:${emb_model_file} -emb_model_bin:True -ann_probe:8 > ${log_file}
 
 
 # Mutate data
@@ -118,3 +127,11 @@ run_name=${command}_${random_number}_$(date +%y-%m-%d-%H-%M-%S)
 output_file="resources/roc_stories_data/processed_pos_cloze_test_val__spring2016-cloze_test_ALL_val.tsv.json"
 
 python DataUtilities_ROCStories.py -input_type:${input_type} -cmd:${command} -input_files:${input_files} -output_file:${output_file} -coreNlpPath:${coreNlpPath} -parse_mode:${parse_mode}
+
+# Convert processed json data to the columnar format (memory mapped by the trainers)
+command=convert_to_columnar
+
+input_files="resources/roc_stories_data/processed_pos_cloze_test_val__spring2016-cloze_test_ALL_val.tsv.json"
+output_file="resources/roc_stories_data/processed_pos_cloze_test_val__spring2016-cloze_test_ALL_val.tsv.columnar"
+
+python DataUtilities_ROCStories.py -cmd:${command} -input_files:${input_files} -output_file:${output_file}
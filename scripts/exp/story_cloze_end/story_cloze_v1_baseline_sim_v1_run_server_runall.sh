@@ -155,6 +155,7 @@ for ((pc_i=0;pc_i<1;pc_i++)); do
             emb_model_file=${loop_emb_file}
             word2vec_load_bin=${loop_emb_binary} # True for google news w2v
             word2vec_load_format=True # True for word23vec.load_word2vec_format
+            emb_mmap_dir=${resources_dir}/mmap_embeddings # converted once, memory mapped by all runs
             load_features=False
 
             lower_tokens=True
@@ -212,7 +213,7 @@ for ((pc_i=0;pc_i<1;pc_i++)); do
             print "Saving log to ${log_file}"
 
 
-            venv/bin/python story_cloze_v1_features_and_similarities.py --cmd ${cmd} --input_data_train ${input_data_train} --input_data_eval ${input_data_eval} --output_file ${output_file} --model_file ${model_file} --scale_file ${scale_file} --scale_features ${scale_features} --emb_model_type ${emb_model_type} --emb_model_file ${emb_model_file} --word2vec_load_bin ${word2vec_load_bin} --output_dir ${output_dir} --run_name ${run_name} --max_records ${max_records} --tune ${tune} --submission_data_eval ${submission_data_eval} --load_features ${load_features}  --word2vec_load_format ${word2vec_load_format}  --lower_tokens ${lower_tokens}  --remove_stopwords ${remove_stopwords}  --inc_embedd_vectors ${inc_embedd_vectors}  --inc_slast1 ${inc_slast1}  --inc_slast2 ${inc_slast2}  --inc_slast3 ${inc_slast3}  --inc_slast4 ${inc_slast4}  --inc_story ${inc_story}  --inc_maxsim ${inc_maxsim}  --inc_possim ${inc_possim}  --inc_fullsims ${inc_fullsims} --include_elem_multiply ${include_elem_multiply} --param_c ${param_c}> ${log_file}
+            venv/bin/python story_cloze_v1_features_and_similarities.py --cmd ${cmd} --input_data_train ${input_data_train} --input_data_eval ${input_data_eval} --output_file ${output_file} --model_file ${model_file} --scale_file ${scale_file} --scale_features ${scale_features} --emb_model_type ${emb_model_type} --emb_model_file ${emb_model_file} --word2vec_load_bin ${word2vec_load_bin} --output_dir ${output_dir} --run_name ${run_name} --max_records ${max_records} --tune ${tune} --submission_data_eval ${submission_data_eval} --load_features ${load_features}  --word2vec_load_format ${word2vec_load_format}  --lower_tokens ${lower_tokens}  --remove_stopwords ${remove_stopwords}  --inc_embedd_vectors ${inc_embedd_vectors}  --inc_slast1 ${inc_slast1}  --inc_slast2 ${inc_slast2}  --inc_slast3 ${inc_slast3}  --inc_slast4 ${inc_slast4}  --inc_story ${inc_story}  --inc_maxsim ${inc_maxsim}  --inc_possim ${inc_possim}  --inc_fullsims ${inc_fullsims} --include_elem_multiply ${include_elem_multiply} --param_c ${param_c} --emb_mmap_dir ${emb_mmap_dir}> ${log_file}
 
             # exit
             #echo "=========TRAIN========="
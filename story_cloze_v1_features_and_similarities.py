@@ -1,9 +1,11 @@
 
 
 import codecs
+import os
 import sys
 
 import logging  # word2vec logging
+import multiprocessing
 
 import numpy as np
 from sklearn import preprocessing
@@ -21,16 +23,18 @@ from scipy import spatial  # used for similarity calculation
 
 # from sklearn.svm import libsvm
 from utils.embedding_vector_utilities import AverageVectorsUtilities
+from utils.eval_helpers import OnlineConfusionMatrix
+from utils.mmap_embeddings import load_mmap_embeddings, init_normalized_vectors, NORM_MODES, NORM_MODE_MEMORY
 
 import pickle
 
+from utils.feature_matrix_store import FeatureColumnGroups, FeatureMatrixStore, get_feature_matrix_key
+from utils.sentence_feature_cache import SentenceFeatureCache, get_sentences_hash
 from utils.similarity_feature_extraction import Similarity_FeatureExtraction
 
 from data.StoryClozeTest.DataUtilities_ROCStories import DataUtilities_ROCStories
+from data.StoryClozeTest.story_references import is_story_refs_file, read_story_refs_header
 
-from sklearn.metrics.classification import confusion_matrix
-from sklearn.metrics import precision_recall_fscore_support
-from sklearn.metrics import accuracy_score
 from optparse import OptionParser
 
 
@@ -382,6 +386,77 @@ def extract_features_as_vector_from_single_record_v1_jointendings(data_item,
         return features
 
 from nltk.corpus import stopwords
+class FeatureRowWriter(object):
+    """
+    Writes features to a preallocated row with the list methods used by the feature extraction (append, extend, len)
+    """
+
+    def __init__(self, row):
+        self.row = row
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, value):
+        self.row[self.size] = value
+        self.size += 1
+
+    def extend(self, values):
+        values_cnt = len(values)
+        self.row[self.size:self.size + values_cnt] = values
+        self.size += values_cnt
+
+
+def get_segments_features(segments, word2vec_model, word2vec_index2word_set, w2v_num_feats,
+                          lower_tokens, remove_stopwords, stop_words, sentence_cache=None):
+    """
+    Tokens (word, pos), words and average embedding of text segments.
+    The average embeddings of the segments that are not in the cache are computed with a single batched call.
+    :param segments: List of segments, a segment is a list of parsed sentences
+    :param sentence_cache: SentenceFeatureCache or None.
+     Keyed by (sentences hash, embeddings model id, lower_tokens, remove_stopwords)
+    :return: List of (tokens, words, embedding) in the segments order
+    """
+    segments_feats = [None] * len(segments)
+    missing_segments = []
+    for seg_id, sentences in enumerate(segments):
+        cache_key = None
+        if sentence_cache is not None:
+            cache_key = (get_sentences_hash(sentences), id(word2vec_model), lower_tokens, remove_stopwords)
+            segments_feats[seg_id] = sentence_cache.get(cache_key)
+
+        if segments_feats[seg_id] is None:
+            missing_segments.append((seg_id, cache_key))
+
+    if len(missing_segments) == 0:
+        return segments_feats
+
+    missing_tokens = []
+    missing_words = []
+    for seg_id, cache_key in missing_segments:
+        seg_tkns = []
+        seg_pos = []
+        for sentence in segments[seg_id]:
+            seg_tkns.extend(sentence["tokens"])
+            seg_pos.extend(sentence["pos"])
+
+        seg_tokens = zip([x.lower() if lower_tokens else x for x in seg_tkns],
+                         [x.lower() if lower_tokens else x for x in seg_pos])
+        missing_tokens.append(seg_tokens)
+        missing_words.append([x[0] for x in seg_tokens if remove_stopwords and x not in stop_words])
+
+    missing_embeddings = AverageVectorsUtilities.makeFeatureVecs(missing_words, word2vec_model, w2v_num_feats,
+                                                                 word2vec_index2word_set)
+
+    for i, (seg_id, cache_key) in enumerate(missing_segments):
+        segments_feats[seg_id] = (missing_tokens[i], missing_words[i], missing_embeddings[i])
+        if sentence_cache is not None:
+            sentence_cache.put(cache_key, segments_feats[seg_id])
+
+    return segments_feats
+
+
 def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
                                                                word2vec_model,
                                                                word2vec_index2word_set,
@@ -397,7 +472,10 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
                                                                include_maxsim=True,
                                                                include_possim=True,
                                                                include_fullsims=True,
-                                                               include_elem_multiply=True):
+                                                               include_elem_multiply=True,
+                                                               sentence_cache=None,
+                                                               feature_groups=None,
+                                                               out=None):
     ''''
         Sum of all sentences - embeddings
         Last sentence embeddings
@@ -405,9 +483,13 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
         Last sent - Ending 2 similarities
         All sent - Ending 1 similarities
         All sent - Ending 2 similarities
+
+        out - preallocated float32 row with the size of the features. If set the features are written to it
     '''
 
     features = []
+    if out is not None:
+        features = FeatureRowWriter(out)
     sparse_feats_dict = {}
 
     w2v_num_feats = len(word2vec_model.wv.syn0[0] if embeddings_model.wv else embeddings_model.syn0.shape[0])
@@ -417,45 +499,47 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
         stop_words = set(stopwords.words('english'))
 
 
-    # Sentence prev
-    sentprev_tkns = []
-    sentprev_pos = []
-    for sent_id in range(0, len(data_item["sentences"])-1):
-        sentprev_tkns.extend(data_item["sentences"][sent_id]["tokens"])
-        sentprev_pos.extend(data_item["sentences"][sent_id]["pos"])
-
-    sentprev_tokens = zip([x.lower() if lower_tokens else x for x in sentprev_tkns],
-                          [x.lower() if lower_tokens else x for x in sentprev_pos])
-
-    sentprev_words = [x[0] for x in sentprev_tokens if remove_stopwords and x not in stop_words]
+    # segments of the item: (name, parsed sentences)
+    segments = [("sentprev", data_item["sentences"][:len(data_item["sentences"])-1]),
+                ("end0", [data_item["endings"][0]]),
+                ("end1", [data_item["endings"][1]])]
+    if include_sentlast:
+        segments.append(("sentlast", [data_item["sentences"][-1]]))
+    if include_sentlast2:
+        segments.append(("sentlast2", [data_item["sentences"][-2]]))
+    if include_sentlast3:
+        segments.append(("sentlast3", [data_item["sentences"][-3]]))
+    if include_sentlast4:
+        segments.append(("sentlast4", [data_item["sentences"][-4]]))
 
-    # print 'arg1: %s' % sentprev_words
-    sentprev_embedding = AverageVectorsUtilities.makeFeatureVec(sentprev_words, word2vec_model, w2v_num_feats,
-                                                                    word2vec_index2word_set)
+    # tokens, words and average vectors of all segments. The story sentences are the same in all items of a story
+    segments_feats = get_segments_features([x[1] for x in segments], word2vec_model, word2vec_index2word_set,
+                                           w2v_num_feats, lower_tokens, remove_stopwords, stop_words,
+                                           sentence_cache=sentence_cache)
+    segments_feats = dict(zip([x[0] for x in segments], segments_feats))
 
-    # FEATURE EXTRACTION HERE
-    # doc_id = data_item['id']
-    # print doc_id
+    sentprev_tokens, sentprev_words, sentprev_embedding = segments_feats["sentprev"]
+    end0_tokens, end0_words, end0_embedding = segments_feats["end0"]
+    end1_tokens, end1_words, end1_embedding = segments_feats["end1"]
+    if include_sentlast:
+        sentlast_tokens, sentlast_words, sentlast_embedding = segments_feats["sentlast"]
+    if include_sentlast2:
+        sentlast2_tokens, sentlast2_words, sentlast2_embedding = segments_feats["sentlast2"]
+    if include_sentlast3:
+        sentlast3_tokens, sentlast3_words, sentlast3_embedding = segments_feats["sentlast3"]
+    if include_sentlast4:
+        sentlast4_tokens, sentlast4_words, sentlast4_embedding = segments_feats["sentlast4"]
 
-    # Ending 0
-    end0_tokens = zip([x.lower() if lower_tokens else x for x in data_item["endings"][0]["tokens"]],
-                      [x.lower() if lower_tokens else x for x in data_item["endings"][0]["pos"]])
-    end0_words = [x[0] for x in end0_tokens if remove_stopwords and x not in stop_words]
-    # print 'arg2: %s' % end0_words
-    end0_embedding = AverageVectorsUtilities.makeFeatureVec(end0_words, word2vec_model, w2v_num_feats,
-                                                            word2vec_index2word_set)
+    def add_feature_group(name, required_flags, start):
+        # the columns from start to the current end of the features
+        if feature_groups is not None:
+            feature_groups.add(name, required_flags, start, len(features))
 
-    # Ending 1
-    end1_tokens = zip([x.lower() if lower_tokens else x for x in data_item["endings"][1]["tokens"]],
-                      [x.lower() if lower_tokens else x for x in data_item["endings"][1]["pos"]])
-    end1_words = [x[0] for x in end1_tokens if remove_stopwords and x not in stop_words]
-    # print 'arg2: %s' % end1_words
-    end1_embedding = AverageVectorsUtilities.makeFeatureVec(end1_words, word2vec_model, w2v_num_feats,
-                                                            word2vec_index2word_set)
     story_ending_diff = False
 
     vec_feats = {}
     if include_embeddings:
+        group_start = len(features)
         end0_emb_curr = end0_embedding
         end1_emb_curr = end1_embedding
         if story_ending_diff:
@@ -467,8 +551,10 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
         CommonUtilities.append_features_with_vectors(vec_feats, end0_emb_curr, 'W2V_End0_')
         features.extend(end1_emb_curr)
         CommonUtilities.append_features_with_vectors(vec_feats, end1_emb_curr, 'W2V_End1_')
+        add_feature_group("endings_embeddings", ["include_embeddings"], group_start)
 
         if include_elem_multiply:
+            group_start = len(features)
             story_end0_mul_curr = np.multiply(np.asarray(end0_emb_curr), np.asarray(sentprev_embedding))
             story_end1_mulcurr = np.multiply(np.asarray(end1_emb_curr), np.asarray(sentprev_embedding))
 
@@ -477,93 +563,46 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
 
             features.extend(end1_emb_curr)
             CommonUtilities.append_features_with_vectors(vec_feats, story_end1_mulcurr, 'W2V_SE1_mul_')
-
-
-    # Sentence last
-    if include_sentlast:
-        sentlast_tokens = zip([x.lower() if lower_tokens else x for x in data_item["sentences"][-1]["tokens"]],
-                              [x.lower() if lower_tokens else x for x in data_item["sentences"][-1]["pos"]])
-        sentlast_words = [x[0] for x in sentlast_tokens if remove_stopwords and x not in stop_words]
-
-        # print 'arg1: %s' % sentlast_words
-        sentlast_embedding = AverageVectorsUtilities.makeFeatureVec(sentlast_words, word2vec_model, w2v_num_feats,
-                                                                    word2vec_index2word_set)
-
-    if include_sentlast2:
-        # Sentence last
-        sentlast2_tokens = zip([x.lower() if lower_tokens else x for x in data_item["sentences"][-2]["tokens"]],
-                              [x.lower() if lower_tokens else x for x in data_item["sentences"][-2]["pos"]])
-        sentlast2_words = [x[0] for x in sentlast2_tokens if remove_stopwords and x not in stop_words]
-
-        # print 'arg1: %s' % sentlast2_words
-        sentlast2_embedding = AverageVectorsUtilities.makeFeatureVec(sentlast2_words, word2vec_model, w2v_num_feats,
-                                                                    word2vec_index2word_set)
-
-    if include_sentlast3:
-        # Sentence last
-        sentlast3_tokens = zip([x.lower() if lower_tokens else x for x in data_item["sentences"][-3]["tokens"]],
-                              [x.lower() if lower_tokens else x for x in data_item["sentences"][-3]["pos"]])
-        sentlast3_words = [x[0] for x in sentlast3_tokens if remove_stopwords and x not in stop_words]
-
-        # print 'arg1: %s' % sentlast2_words
-        sentlast3_embedding = AverageVectorsUtilities.makeFeatureVec(sentlast3_words, word2vec_model, w2v_num_feats,
-                                                                    word2vec_index2word_set)
-
-    if include_sentlast4:
-        # Sentence last
-        sentlast4_tokens = zip([x.lower() if lower_tokens else x for x in data_item["sentences"][-4]["tokens"]],
-                              [x.lower() if lower_tokens else x for x in data_item["sentences"][-4]["pos"]])
-        sentlast4_words = [x[0] for x in sentlast4_tokens if remove_stopwords and x not in stop_words]
-
-        # print 'arg1: %s' % sentlast2_words
-        sentlast4_embedding = AverageVectorsUtilities.makeFeatureVec(sentlast4_words, word2vec_model, w2v_num_feats,
-                                                                    word2vec_index2word_set)
-        
-    if include_sentprev:
-        # Sentence prev
-        sentprev_tkns = []
-        sentprev_pos = []
-        for sent_id in range(0, len(data_item["sentences"])-1):
-            sentprev_tkns.extend(data_item["sentences"][sent_id]["tokens"])
-            sentprev_pos.extend(data_item["sentences"][sent_id]["pos"])
-
-        sentprev_tokens = zip([x.lower() if lower_tokens else x for x in sentprev_tkns],
-                              [x.lower() if lower_tokens else x for x in sentprev_pos])
-
-        sentprev_words = [x[0] for x in sentprev_tokens if remove_stopwords and x not in stop_words]
-
-        # print 'arg1: %s' % sentprev_words
-        sentprev_embedding = AverageVectorsUtilities.makeFeatureVec(sentprev_words, word2vec_model, w2v_num_feats,
-                                                                    word2vec_index2word_set)
+            add_feature_group("endings_elem_multiply", ["include_embeddings", "include_elem_multiply"], group_start)
 
     if include_embeddings:
         if include_sentlast:
+            group_start = len(features)
             features.extend(sentlast_embedding)
+            add_feature_group("sentlast_embeddings", ["include_embeddings", "include_sentlast"], group_start)
             # vec_feats = {}
             # CommonUtilities.append_features_with_vectors(vec_feats, sentlast_embedding, 'W2V_sentlast_')
 
         if include_sentlast2:
+            group_start = len(features)
             features.extend(sentlast2_embedding)
+            add_feature_group("sentlast2_embeddings", ["include_embeddings", "include_sentlast2"], group_start)
             # vec_feats = {}
             # CommonUtilities.append_features_with_vectors(vec_feats, sentlast2_embedding, 'W2V_sentlast2_')
 
         if include_sentlast3:
+            group_start = len(features)
             features.extend(sentlast3_embedding)
+            add_feature_group("sentlast3_embeddings", ["include_embeddings", "include_sentlast3"], group_start)
             # vec_feats = {}
             # CommonUtilities.append_features_with_vectors(vec_feats, sentlast3_embedding, 'W2V_sentlast3_')
 
         if include_sentlast4:
+            group_start = len(features)
             features.extend(sentlast4_embedding)
+            add_feature_group("sentlast4_embeddings", ["include_embeddings", "include_sentlast4"], group_start)
             # vec_feats = {}
             # CommonUtilities.append_features_with_vectors(vec_feats, sentlast4_embedding, 'W2V_sentlast4_')
 
         if include_sentprev:
+            group_start = len(features)
             features.extend(sentprev_embedding)
+            add_feature_group("sentprev_embeddings", ["include_embeddings", "include_sentprev"], group_start)
             # vec_feats = {}
             # CommonUtilities.append_features_with_vectors(vec_feats, sentprev_embedding, 'W2V_sentprev_')
 
 
-    def gen_and_add_features_for_sentence(featpref,
+    def gen_and_add_features_for_sentence(featpref, sent_flag,
                                   sentcurr_tokens, sentcurr_embedding,
                                   end0_tokens, end0_embedding,
                                   end1_tokens, end1_embedding):
@@ -572,6 +611,7 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
         # Last sent to End1 cosine similarity
         # Last sent to End1 cosine similarity
         if include_fullsims:
+            group_start = len(features)
             feat_key = featpref + "end0_sim"
             arg1arg2_similarity_end0 = 0.00
             if not math.isnan(sentcurr_embedding[0]) and not math.isnan(end0_embedding[0]):
@@ -585,6 +625,7 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
             if not math.isnan(sentcurr_embedding[0]) and not math.isnan(end1_embedding[0]):
                 arg1arg2_similarity_end1 = spatial.distance.cosine(sentcurr_embedding, end1_embedding)
             features.append(arg1arg2_similarity_end1)
+            add_feature_group(featpref + "fullsims", [sent_flag, "include_fullsims"], group_start)
             # CommonUtilities.increment_feat_val(sparse_feats_dict, feat_key, arg1arg2_similarity_end1)
     
         # # Last sent to End1 cosine similarity
@@ -605,6 +646,7 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
     
         # Maximized similarities
         if include_maxsim:
+            group_start = len(features)
             maxsims_feats_vec_end0, maxsims_feats_sparse_end0 = Similarity_FeatureExtraction.get_maxsims_sim_fetures(
                 words1=words1, words2=words2,
                 word2vec_model=word2vec_model,
@@ -612,15 +654,18 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
                 w2v_num_feats=w2v_num_feats,
                 pref=pref)
             features.extend(maxsims_feats_vec_end0)
+            add_feature_group(pref + "maxsim", [sent_flag, "include_maxsim"], group_start)
             # sparse_feats_dict.update(maxsims_feats_sparse_end0)
     
         # POS tags similarities
         if include_possim:
+            group_start = len(features)
             postag_feats_vec_end0, postag_feats_sparse_end0 = Similarity_FeatureExtraction.get_postagged_sim_fetures_experiments(
                 tokens_data_text1=arg1_tokens, tokens_data_text2=arg2_tokens,
                 model=word2vec_model, word2vec_num_features=w2v_num_feats,
                 word2vec_index2word_set=word2vec_index2word_set)
             features.extend(postag_feats_vec_end0)
+            add_feature_group(pref + "possim", [sent_flag, "include_possim"], group_start)
             # sparse_feats_dict.update(postag_feats_sparse_end0)
 
         # SIMILARITIES
@@ -634,6 +679,7 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
     
         # Maximized similarities
         if include_maxsim:
+            group_start = len(features)
             maxsims_feats_vec_end1, maxsims_feats_sparse_end1 = Similarity_FeatureExtraction.get_maxsims_sim_fetures(
                 words1=words1, words2=words2,
                 word2vec_model=word2vec_model,
@@ -641,15 +687,18 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
                 w2v_num_feats=w2v_num_feats,
                 pref=pref)
             features.extend(maxsims_feats_vec_end1)
+            add_feature_group(pref + "maxsim", [sent_flag, "include_maxsim"], group_start)
             # sparse_feats_dict.update(maxsims_feats_sparse_end1)
 
         # POS tags similarities
         if include_possim:
+            group_start = len(features)
             postag_feats_vec_end1, postag_feats_sparse_end1 = Similarity_FeatureExtraction.get_postagged_sim_fetures_experiments(
                 tokens_data_text1=arg1_tokens, tokens_data_text2=arg2_tokens,
                 model=word2vec_model, word2vec_num_features=w2v_num_feats,
                 word2vec_index2word_set=word2vec_index2word_set)
             features.extend(postag_feats_vec_end1)
+            add_feature_group(pref + "possim", [sent_flag, "include_possim"], group_start)
             # logging.info(postag_feats_sparse) # debug
             # sparse_feats_dict.update(postag_feats_sparse_end1)
 
@@ -663,44 +712,140 @@ def extract_features_as_vector_from_single_record_v2_jointendings(data_item,
         #     # sparse_feats_dict.update(postag_feats_sparse_end0)
 
     if include_sentlast:
-        gen_and_add_features_for_sentence("sentlast_",
+        gen_and_add_features_for_sentence("sentlast_", "include_sentlast",
                                           sentlast_tokens, sentlast_embedding,
                                           end0_tokens, end0_embedding,
                                           end1_tokens, end1_embedding)
 
     if include_sentlast2:
-        gen_and_add_features_for_sentence("sent2_",
+        gen_and_add_features_for_sentence("sent2_", "include_sentlast2",
                                           sentlast2_tokens, sentlast2_embedding,
                                           end0_tokens, end0_embedding,
                                           end1_tokens, end1_embedding)
 
     if include_sentlast3:
-        gen_and_add_features_for_sentence("sent3_",
+        gen_and_add_features_for_sentence("sent3_", "include_sentlast3",
                                           sentlast3_tokens, sentlast3_embedding,
                                           end0_tokens, end0_embedding,
                                           end1_tokens, end1_embedding)
 
     if include_sentlast4:
-        gen_and_add_features_for_sentence("sent4_",
+        gen_and_add_features_for_sentence("sent4_", "include_sentlast4",
                                           sentlast4_tokens, sentlast4_embedding,
                                           end0_tokens, end0_embedding,
                                           end1_tokens, end1_embedding)
     if include_sentprev:
-        gen_and_add_features_for_sentence("sentprev_",
+        gen_and_add_features_for_sentence("sentprev_", "include_sentprev",
                                           sentprev_tokens, sentprev_embedding,
                                           end0_tokens, end0_embedding,
                                           end1_tokens, end1_embedding)
 
     # Fix Nan features
-    for i in range(0, len(features)):
-        if math.isnan(features[i]):
-            features[i] = 0.00
+    if out is not None:
+        if len(features) != len(out):
+            raise Exception("%s features extracted, the output row size is %s" % (len(features), len(out)))
+        out[np.isnan(out)] = 0.00
+        features = out
+    else:
+        for i in range(0, len(features)):
+            if math.isnan(features[i]):
+                features[i] = 0.00
 
     if return_sparse_feats:
         return features, sparse_feats_dict
     else:
         return features
 
+def get_item_with_swapped_endings(data_item):
+    swapped_item = dict(data_item)
+    swapped_item["endings"] = [data_item["endings"][1], data_item["endings"][0]]
+
+    return swapped_item
+
+
+def get_feature_flags(options):
+    """
+    :return: Feature flags of extract_features_as_vector_from_single_record_v2_jointendings set in the options
+    """
+    return {"lower_tokens": options.lower_tokens == 'True',
+            "remove_stopwords": options.remove_stopwords == 'True',
+            "include_embeddings": options.include_embeddings == 'True',
+            "include_sentlast": options.include_sentlast == 'True',
+            "include_sentlast2": options.include_sentlast2 == 'True',
+            "include_sentlast3": options.include_sentlast3 == 'True',
+            "include_sentlast4": options.include_sentlast4 == 'True',
+            "include_sentprev": options.include_sentprev == 'True',
+            "include_maxsim": options.include_maxsim == 'True',
+            "include_possim": options.include_possim == 'True',
+            "include_fullsims": options.include_fullsims == 'True',
+            "include_elem_multiply": options.include_elem_multiply == 'True',
+            }
+
+
+# flags that select feature groups (columns), the other flags change the feature values
+FEATURE_GROUP_FLAGS = ["include_embeddings", "include_sentlast", "include_sentlast2", "include_sentlast3",
+                       "include_sentlast4", "include_sentprev", "include_maxsim", "include_possim", "include_fullsims",
+                       "include_elem_multiply"]
+
+
+def get_superset_feature_flags(feature_flags):
+    """
+    :return: feature_flags with all feature groups on
+    """
+    superset_flags = dict(feature_flags)
+    superset_flags.update([(x, True) for x in FEATURE_GROUP_FLAGS])
+
+    return superset_flags
+
+
+def get_dataset_files(input_dataset):
+    """
+    :return: Files a dataset is loaded from: the dataset and the source datasets of a reference records file
+    """
+    dataset_files = [input_dataset]
+    if is_story_refs_file(input_dataset):
+        for source_file in read_story_refs_header(input_dataset)["source_files"]:
+            if not os.path.exists(source_file):
+                # paths relative to the references file
+                source_file = os.path.join(os.path.dirname(input_dataset), os.path.basename(source_file))
+            dataset_files.append(source_file)
+
+    return dataset_files
+
+
+# data and embeddings of the feature extraction workers. Set before the pool is created and inherited on fork
+_features_workers_state = {}
+
+
+def _extract_items_features_chunk(items_chunk):
+    """
+    Features of a chunk of items for all embeddings
+    :param items_chunk: List of (item position in the data, swap the endings)
+    :return: float32 matrix with a row per item in the chunk order
+    """
+    state = _features_workers_state
+    emb_offsets = np.cumsum([0] + state["features_widths"])
+
+    chunk_features = np.zeros((len(items_chunk), emb_offsets[-1]), dtype=np.float32)
+    for row_id, (item_id, swap_endings) in enumerate(items_chunk):
+        data_item = state["data"][item_id]
+        if swap_endings:
+            data_item = get_item_with_swapped_endings(data_item)
+
+        for emb_i in range(len(state["embeddings"])):
+            # the features of each embeddings are written to their columns of the row
+            extract_features_as_vector_from_single_record_v2_jointendings(data_item,
+                                                                          state["embeddings"][emb_i],
+                                                                          state["embeddings_vocab"][emb_i],
+                                                                          return_sparse_feats=False,
+                                                                          sentence_cache=state["sentence_cache"],
+                                                                          out=chunk_features[row_id,
+                                                                                             emb_offsets[emb_i]:emb_offsets[emb_i + 1]],
+                                                                          **state["feature_flags"])
+
+    return chunk_features
+
+
 class StoryCloze_Baseline_Similarity_v1(object):
     def __init__(self, output_dir, embeddings):
         self._output_dir = output_dir
@@ -709,6 +854,170 @@ class StoryCloze_Baseline_Similarity_v1(object):
 
         pass
 
+    def iter_items_features(self, input_data, items, options, feature_flags=None):
+        """
+        Extracts the features of items for all embeddings, in the items order.
+        With options.feat_workers > 1 chunks of options.feat_chunk_size items are processed by a forked process pool:
+        the data and the embeddings (in memory or memory mapped) are shared with the workers, not copied.
+        The feature vectors are the same as in the serial mode.
+        :param input_data: List-like of data items
+        :param items: List of (item position in input_data, swap the endings)
+        :param options: Options with the feature flags, feat_workers, feat_chunk_size and sent_cache_size
+        :param feature_flags: Feature flags to use instead of the options ones
+        :return: Generator of float32 feature rows
+        """
+        if len(items) == 0:
+            return
+
+        if feature_flags is None:
+            feature_flags = get_feature_flags(options)
+
+        sentence_cache = None
+        if options.sent_cache_size > 0:
+            sentence_cache = SentenceFeatureCache(max_size=options.sent_cache_size)
+
+        _features_workers_state["data"] = input_data
+        _features_workers_state["embeddings"] = self._embeddings
+        _features_workers_state["embeddings_vocab"] = self._embeddings_vocab
+        _features_workers_state["feature_flags"] = feature_flags
+        # the rows are preallocated with the number of features of each embeddings
+        _features_workers_state["features_widths"] = self.get_features_widths(input_data[items[0][0]], feature_flags)
+        _features_workers_state["sentence_cache"] = sentence_cache
+
+        chunk_size = max(1, options.feat_chunk_size)
+        items_chunks = [items[x:x + chunk_size] for x in range(0, len(items), chunk_size)]
+        try:
+            if options.feat_workers > 1:
+                logging.info("Extracting features with %s workers (chunks of %s items)" % (options.feat_workers,
+                                                                                          chunk_size))
+                pool = multiprocessing.Pool(processes=options.feat_workers)
+                try:
+                    # imap returns the chunks in order
+                    for chunk_features in pool.imap(_extract_items_features_chunk, items_chunks):
+                        for feat_vecs in chunk_features:
+                            yield feat_vecs
+                finally:
+                    pool.terminate()
+            else:
+                for items_chunk in items_chunks:
+                    for feat_vecs in _extract_items_features_chunk(items_chunk):
+                        yield feat_vecs
+
+                if sentence_cache is not None:
+                    sentence_cache.log_stats()
+        finally:
+            _features_workers_state.clear()
+
+    def iter_items_feature_blocks(self, input_dataset, input_data, items, options, block_size,
+                                  input_data_feats=None):
+        """
+        Feature matrices of consecutive blocks of items, for evaluation in constant memory
+        :param input_dataset: Dataset file the data items are loaded from (see iter_stored_items_features)
+        :param input_data: Data items
+        :param items: List of (item position in input_data, swap the endings)
+        :param options: Options (see iter_items_features)
+        :param block_size: Maximum number of rows in a block
+        :param input_data_feats: Additional features (ex. neural representations) per entry of items, appended to the rows
+        :return: Generator of (position of the first block item in items, float32 block matrix).
+         The block matrix is reused for the next block
+        """
+        feat_block = None
+        rows_cnt = 0
+        block_start = 0
+        items_feat_vecs = self.iter_stored_items_features(input_dataset, input_data, items, options)
+        for item_id, feat_vecs in enumerate(items_feat_vecs):
+            if feat_block is None:
+                extra_feats_cnt = len(input_data_feats[0]) if input_data_feats is not None else 0
+                feat_block = np.zeros((min(block_size, len(items)), len(feat_vecs) + extra_feats_cnt), dtype=np.float32)
+
+            feat_block[rows_cnt, :len(feat_vecs)] = feat_vecs
+            if input_data_feats is not None:
+                feat_block[rows_cnt, len(feat_vecs):] = input_data_feats[item_id]
+            rows_cnt += 1
+
+            if rows_cnt == len(feat_block):
+                yield block_start, feat_block
+                block_start += rows_cnt
+                rows_cnt = 0
+
+        if rows_cnt > 0:  # last block
+            yield block_start, feat_block[:rows_cnt]
+
+    def get_features_widths(self, data_item, feature_flags):
+        """
+        :return: Number of features of each embeddings (the column groups sizes)
+        """
+        features_widths = []
+        for emb_i in range(len(self._embeddings)):
+            emb_column_groups = FeatureColumnGroups()
+            extract_features_as_vector_from_single_record_v2_jointendings(data_item,
+                                                                          self._embeddings[emb_i],
+                                                                          self._embeddings_vocab[emb_i],
+                                                                          return_sparse_feats=False,
+                                                                          feature_groups=emb_column_groups,
+                                                                          **feature_flags)
+            features_widths.append(emb_column_groups.get_width())
+
+        return features_widths
+
+    def get_feature_column_groups(self, data_item, feature_flags):
+        """
+        Column groups of the feature vectors (of all embeddings) extracted with feature_flags
+        :param data_item: Item to extract the features from. The groups are the same for all items
+        :return: FeatureColumnGroups
+        """
+        column_groups = FeatureColumnGroups()
+        offset = 0
+        for emb_i in range(len(self._embeddings)):
+            emb_column_groups = FeatureColumnGroups()
+            feat_vecs_curr = extract_features_as_vector_from_single_record_v2_jointendings(data_item,
+                                                                                           self._embeddings[emb_i],
+                                                                                           self._embeddings_vocab[emb_i],
+                                                                                           return_sparse_feats=False,
+                                                                                           feature_groups=emb_column_groups,
+                                                                                           **feature_flags)
+            column_groups.add_groups(emb_column_groups, offset, name_pref="emb%s_" % emb_i)
+            offset += len(feat_vecs_curr)
+
+        return column_groups
+
+    def iter_stored_items_features(self, input_dataset, input_data, items, options):
+        """
+        iter_items_features with the feature matrix store in options.feature_cache_dir.
+        The features of all feature groups are extracted once for the same dataset, items and embeddings
+        and memory mapped by the next runs (as float32 rows).
+        The columns of the feature flags in the options are sliced from the stored rows,
+        so runs with other flags or classifier params do not extract the features again.
+        :param input_dataset: Dataset file input_data is loaded from
+        :return: Generator of feature vectors
+        """
+        if not options.feature_cache_dir or len(items) == 0:
+            return self.iter_items_features(input_data, items, options)
+
+        feature_flags = get_feature_flags(options)
+        superset_flags = get_superset_feature_flags(feature_flags)
+        emb_model_files = options.emb_model_file.split(',')
+        features_key = get_feature_matrix_key(get_dataset_files(input_dataset), emb_model_files, superset_flags,
+                                              items=items)
+
+        store = FeatureMatrixStore(options.feature_cache_dir)
+        if store.exists(features_key):
+            column_groups = FeatureColumnGroups(store.load_meta(features_key)["feature_groups"])
+        else:
+            column_groups = self.get_feature_column_groups(input_data[items[0][0]], superset_flags)
+
+        features_meta = {"input_dataset": input_dataset, "emb_model_files": emb_model_files,
+                         "feature_flags": superset_flags, "feature_groups": column_groups.to_list()}
+        stored_feat_vecs = store.iter_rows(features_key,
+                                           self.iter_items_features(input_data, items, options,
+                                                                    feature_flags=superset_flags),
+                                           len(items), meta=features_meta)
+
+        columns = column_groups.get_columns(feature_flags)
+        logging.info("Feature groups: %s of %s columns selected" % (len(columns), column_groups.get_width()))
+
+        return (feat_vec[columns] for feat_vec in stored_feat_vecs)
+
     def train(self,
               input_dataset,
               options):
@@ -717,7 +1026,7 @@ class StoryCloze_Baseline_Similarity_v1(object):
         scale_file = options.scale_file
 
 
-        input_data = DataUtilities_ROCStories.load_data_from_json_file(input_dataset)
+        input_data = DataUtilities_ROCStories.load_dataset(input_dataset)
         logging.info("input_data[0] train:\n%s" % str(input_data[0]))
         if options.max_records and options.max_records>0:
             logging.info("max_records:%s" % options.max_records)
@@ -740,113 +1049,36 @@ class StoryCloze_Baseline_Similarity_v1(object):
             logging.info("Features loaded from %s" % input_data_feats_file)
 
         start = time.time()
-        id_id = -1
+        # the items and the items with swapped endings
+        items = []
         for i in range(len(input_data)):
-            if ((i+1) % 100) == 0:
+            items.append((i, False))
+            if gen_swap_endings:
+                items.append((i, True))
+
+        id_id = -1
+        items_feat_vecs = self.iter_stored_items_features(input_dataset, input_data, items, options)
+        for item_id, feat_vecs in enumerate(items_feat_vecs):
+            i, swap_endings = items[item_id]
+            if ((i+1) % 100) == 0 and not swap_endings:
                 logging.info("processed %s of  %s" % (i+1, len(input_data)))
-            # feat_vecs, feats_sparse
-            # normal item
-            feat_vecs = []
-            for emb_i in range(len(self._embeddings)):
-                feat_vecs_curr = extract_features_as_vector_from_single_record_v2_jointendings(input_data[i],
-                                                                           self._embeddings[emb_i],
-                                                                           self._embeddings_vocab[emb_i],
-                                                                           return_sparse_feats=False,
-                                                                          lower_tokens=(
-                                                                          options.lower_tokens == 'True'),
-                                                                          remove_stopwords=(
-                                                                          options.remove_stopwords == 'True'),
-                                                                          include_embeddings=(
-                                                                          options.include_embeddings == 'True'),
-                                                                          include_sentlast=(
-                                                                          options.include_sentlast == 'True'),
-                                                                          include_sentlast2=(
-                                                                          options.include_sentlast2 == 'True'),
-                                                                          include_sentlast3=(
-                                                                          options.include_sentlast3 == 'True'),
-                                                                          include_sentlast4=(
-                                                                          options.include_sentlast4 == 'True'),
-                                                                          include_sentprev=(
-                                                                          options.include_sentprev == 'True'),
-                                                                          include_maxsim=(
-                                                                          options.include_maxsim == 'True'),
-                                                                          include_possim=(
-                                                                          options.include_possim == 'True'),
-                                                                          include_fullsims=(
-                                                                          options.include_fullsims == 'True'),
-                                                                          include_elem_multiply=(
-                                                                          options.include_elem_multiply == 'True'),
-                                                                          )
-                feat_vecs.extend(feat_vecs_curr)
 
             #logging.info("feats type = %s" % str(type(feat_vecs)))
             id_id += 1
             if input_data_feats is not None:
                 # logging.info("input_data_feats[i] type = %s" % str(type(input_data_feats[i].tolist())))
-                feat_vecs.extend(input_data_feats[id_id].tolist())
+                feat_vecs = np.concatenate([feat_vecs, np.asarray(input_data_feats[id_id], dtype=np.float32)])
 
             y = input_data[i]["right_end_id"]
 
-            input_x_features.append(feat_vecs)
+            if item_id == 0:
+                input_x_features = np.zeros((len(items), len(feat_vecs)), dtype=np.float32)
+            input_x_features[item_id] = feat_vecs
             # input_x_features_sparse.append(feats_sparse)
-            input_y.append(y)
+            input_y.append(y if not swap_endings else (0 if y==1 else 1))
 
             id2docid.append(input_data[i]["id"])
 
-            from copy import deepcopy
-            if gen_swap_endings:
-                id_id += 1
-                curr_item = deepcopy(input_data[i])
-                curr_item["endings"][0] = deepcopy(input_data[i]["endings"][1])
-                curr_item["endings"][1] = deepcopy(input_data[i]["endings"][0])
-
-                feat_vecs = []
-                for emb_i in range(len(self._embeddings)):
-                    feat_vecs_curr = extract_features_as_vector_from_single_record_v2_jointendings(curr_item,
-                                                                                                   self._embeddings[
-                                                                                                       emb_i],
-                                                                                                   self._embeddings_vocab[
-                                                                                                       emb_i],
-                                                                                                   return_sparse_feats=False,
-                                                                                                   lower_tokens=(
-                                                                                                       options.lower_tokens == 'True'),
-                                                                                                   remove_stopwords=(
-                                                                                                       options.remove_stopwords == 'True'),
-                                                                                                   include_embeddings=(
-                                                                                                       options.include_embeddings == 'True'),
-                                                                                                   include_sentlast=(
-                                                                                                       options.include_sentlast == 'True'),
-                                                                                                   include_sentlast2=(
-                                                                                                       options.include_sentlast2 == 'True'),
-                                                                                                   include_sentlast3=(
-                                                                                                       options.include_sentlast3 == 'True'),
-                                                                                                   include_sentlast4=(
-                                                                                                       options.include_sentlast4 == 'True'),
-                                                                                                   include_sentprev=(
-                                                                                                       options.include_sentprev == 'True'),
-                                                                                                   include_maxsim=(
-                                                                                                       options.include_maxsim == 'True'),
-                                                                                                   include_possim=(
-                                                                                                       options.include_possim == 'True'),
-                                                                                                   include_fullsims=(
-                                                                                                       options.include_fullsims == 'True'),
-                                                                                                   include_elem_multiply=(
-                                                                                                       options.include_elem_multiply == 'True'),
-                                                                                                   )
-                    feat_vecs.extend(feat_vecs_curr)
-
-                if input_data_feats is not None:
-                    # logging.info("input_data_feats[i] type = %s" % str(type(input_data_feats[i].tolist())))
-                    feat_vecs.extend(input_data_feats[id_id].tolist())
-
-                y = input_data[i]["right_end_id"]
-
-                input_x_features.append(feat_vecs)
-                # input_x_features_sparse.append(feats_sparse)
-                input_y.append(0 if y==1 else 1)
-
-                id2docid.append(input_data[i]["id"])
-
         logging.info("Done in %s s" % (time.time() - start))
         logging.info("Features:%s" % (len(input_x_features[0])))
         logging.info("Feature vector 0:%s" % (str(input_x_features[0])))
@@ -939,7 +1171,7 @@ class StoryCloze_Baseline_Similarity_v1(object):
         model_file = options.model_file
         scale_file = options.scale_file
 
-        input_data = DataUtilities_ROCStories.load_data_from_json_file(input_dataset)
+        input_data = DataUtilities_ROCStories.load_dataset(input_dataset)
         logging.info("input_data[0] eval:\n%s" % str(input_data[0]))
 
 
@@ -957,13 +1189,6 @@ class StoryCloze_Baseline_Similarity_v1(object):
             input_data_feats = pickle.load(open(input_data_feats_file, 'rb'))
             logging.info("Features loaded from %s" % input_data_feats_file)
 
-        id2docid = []
-
-        input_x_features = []
-        input_x_features_sparse = []
-        input_y = []
-        predicted_y = []
-
         # evaluation
         if scale_features:
             scaler = pickle.load(open(scale_file, 'rb'))
@@ -994,86 +1219,44 @@ class StoryCloze_Baseline_Similarity_v1(object):
             return predicted_y_curr
 
         eval_batch_size = 5000
-        for i in range(len(input_data)):
-            if ((i+1) % 1000) == 0:
-                logging.info("processed %s of  %s" % (i+1, len(input_data)))
-            # feat_vecs, feats_sparse
-            feat_vecs = []
-            for emb_i in range(len(self._embeddings)):
-                feat_vecs_curr = extract_features_as_vector_from_single_record_v2_jointendings(input_data[i],
-                                                                                               self._embeddings[emb_i],
-                                                                                               self._embeddings_vocab[
-                                                                                                   emb_i],
-                                                                                               return_sparse_feats=False,
-                                                                                               lower_tokens=(
-                                                                                                   options.lower_tokens == 'True'),
-                                                                                               remove_stopwords=(
-                                                                                                   options.remove_stopwords == 'True'),
-                                                                                               include_embeddings=(
-                                                                                                   options.include_embeddings == 'True'),
-                                                                                               include_sentlast=(
-                                                                                                   options.include_sentlast == 'True'),
-                                                                                               include_sentlast2=(
-                                                                                                   options.include_sentlast2 == 'True'),
-                                                                                               include_sentlast3=(
-                                                                                                   options.include_sentlast3 == 'True'),
-                                                                                               include_sentlast4=(
-                                                                                                   options.include_sentlast4 == 'True'),
-                                                                                               include_sentprev=(
-                                                                                                   options.include_sentprev == 'True'),
-                                                                                               include_maxsim=(
-                                                                                                   options.include_maxsim == 'True'),
-                                                                                               include_possim=(
-                                                                                                   options.include_possim == 'True'),
-                                                                                               include_fullsims=(
-                                                                                                   options.include_fullsims == 'True'),
-                                                                                               include_elem_multiply=(
-                                                                                                   options.include_elem_multiply == 'True'),
-
-                                                                                               )
-                feat_vecs.extend(feat_vecs_curr)
-
-            if input_data_feats is not None:
-                feat_vecs.extend(input_data_feats[i])
+        conf_matrix = OnlineConfusionMatrix(labels=classifier_current.classes_)
 
-            y = input_data[i]["right_end_id"]
-            input_y.append(y)
-            id2docid.append(input_data[i]["id"])
-
-            input_x_features.append(feat_vecs)
-            # input_x_features_sparse.append(feats_sparse)
+        # the predictions are written as the blocks are evaluated and the file is renamed with the accuracy at the end
+        fw = None
+        if options.submission_data_eval:
+            submission_tmp_file_name = options.submission_data_eval + "_acc.txt.tmp"
+            fw = codecs.open(submission_tmp_file_name, "w", encoding='utf-8')
+            fw.write("InputStoryid,AnswerRightEnding\n")
 
-            if ((i+1) % eval_batch_size) == 0:
-                logging.info("processed %s of  %s" % (i+1, len(input_data)))
+        try:
+            feat_blocks = self.iter_items_feature_blocks(input_dataset, input_data,
+                                                         [(i, False) for i in range(len(input_data))], options,
+                                                         eval_batch_size, input_data_feats=input_data_feats)
+            for block_start, feat_block in feat_blocks:
+                block_data = input_data[block_start:block_start + len(feat_block)]
+                logging.info("processed %s of  %s" % (block_start + len(feat_block), len(input_data)))
 
-                predicted_y_curr = eval_instances(input_x_features)
-                predicted_y.extend(predicted_y_curr)
-                del input_x_features
-                input_x_features = []
+                predicted_y_curr = eval_instances(feat_block)
+                conf_matrix.update([x["right_end_id"] for x in block_data], predicted_y_curr)
 
-        if len(input_x_features) > 0:  # eval last batch
-            predicted_y_curr = eval_instances(input_x_features)
-            predicted_y.extend(predicted_y_curr)
-            del input_x_features
-            input_x_features = []
+                if fw is not None:
+                    for data_item, predicted_y in zip(block_data, predicted_y_curr):
+                        fw.write("%s,%s\n" % (data_item["id"], predicted_y + 1))
+        finally:
+            if fw is not None:
+                fw.close()
 
         logging.info("Confusion matrix:")
+        logging.info("\n" + str(conf_matrix.matrix))
+        logging.info("precision_recall_fscore_support:%s" % str(conf_matrix.precision_recall_fscore_support()))
 
-        conf_matrix = confusion_matrix(input_y, predicted_y)
-        logging.info("\n" + str(conf_matrix))
-        logging.info("precision_recall_fscore_support:%s" % str(precision_recall_fscore_support(input_y, predicted_y)))
-
-        test_accuracy_score=accuracy_score(input_y, predicted_y)
+        test_accuracy_score = conf_matrix.accuracy()
         logging.info("accuracy_score:%s" % test_accuracy_score)
 
         if options.submission_data_eval:
             submission_file_name = options.submission_data_eval + "_acc_%s.txt" % test_accuracy_score
-            logging.info("Building submission file [%s]" % submission_file_name)
-            fw = codecs.open(submission_file_name, "w", encoding='utf-8')
-            fw.write("InputStoryid,AnswerRightEnding\n")
-            for i in range(len(predicted_y)):
-                fw.write("%s,%s\n" % (id2docid[i], predicted_y[i]+1))
-            logging.info("Done! %s items written!" % len(predicted_y))
+            os.rename(submission_tmp_file_name, submission_file_name)
+            logging.info("Submission file [%s]: %s items written!" % (submission_file_name, conf_matrix.total()))
 
 
 # Sample run
@@ -1122,6 +1305,13 @@ if __name__ == "__main__":
     parser.add_option("--emb_model_file", dest="emb_model_file", help="")
 
     parser.add_option("--word2vec_load_bin", dest="word2vec_load_bin", default=False, help="")
+    parser.add_option("--emb_mmap_dir", dest="emb_mmap_dir", default="",
+                      help="dir for float32 memory mapped copies of the embeddings (created on the first run)")
+    parser.add_option("--emb_norm_mode", dest="emb_norm_mode", choices=NORM_MODES, default=NORM_MODE_MEMORY,
+                      help="normalized embeddings for the cosine features: memory - copy in memory, "
+                           "mmap - memory mapped copy in emb_norm_dir, inplace - normalize the loaded matrix")
+    parser.add_option("--emb_norm_dir", dest="emb_norm_dir", default="",
+                      help="dir for the normalized embeddings of emb_norm_mode=mmap")
     parser.add_option("--word2vec_load_format", dest="word2vec_load_format", default=True, help="")
     parser.add_option("--output_dir", dest="output_dir", help="")
     parser.add_option("--model_file", dest="model_file", help="")
@@ -1144,6 +1334,15 @@ if __name__ == "__main__":
     parser.add_option('--inc_possim', dest='include_possim', default=True)
     parser.add_option('--inc_fullsims', dest='include_fullsims', default=True)
     parser.add_option('--include_elem_multiply', dest='include_elem_multiply', default=False)
+    parser.add_option('--sent_cache_size', dest='sent_cache_size', default=100000, type="int",
+                      help="max number of cached sentence token lists and embeddings. 0 to disable the cache")
+    parser.add_option('--feat_workers', dest='feat_workers', default=0, type="int",
+                      help="number of feature extraction processes. 0 or 1 for serial extraction")
+    parser.add_option('--feat_chunk_size', dest='feat_chunk_size', default=100, type="int",
+                      help="number of items sent to a feature extraction process at once")
+    parser.add_option('--feature_cache_dir', dest='feature_cache_dir', default="",
+                      help="dir for the extracted float32 feature matrices with all feature groups, "
+                           "reused by the runs with the same data and embeddings (any --inc_* flags)")
 
 
     (options, args) = parser.parse_args()
@@ -1163,13 +1362,18 @@ if __name__ == "__main__":
         logging.info("Loading w2v model..")
 
         for emb_model_file in options.emb_model_file.split(','):
-            if options.word2vec_load_format and options.word2vec_load_format == "True":
+            if options.emb_mmap_dir:
+                embeddings_model = load_mmap_embeddings(emb_model_file, options.emb_mmap_dir,
+                                                        binary=options.word2vec_load_bin=="True")
+            elif options.word2vec_load_format and options.word2vec_load_format == "True":
                 embeddings_model = Word2Vec.load_word2vec_format(emb_model_file,
                                                                  binary=options.word2vec_load_bin=="True")
 
             else:
                 embeddings_model = Word2Vec.load(emb_model_file)
 
+            init_normalized_vectors(embeddings_model, mode=options.emb_norm_mode, norm_dir=options.emb_norm_dir)
+
             embeddings_models.append(embeddings_model)
             embeddings_vec_size = embeddings_model.wv.syn0.shape[1] if embeddings_model.wv else embeddings_model.syn0.shape[1]
             embeddings_vec_sizes.append(embeddings_vec_size)
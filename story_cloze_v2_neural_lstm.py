@@ -10,10 +10,12 @@ from gensim.models.word2vec import Word2Vec  # used for word2vec
 
 import time  # used for performance measuring
 from utils.embedding_vector_utilities import AverageVectorsUtilities
+from utils.mmap_embeddings import load_mmap_embeddings, load_vocab_embeddings
 
 import pickle
 
 from data.StoryClozeTest.DataUtilities_ROCStories import DataUtilities_ROCStories
+from data.StoryClozeTest.columnar_dataset import ColumnarStoryDataset, iter_stories_token_ids
 import time as ti
 
 from utils.label_dictionary import LabelDictionary
@@ -33,6 +35,10 @@ def extract_word_frequencies(input_data,
                              tokens_field="tokens",
                              max_nr_sent=0,
                              tokens_lowercase=False):
+    if isinstance(input_data, ColumnarStoryDataset):
+        return input_data.word_frequencies(data_fields_sents, tokens_field=tokens_field, max_items=max_nr_sent,
+                                           lowercase=tokens_lowercase)
+
     vocab_freq = {}
     nr_sent = 0
 
@@ -79,22 +85,16 @@ def transofrm_data_word_to_id(input_data,
     input_list_endings2 = []
     input_list_labels = []
 
-    vocab_set = set(vocab_token_to_id.keys())
-    for data_item in input_data:
+    for story_id, story_sents, endings, label in iter_stories_token_ids(input_data, vocab_token_to_id,
+                                                                         unknown_token_id=unknown_token_id,
+                                                                         tokens_field=tokens_field,
+                                                                         lowercase=lowercase):
         story = []
-
-        for sent_data in data_item["sentences"]:
-            sent = [vocab_token_to_id[x] if x in vocab_set else unknown_token_id for x in
-                    lowercase_list(sent_data[tokens_field], lowercase)]
+        for sent in story_sents:
             story.extend(sent)
 
-        ending1 = [vocab_token_to_id[x] if x in vocab_set else unknown_token_id for x in
-                   lowercase_list(data_item["endings"][0][tokens_field], lowercase)]
-        ending2 = [vocab_token_to_id[x] if x in vocab_set else unknown_token_id for x in
-                   lowercase_list(data_item["endings"][1][tokens_field], lowercase)]
-
-        label = data_item["right_end_id"]
-        story_id = data_item["id"]
+        ending1 = endings[0]
+        ending2 = endings[1]
 
         # append
         input_list_story_ids.append(story_id)
@@ -193,7 +193,8 @@ class StoryCloze_v2_lstm_v1(object):
               input_dataset,
               options,
               embeddings,
-              embeddings_vocab
+              embeddings_vocab,
+              input_data=None
               ):
         scale_features = options.scale_features
         model_file = options.model_file
@@ -204,8 +205,9 @@ class StoryCloze_v2_lstm_v1(object):
         if embeddings_type == "w2v":
             embeddings_vocab_set = set(embeddings.index2word)
 
-        # train data
-        input_data = DataUtilities_ROCStories.load_data_from_json_file(input_dataset)
+        # train data. Already loaded if the embeddings are restricted to the train vocab
+        if input_data is None:
+            input_data = DataUtilities_ROCStories.load_dataset(input_dataset, intern_vocab=True)
         logging.info("input_data fields:\n%s" % str(input_data[0].keys()))
 
         logging.info("input_data[0] train:\n%s" % str(input_data[0]))
@@ -216,7 +218,7 @@ class StoryCloze_v2_lstm_v1(object):
         logging.info("Items to process:%s" % len(input_data))
 
         # dev data
-        input_data_dev = DataUtilities_ROCStories.load_data_from_json_file(options.input_data_eval)
+        input_data_dev = DataUtilities_ROCStories.load_dataset(options.input_data_eval, intern_vocab=True)
         logging.info("input_data_dev[0] dev:\n%s" % str(input_data_dev[0]))
         # if options.max_records and options.max_records > 0:
         #     logging.info("max_records:%s" % options.max_records)
@@ -260,10 +262,14 @@ class StoryCloze_v2_lstm_v1(object):
 
         vocab_and_embeddings = {}
         if embeddings_type == "w2v":
-            unknown_vec = AverageVectorsUtilities.makeFeatureVec(words=list(embeddings_vocab_set),
-                                                                 model=embeddings_model,
-                                                                 num_features=embeddings_vec_size,
-                                                                 index2word_set=embeddings_vocab_set)
+            if getattr(embeddings_model, "mean_vector", None) is not None:
+                # vocab restricted embeddings - the average of all vectors is computed when they are extracted
+                unknown_vec = embeddings_model.mean_vector
+            else:
+                unknown_vec = AverageVectorsUtilities.makeFeatureVec(words=list(embeddings_vocab_set),
+                                                                     model=embeddings_model,
+                                                                     num_features=embeddings_vec_size,
+                                                                     index2word_set=embeddings_vocab_set)
 
             pad_vec = unknown_vec * 0.25
             logging.info("Done in %s s" % (ti.time() - st))
@@ -535,7 +541,7 @@ class StoryCloze_v2_lstm_v1(object):
         model_file = options.model_file
         scale_file = options.scale_file
 
-        input_data = DataUtilities_ROCStories.load_data_from_json_file(input_dataset)
+        input_data = DataUtilities_ROCStories.load_dataset(input_dataset)
         logging.info("input_data[0] eval:\n%s" % str(input_data[0]))
 
         # if options.max_records and options.max_records > 0:
@@ -643,6 +649,10 @@ if __name__ == "__main__":
     parser.add_option("--emb_model_type", dest="emb_model_type", choices=["w2v", "dep", "rand"], help="")  # "w2v"  #
     parser.add_option("--emb_model_file", dest="emb_model_file", help="")
     parser.add_option("--word2vec_load_bin", dest="word2vec_load_bin", default=False, help="")
+    parser.add_option("--emb_mmap_dir", dest="emb_mmap_dir", default="",
+                      help="dir for float32 memory mapped copies of the embeddings (created on the first run)")
+    parser.add_option("--emb_vocab_cache_dir", dest="emb_vocab_cache_dir", default="",
+                      help="load only the embeddings of the train words (cached in this dir)")
     parser.add_option("--output_dir", dest="output_dir", help="")
     parser.add_option("--model_file", dest="model_file", help="")
     parser.add_option("--scale_file", dest="scale_file", help="")
@@ -673,9 +683,28 @@ if __name__ == "__main__":
         options_print += "opt: %s=%s\r\n" % (k, v)
     logging.info(options_print)
 
+    # train data loaded before the training
+    input_data_train = None
     if options.emb_model_type == "w2v":
         logging.info("Loading w2v model..")
-        if options.word2vec_load_bin and options.word2vec_load_bin == "True":
+        if options.emb_vocab_cache_dir and options.input_data_train:
+            if options.word2vec_load_bin != "True":
+                # without word2vec_load_bin the model is loaded with Word2Vec.load
+                raise Exception("Vocab embeddings cannot be extracted from native gensim models (emb_vocab_cache_dir "
+                                "is set but word2vec_load_bin is not True): %s" % options.emb_model_file)
+            # the vocab is built from the train data, only the vectors of its words are needed
+            input_data_train = DataUtilities_ROCStories.load_dataset(options.input_data_train, intern_vocab=True)
+            train_vocab = [x[0] for x in extract_word_frequencies(input_data_train)]
+            embeddings_model = load_vocab_embeddings(options.emb_model_file, train_vocab, options.emb_vocab_cache_dir,
+                                                     binary=options.word2vec_load_bin=="True")
+        elif options.emb_mmap_dir:
+            if options.word2vec_load_bin != "True":
+                # without word2vec_load_bin the model is loaded with Word2Vec.load
+                raise Exception("Native gensim models cannot be memory mapped (emb_mmap_dir is set but "
+                                "word2vec_load_bin is not True): %s" % options.emb_model_file)
+            embeddings_model = load_mmap_embeddings(options.emb_model_file, options.emb_mmap_dir,
+                                                    binary=options.word2vec_load_bin=="True")
+        elif options.word2vec_load_bin and options.word2vec_load_bin == "True":
             embeddings_model = Word2Vec.load_word2vec_format(options.emb_model_file,
                                                              binary=True)  # use this for google vectors
         else:
@@ -711,7 +740,8 @@ if __name__ == "__main__":
         magic_box.train(input_dataset=options.input_data_train,
                         options=options,
                         embeddings=embeddings_model,
-                        embeddings_vocab=embeddings_model.index2word)
+                        embeddings_vocab=embeddings_model.index2word,
+                        input_data=input_data_train)
         # logging.info("------EVALUATION--------")
         # magic_box.eval(input_dataset=options.input_data_eval,
         #                options=options)
@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+from utils.json_helpers import remove_meta_file, save_meta_file
+
+ANN_INDEX_META_FILE = "meta.json"
+
+
+def normalize_rows(vectors):
+    """
+    L2-normalizes the rows of a matrix. Zero rows stay zero.
+    :param vectors: 2D array
+    :return: New float32 array with unit rows
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+    norms[norms == 0] = 1.0
+
+    return vectors / norms[:, None]
+
+
+class IVFIndex(object):
+    """
+    Approximate nearest neighbour index (cosine similarity) for dense vectors.
+    The vectors are clustered with spherical k-means and each vector is put in the inverted list of its centroid.
+    A query is compared to the centroids and only to the vectors in the n_probe closest lists.
+    Usage:
+        index = IVFIndex(n_lists=256, n_probe=8)
+        index.build(sentence_vectors)
+        neighbour_ids, neighbour_sims = index.search(query_vectors, top_k=20)
+        index.save("resources/ann_index")
+        index, meta = IVFIndex.load("resources/ann_index")  # memory mapped arrays
+    """
+
+    def __init__(self, n_lists=0, n_probe=8, seed=42):
+        """
+        :param n_lists: Number of clusters (inverted lists). 0 for sqrt(number of vectors)
+        :param n_probe: Number of lists searched for a query
+        :param seed: Random seed for the k-means initialization
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.seed = seed
+
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        # vectors of list l are list_ids[list_ptr[l]:list_ptr[l + 1]]
+        self.list_ptr = np.zeros(1, dtype=np.int64)
+        self.list_ids = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @staticmethod
+    def _assign(vectors, centroids, batch_size=4096):
+        assignment = np.zeros(len(vectors), dtype=np.int64)
+        for start in xrange(0, len(vectors), batch_size):
+            batch = vectors[start:start + batch_size]
+            assignment[start:start + len(batch)] = np.argmax(np.dot(batch, centroids.T), axis=1)
+
+        return assignment
+
+    def build(self, vectors, kmeans_iters=10, max_train_size=100000):
+        """
+        Clusters the vectors and builds the inverted lists
+        :param vectors: 2D array with a vector per document. Document ids are the row positions
+        :param kmeans_iters: Number of k-means iterations
+        :param max_train_size: Maximum number of (randomly sampled) vectors used to train the centroids
+        """
+        self.vectors = normalize_rows(vectors)
+        vectors_cnt = len(self.vectors)
+
+        n_lists = self.n_lists if self.n_lists > 0 else int(np.sqrt(vectors_cnt))
+        n_lists = max(1, min(n_lists, vectors_cnt))
+
+        rand = np.random.RandomState(self.seed)
+        train_vectors = self.vectors
+        if vectors_cnt > max_train_size:
+            train_vectors = self.vectors[np.sort(rand.choice(vectors_cnt, max_train_size, replace=False))]
+
+        centroids = train_vectors[rand.choice(len(train_vectors), n_lists, replace=False)].copy()
+        for iter_id in range(kmeans_iters):
+            assignment = self._assign(train_vectors, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, train_vectors)
+
+            # empty clusters keep their centroid
+            not_empty = np.bincount(assignment, minlength=n_lists) > 0
+            centroids[not_empty] = normalize_rows(sums[not_empty])
+
+        self.centroids = centroids
+
+        assignment = self._assign(self.vectors, self.centroids)
+        self.list_ids = np.argsort(assignment, kind="mergesort").astype(np.int64)
+        self.list_ptr = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=self.list_ptr[1:])
+
+        logging.info("IVFIndex: %s vectors in %s lists (max list size %s)" % (
+            vectors_cnt, n_lists, np.diff(self.list_ptr).max() if vectors_cnt > 0 else 0))
+
+    @staticmethod
+    def exists(index_dir):
+        return os.path.exists(os.path.join(index_dir, ANN_INDEX_META_FILE))
+
+    def save(self, index_dir, meta=None):
+        """
+        Saves the index to index_dir: vectors.npy, centroids.npy, list_ptr.npy, list_ids.npy and meta.json
+        :param index_dir: Output directory
+        :param meta: Dict saved in meta.json, ex. what the index is built from
+        """
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+        # an index saved before in index_dir is not valid while its arrays are overwritten
+        remove_meta_file(os.path.join(index_dir, ANN_INDEX_META_FILE))
+
+        for name in ["vectors", "centroids", "list_ptr", "list_ids"]:
+            np.save(os.path.join(index_dir, "%s.npy" % name), getattr(self, name))
+
+        meta = dict(meta if meta is not None else {})
+        meta["n_probe"] = self.n_probe
+        meta["seed"] = self.seed
+
+        # meta is written last so a partially saved index is not loaded
+        save_meta_file(os.path.join(index_dir, ANN_INDEX_META_FILE), meta)
+
+    @staticmethod
+    def load(index_dir, mmap_mode="r"):
+        """
+        Loads an index saved with save()
+        :param index_dir: Index directory
+        :param mmap_mode: np.load mmap_mode for the arrays. None to read them in memory
+        :return: (IVFIndex, meta dict)
+        """
+        with open(os.path.join(index_dir, ANN_INDEX_META_FILE), mode="rb") as meta_file:
+            meta = json.load(meta_file)
+
+        index = IVFIndex(n_probe=meta["n_probe"], seed=meta["seed"])
+        for name in ["vectors", "centroids", "list_ptr", "list_ids"]:
+            setattr(index, name, np.load(os.path.join(index_dir, "%s.npy" % name), mmap_mode=mmap_mode))
+        index.n_lists = len(index.centroids)
+
+        return index, meta
+
+    def search(self, queries, top_k=10, exclude_ids=None, batch_size=1024):
+        """
+        Finds the most similar vectors for a batch of queries
+        :param queries: 2D array with a query vector per row
+        :param top_k: Number of neighbours for a query
+        :param exclude_ids: Document id to skip for each query (ex. the query document itself). -1 for none
+        :param batch_size: Number of queries compared to the centroids at once
+        :return: (ids, sims) arrays of shape (queries count, top_k) sorted by similarity desc, then id asc.
+         Missing neighbours have id -1
+        """
+        queries = normalize_rows(queries)
+        queries_cnt = len(queries)
+        neighbour_ids = np.full((queries_cnt, top_k), -1, dtype=np.int64)
+        neighbour_sims = np.zeros((queries_cnt, top_k), dtype=np.float32)
+        if queries_cnt == 0 or top_k <= 0 or len(self.vectors) == 0:
+            return neighbour_ids, neighbour_sims
+
+        n_probe = max(1, min(self.n_probe, len(self.centroids)))
+        list_sizes = np.diff(self.list_ptr)
+        for start in xrange(0, queries_cnt, batch_size):
+            batch = queries[start:start + batch_size]
+            centroid_sims = np.dot(batch, self.centroids.T)
+            if n_probe < len(self.centroids):
+                probes = np.argpartition(-centroid_sims, n_probe - 1, axis=1)[:, :n_probe]
+            else:
+                probes = np.tile(np.arange(len(self.centroids)), (len(batch), 1))
+
+            for i in range(len(batch)):
+                query_id = start + i
+                lists = probes[i]
+                lists = lists[list_sizes[lists] > 0]
+                if len(lists) == 0:
+                    continue
+
+                candidates = np.concatenate([self.list_ids[self.list_ptr[l]:self.list_ptr[l + 1]] for l in lists])
+                if exclude_ids is not None and exclude_ids[query_id] >= 0:
+                    candidates = candidates[candidates != exclude_ids[query_id]]
+                if len(candidates) == 0:
+                    continue
+
+                sims = np.dot(self.vectors[candidates], batch[i])
+                if len(candidates) > top_k:
+                    # the k-th largest similarity and everything above it
+                    kth_sim = sims[np.argpartition(-sims, top_k - 1)[top_k - 1]]
+                    selected = sims >= kth_sim
+                    candidates = candidates[selected]
+                    sims = sims[selected]
+
+                order = np.lexsort((candidates, -sims))[:top_k]
+                neighbour_ids[query_id, :len(order)] = candidates[order]
+                neighbour_sims[query_id, :len(order)] = sims[order]
+
+        return neighbour_ids, neighbour_sims
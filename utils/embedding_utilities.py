@@ -11,6 +11,9 @@ import pickle
 
 import logging
 
+from utils.mmap_embeddings import get_model_word_row
+
+
 class VocabEmbeddingUtilities(object):
 
     @staticmethod
@@ -69,6 +72,52 @@ class VocabEmbeddingUtilities(object):
 
         return vocabulary
 
+    @staticmethod
+    def build_embeddings_matrix(vocabulary, get_source_row, source_matrix, embeddings_size, lowercase_fallback=True):
+        """
+        Builds a float32 embeddings matrix for a vocabulary with a single gather from the source matrix.
+        Words that are not found get random vectors (uniform -0.1, 0.1), drawn in the vocabulary iteration order.
+            Args:
+                vocabulary:
+                    dictionary with key words and value index
+                get_source_row:
+                    function word -> row in source_matrix or None
+                source_matrix:
+                    matrix with the source embeddings
+                embeddings_size:
+                    the size of the embeddings vector
+                lowercase_fallback:
+                    look up the lowercased word when the word is not found
+            Returns:
+                float32 matrix with a row per vocabulary index
+        """
+        vocab_size = len(vocabulary)
+        embeddings = np.zeros((vocab_size, embeddings_size), dtype=np.float32)
+
+        found_indexes = []
+        found_rows = []
+        oov_indexes = []
+        for word in vocabulary:
+            source_row = get_source_row(word)
+            if source_row is None and lowercase_fallback:
+                source_row = get_source_row(word.lower())
+
+            if source_row is None:
+                oov_indexes.append(vocabulary[word])
+            else:
+                found_indexes.append(vocabulary[word])
+                found_rows.append(source_row)
+
+        if len(found_indexes) > 0:
+            embeddings[np.array(found_indexes)] = source_matrix[np.array(found_rows)]
+        if len(oov_indexes) > 0:
+            # Init random embeddings vectors
+            embeddings[np.array(oov_indexes)] = np.random.uniform(-0.1, 0.1, [len(oov_indexes), embeddings_size])
+
+        logging.info("Embeddings for vocab: %s found, %s random" % (len(found_indexes), len(oov_indexes)))
+
+        return embeddings
+
     @staticmethod
     def get_embeddings_for_vocab_from_model(vocabulary, embeddings_type, embeddings_model, embeddings_size):
         """
@@ -83,54 +132,31 @@ class VocabEmbeddingUtilities(object):
                 embeddings_size:
                     the size of the embeddings vector
             Returns:
-                Word types vocabulary
+                Word types vocabulary and float32 embeddings
             """
         if embeddings_type == 'w2v':
-            index2wordset = set(embeddings_model.index2word)  # performance optimization
             print ("Building embeddings...")
             vocab_size = len(vocabulary)
             print vocab_size
-            embeddings = np.zeros((vocab_size, embeddings_size))
-            for word in vocabulary:
-                index = vocabulary[word]
-                if word in index2wordset:
-                    embeddings[index, :] = embeddings_model[word].reshape((1, embeddings_size))
-                elif word.lower() in index2wordset:
-                    embeddings[index, :] = embeddings_model[word.lower()].reshape((1, embeddings_size))
-                else:
-                    # Init random embeddings vector
-                    embeddings[index, :] = np.random.uniform(-0.1, 0.1, [1, embeddings_size])
-
-            # print ("Write vocab and embeddings data in a pickle...")
-
-            try:
-                # fp = open(output_pickle_file, 'wb')
-                vocab_embeddings = {
-                    'vocabulary': vocabulary,
-                    'embeddings': embeddings
-                }
-                # pickle.dump(save, fp, pickle.HIGHEST_PROTOCOL)
-                # fp.close()
-            except Exception as e:
-                # print('Unable to save data to %s : %s' % (output_pickle_file, e))
-                raise
+            embeddings = VocabEmbeddingUtilities.build_embeddings_matrix(
+                vocabulary,
+                lambda word: get_model_word_row(embeddings_model, word),
+                embeddings_model.syn0,
+                embeddings_size,
+                lowercase_fallback=True)
+
+            vocab_embeddings = {
+                'vocabulary': vocabulary,
+                'embeddings': embeddings
+            }
         elif embeddings_type == 'random':
             vocab_size = len(vocabulary)
-            embeddings = np.random.uniform(-1.0, 1.0, [vocab_size, embeddings_size])
+            embeddings = np.random.uniform(-1.0, 1.0, [vocab_size, embeddings_size]).astype(np.float32)
 
-            # print ("Write data in a pickle...")
-            # output_pickle_file = 'random.pickle'
-            try:
-                # fp = open(output_pickle_file, 'wb')
-                vocab_embeddings = {
-                    'vocabulary': vocabulary,
-                    'embeddings': embeddings
-                }
-                # pickle.dump(save, fp, pickle.HIGHEST_PROTOCOL)
-                # fp.close()
-            except Exception as e:
-                # print('Unable to save data to %s : %s' % (output_pickle_file, e))
-                raise
+            vocab_embeddings = {
+                'vocabulary': vocabulary,
+                'embeddings': embeddings
+            }
         elif embeddings_type == 'deps':
             print ("Loading deps embeddings_model...")
 
@@ -138,29 +164,14 @@ class VocabEmbeddingUtilities(object):
             embeddings_deps = embeddings_model['embeddings']
 
             print ("Building embeddings...")
-            vocab_size = len(vocabulary)
-            embeddings = np.zeros((vocab_size, embeddings_size))
-            for word in vocabulary:
-                index = vocabulary[word]
-                try:
-                    index_deps = vocabulary_deps[word]
-                    embeddings[index, :] = embeddings_deps[index_deps, :]
-                except KeyError:
-                    embeddings[index, :] = np.random.uniform(-0.1, 0.1, [1, embeddings_size])
-
-            print ("Write data in a pickle...")
-            # output_pickle_file = 'deps.pickle'
-            try:
-                # fp = open(output_pickle_file, 'wb')
-                vocab_embeddings = {
-                    'vocabulary': vocabulary,
-                    'embeddings': embeddings
-                }
-                # pickle.dump(save, fp, pickle.HIGHEST_PROTOCOL)
-                # fp.close()
-            except Exception as e:
-                # print('Unable to save data to %s : %s' % (output_pickle_file, e))
-                raise
+            embeddings = VocabEmbeddingUtilities.build_embeddings_matrix(vocabulary, vocabulary_deps.get,
+                                                                         embeddings_deps, embeddings_size,
+                                                                         lowercase_fallback=False)
+
+            vocab_embeddings = {
+                'vocabulary': vocabulary,
+                'embeddings': embeddings
+            }
         else:
             raise Exception("vector_type must be in: %s" % ["w2v", "random", "deps"])
 
@@ -7,6 +7,10 @@ import sys
 
 from scipy import spatial # used for similarity calculation
 
+from utils.ann_index import normalize_rows
+from utils.mmap_embeddings import get_model_word_row, get_model_vectors, get_normalized_vectors, \
+    get_rows_mean_unitvec
+
 class AverageVectorsUtilities(object):
     @staticmethod
     def makeFeatureVec(words, model, num_features, index2word_set, check_if_in_vocab=True):
@@ -20,112 +24,161 @@ class AverageVectorsUtilities(object):
             if check_if_in_vocab and not word in index2word_set:
                 continue
 
+            word_row = get_model_word_row(model, word)
+            if word_row is None:
+                raise KeyError("word '%s' not in vocabulary" % word)
+
             nwords = nwords+1
-            featureVec = np.add(featureVec, model[word])
+            featureVec = np.add(featureVec, get_model_vectors(model, word_row))
 
         if(nwords>0):
             featureVec = np.divide(featureVec, nwords)
         return featureVec
 
+    @staticmethod
+    def makeFeatureVecs(words_lists, model, num_features, index2word_set, check_if_in_vocab=True):
+        """
+        Average word vectors of many word lists (the batched makeFeatureVec).
+        The word vectors of all lists are gathered from the model matrix at once and summed with a single
+        np.add.reduceat, so a whole dataset can be processed in one pass.
+        :param words_lists: List of word lists
+        :param model: gensim Word2Vec or MmapEmbeddings
+        :param num_features: Vector size
+        :param index2word_set: Words that are used (see makeFeatureVec)
+        :param check_if_in_vocab: Skip the words that are not in index2word_set
+        :return: float32 matrix with a row per word list (zeros for lists without known words)
+        """
+        word_rows = []
+        lengths = np.zeros(len(words_lists), dtype=np.int64)
+        for i, words in enumerate(words_lists):
+            for word in words:
+                if check_if_in_vocab and not word in index2word_set:
+                    continue
+
+                word_row = get_model_word_row(model, word)
+                if word_row is None:
+                    raise KeyError("word '%s' not in vocabulary" % word)
+                word_rows.append(word_row)
+                lengths[i] += 1
+
+        featureVecs = np.zeros((len(words_lists), num_features), dtype="float32")
+        not_empty = lengths > 0
+        if len(word_rows) > 0:
+            starts = np.cumsum(lengths) - lengths
+            sums = np.add.reduceat(get_model_vectors(model, np.array(word_rows)), starts[not_empty], axis=0)
+            featureVecs[not_empty] = sums / lengths[not_empty].astype(np.float32)[:, None]
+
+        return featureVecs
+
     #get average similarity between every word from word1 with closes word in word2
     @staticmethod
     def get_feature_vec_avg_aligned_sim(words1, words2, model, num_features, index2word_set):
-        #function to average all words vectors in a given paragraph
-        nwords = 0
-
-        #list containing names of words in the vocabulary
-        #index2word_set = set(word2vec_model.index2word) this is moved as input param for performance reasons
-        aligned_sim=0.00
-        sim_sum=0.00
-        for word1 in words1:
-            if word1 in index2word_set:
-                nwords = nwords+1
-                best_sim=0.0000
-                for word2 in words2:
-                    if word2 in index2word_set:
-                        sim = model.similarity(word1, word2)
-                        if sim > best_sim:
-                            best_sim=sim
-                sim_sum+=best_sim
-
-        if(nwords>0):
-            aligned_sim = sim_sum/nwords
+        aligned_sim, top_avg_sims = AverageVectorsUtilities.get_aligned_and_top_words_avg_sims(words1, words2, model,
+                                                                                              num_features,
+                                                                                              index2word_set,
+                                                                                              top_nums=[1])
         return aligned_sim
 
-    #get average similarity between every word from word1 with closes word in word2
+    #get average similarity between the words1 vector and the top_num_words most similar words in word2
     @staticmethod
     def get_question_vec_to_top_words_avg_sim(words1, words2, model, num_features, index2word_set, top_num_words):
-        #function to average all words vectors in a given paragraph
-        if(len(words1)==0 or len(words2)==0):
-            return 0.00
+        aligned_sim, top_avg_sims = AverageVectorsUtilities.get_aligned_and_top_words_avg_sims(words1, words2, model,
+                                                                                              num_features,
+                                                                                              index2word_set,
+                                                                                              top_nums=[top_num_words])
+        return top_avg_sims[0]
 
-        nwords = 0 #all words checked
-        avg_sim=0.00 #avg similarity to be returned
+    @staticmethod
+    def get_words_unit_matrix(words, model, index2word_set):
+        """
+        :return: (normalized vectors, norms) of the words that are in index2word_set (in the words order),
+         taken from the normalized copy of the model matrix
+        """
+        syn0norm, norms = get_normalized_vectors(model)
+        word_rows = np.array([get_model_word_row(model, word) for word in words if word in index2word_set],
+                             dtype=np.int64)
 
-        top_sims=[]
+        return syn0norm[word_rows], norms[word_rows]
 
-        words1_in_model = words1
-        for word2 in words2:
-            if word2 in index2word_set:
-                nwords = nwords+1
-                sim = model.n_similarity(words1_in_model, [word2])
-                top_sims.append(sim)
+    @staticmethod
+    def get_words_n_similarity(words1, words2, model):
+        """
+        Cosine similarity between the average vectors of two word lists (gensim n_similarity)
+        as a dot product of rows of the normalized model matrix
+        """
+        if len(words1) == 0 or len(words2) == 0:
+            raise ZeroDivisionError("Atleast one of the passed list is empty.")
 
-        top_sims.sort(reverse=True)
-        num_words_to_select = min(len(top_sims), top_num_words)
+        syn0norm, norms = get_normalized_vectors(model)
+        vec1 = get_rows_mean_unitvec(syn0norm, norms, [get_model_word_row(model, x) for x in words1])
+        vec2 = get_rows_mean_unitvec(syn0norm, norms, [get_model_word_row(model, x) for x in words2])
 
-        #print top_sims[:num_words_to_select]
-        sim_sum=sum(top_sims[:num_words_to_select])
-        if(num_words_to_select>0):
-            avg_sim = sim_sum/num_words_to_select
+        return np.dot(vec1, vec2)
 
-        return avg_sim
+    @staticmethod
+    def get_aligned_and_top_words_avg_sims(words1, words2, model, num_features, index2word_set, top_nums=(1, 2, 3, 5)):
+        """
+        Computes get_feature_vec_avg_aligned_sim and get_question_vec_to_top_words_avg_sim for all top_nums at once.
+        The word vectors are taken from the normalized model matrix and all cosines come from a single matmul:
+        the rows of words1 and their average (the words1 vector) against the rows of words2.
+        The top words averages are taken from one partial sort.
+        :param words1: Words of the first text
+        :param words2: Words of the second text
+        :param model: gensim Word2Vec or MmapEmbeddings
+        :param num_features: Vector size
+        :param index2word_set: Words that are used
+        :param top_nums: Numbers of top words2 similarities to average
+        :return: (aligned similarity, list of the top words average similarities in the top_nums order)
+        """
+        vectors1, norms1 = AverageVectorsUtilities.get_words_unit_matrix(words1, model, index2word_set)
+        vectors2, norms2 = AverageVectorsUtilities.get_words_unit_matrix(words2, model, index2word_set)
+        if len(vectors1) == 0 or len(vectors2) == 0:
+            return 0.00, [0.00 for x in top_nums]
+
+        # the direction of the average raw vector of words1
+        text1_vector = np.dot(norms1, vectors1)
+        text1_norm = np.sqrt(np.dot(text1_vector, text1_vector))
+        if text1_norm > 0:
+            text1_vector /= text1_norm
+
+        sims = np.dot(np.vstack([vectors1, text1_vector[None, :]]), vectors2.T)
+
+        # best similarity of each words1 word (not below 0)
+        aligned_sim = float(np.mean(np.maximum(sims[:-1].max(axis=1), 0.0), dtype=np.float64))
+
+        text_sims = sims[-1]
+        max_top_num = min(max(top_nums), len(text_sims))
+        if max_top_num < len(text_sims):
+            text_sims = text_sims[np.argpartition(-text_sims, max_top_num - 1)[:max_top_num]]
+        top_sims_cumsum = np.cumsum(np.sort(text_sims)[::-1], dtype=np.float64)
+
+        top_avg_sims = []
+        for top_num in top_nums:
+            num_words_to_select = min(top_num, len(top_sims_cumsum))
+            top_avg_sims.append(float(top_sims_cumsum[num_words_to_select - 1] / num_words_to_select))
+
+        return aligned_sim, top_avg_sims
 
     @staticmethod
     def get_question_vec_to_top_words_avg_sim_wordgroups(words1, words2, model, num_features, index2word_set, top_num_words):
-        #function to average all words vectors in a given paragraph
-        if(len(words1)==0 or len(words2)==0):
-            return 0.00
-
-        nwords = 0 #all words checked
-        avg_sim=0.00 #avg similarity to be returned
-
-        top_sims=[]
-
-        words1_in_model = words1
-        for word2 in words2:
-            if word2 in index2word_set:
-                nwords = nwords+1
-                sim = model.n_similarity(words1_in_model, [word2])
-                top_sims.append(sim)
-
-        top_sims.sort(reverse=True)
-        num_words_to_select = min(len(top_sims), top_num_words)
-
-        #print top_sims[:num_words_to_select]
-        sim_sum=sum(top_sims[:num_words_to_select])
-        if(num_words_to_select>0):
-            avg_sim = sim_sum/num_words_to_select
-
-        return avg_sim
+        return AverageVectorsUtilities.get_question_vec_to_top_words_avg_sim(words1, words2, model, num_features,
+                                                                            index2word_set, top_num_words)
 
     @staticmethod
     def getAvgFeatureVecs(doc_wordlists, model, num_features, index2word_set=set()):
-        counter = 0
         reviewFeatureVecs = np.zeros((len(doc_wordlists), num_features), dtype="float32")
 
         #pass index2word_set as if used more than once outside this function
         if(len(index2word_set)==0):
             index2word_set = set(model.index2word)
 
-        for doc_wordlist in doc_wordlists:
-            if((counter%1000) == 0):
-                print "Doc %d of %d" %(counter, len(doc_wordlists))
-                print doc_wordlist
+        batch_size = 10000
+        for counter in range(0, len(doc_wordlists), batch_size):
+            print "Doc %d of %d" %(counter, len(doc_wordlists))
 
-            reviewFeatureVecs[counter] = AverageVectorsUtilities.makeFeatureVec(doc_wordlist, model,\
-                                                                                                    num_features,index2word_set)
-            counter += 1
+            doc_wordlists_batch = doc_wordlists[counter:counter + batch_size]
+            reviewFeatureVecs[counter:counter + len(doc_wordlists_batch)] = \
+                AverageVectorsUtilities.makeFeatureVecs(doc_wordlists_batch, model, num_features, index2word_set)
 
         return reviewFeatureVecs
 
@@ -154,11 +207,14 @@ class AverageVectorsUtilities(object):
     @staticmethod
     def get_sim_top_most_similar_items(vector1, list_of_vectors, list_of_vector_keys, list_of_vector_data, top_n_sim, category='', all_data=None):
         similar_vectors=[]
+        if len(list_of_vectors) == 0:
+            return similar_vectors
+
+        sims = np.dot(normalize_rows(list_of_vectors), normalize_rows([vector1])[0])
         for i in range(0, len(list_of_vectors)):
             if category!='' and all_data[i]!=category:
                 continue
-            sim = 1 - spatial.distance.cosine(vector1,list_of_vectors[i])
-            similar_vectors.append(((list_of_vector_keys[i], list_of_vector_data[i]), sim))
+            similar_vectors.append(((list_of_vector_keys[i], list_of_vector_data[i]), sims[i]))
 
         similar_vectors.sort(key=lambda x:x[1], reverse=True)
         return similar_vectors[:top_n_sim]
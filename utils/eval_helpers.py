@@ -43,6 +43,65 @@ def ensemble_epoch_runs_by_accuracy(epoch_candidate_probs, epoch_accuracy):
 
     return np.sum(np.asarray(acc_scaled), axis=0)
 
+
+class OnlineConfusionMatrix(object):
+    """
+    Confusion matrix accumulated batch by batch, so the predictions do not have to be kept in memory.
+    Usage:
+        conf_matrix = OnlineConfusionMatrix(labels=[0, 1])
+        for y_true_batch, y_pred_batch in batches:
+            conf_matrix.update(y_true_batch, y_pred_batch)
+        print conf_matrix.matrix, conf_matrix.accuracy()
+    """
+
+    def __init__(self, labels):
+        """
+        :param labels: Class labels. Rows (gold) and columns (predicted) of the matrix are in the sorted labels order
+        """
+        self.labels = np.unique(np.asarray(labels))
+        self.matrix = np.zeros((len(self.labels), len(self.labels)), dtype=np.int64)
+
+    def _get_label_ids(self, y):
+        y = np.asarray(y)
+        label_ids = np.searchsorted(self.labels, y)
+        label_ids[label_ids == len(self.labels)] = 0
+        if len(y) > 0 and not (self.labels[label_ids] == y).all():
+            raise Exception("Unknown labels %s. Known labels are %s" % (
+                np.unique(y[self.labels[label_ids] != y]), self.labels))
+
+        return label_ids
+
+    def update(self, y_true, y_pred):
+        """
+        Adds a batch of gold and predicted labels
+        """
+        if len(y_true) != len(y_pred):
+            raise Exception("%s gold labels and %s predicted labels" % (len(y_true), len(y_pred)))
+
+        np.add.at(self.matrix, (self._get_label_ids(y_true), self._get_label_ids(y_pred)), 1)
+
+    def total(self):
+        return int(self.matrix.sum())
+
+    def accuracy(self):
+        total = self.total()
+        return float(np.trace(self.matrix)) / total if total > 0 else 0.0
+
+    def precision_recall_fscore_support(self):
+        """
+        Per label scores, the same as sklearn.metrics.precision_recall_fscore_support with average=None
+        :return: (precision, recall, fscore, support) arrays. Scores with zero denominators are 0.0
+        """
+        true_positives = np.diag(self.matrix).astype(np.float64)
+        support = self.matrix.sum(axis=1)
+        predicted = self.matrix.sum(axis=0)
+
+        precision = true_positives / np.maximum(predicted, 1)
+        recall = true_positives / np.maximum(support, 1)
+        fscore = 2 * precision * recall / np.maximum(precision + recall, np.finfo(np.float64).tiny)
+
+        return precision, recall, fscore, support
+
 if __name__ == '__main__':
     print "Batch helpers"
     probs = [
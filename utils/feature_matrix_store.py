@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from utils.json_helpers import save_meta_file
+
+FEATURE_STORE_FORMAT_VERSION = 1
+
+
+def get_path_hash(path, block_size=1 << 20):
+    """
+    Content hash of a file or of all files in a directory
+    """
+    sha = hashlib.sha1()
+    if os.path.isdir(path):
+        file_paths = []
+        for dir_path, dir_names, file_names in os.walk(path):
+            file_paths.extend([os.path.join(dir_path, x) for x in file_names])
+        file_paths.sort()
+    else:
+        file_paths = [path]
+
+    for file_path in file_paths:
+        sha.update(os.path.relpath(file_path, path) + "\n")
+        with open(file_path, mode="rb") as input_file:
+            while True:
+                block = input_file.read(block_size)
+                if not block:
+                    break
+                sha.update(block)
+
+    return sha.hexdigest()[:16]
+
+
+def get_file_id(file_path):
+    """
+    Cheap id of a large file (ex. embeddings): absolute path, size and modification time
+    """
+    file_stat = os.stat(file_path)
+    return [os.path.abspath(file_path), file_stat.st_size, int(file_stat.st_mtime)]
+
+
+def get_feature_matrix_key(dataset_files, embeddings_files, feature_flags, **extra):
+    """
+    Key of a feature matrix in FeatureMatrixStore
+    :param dataset_files: Files (or directories) the data items are loaded from. Hashed by content
+    :param embeddings_files: Embeddings files. Identified by path, size and modification time
+    :param feature_flags: Dict with the feature extraction flags
+    :param extra: Other values the features depend on (json serializable)
+    :return: Key string
+    """
+    key_data = {"format_version": FEATURE_STORE_FORMAT_VERSION,
+                "datasets": [get_path_hash(x) for x in dataset_files],
+                "embeddings": [get_file_id(x) for x in embeddings_files],
+                "feature_flags": feature_flags,
+                "extra": extra}
+
+    return hashlib.sha1(json.dumps(key_data, sort_keys=True)).hexdigest()[:16]
+
+
+class FeatureMatrixStore(object):
+    """
+    Directory with extracted feature matrices saved as float32 .npy files.
+    A matrix is saved once and memory mapped by the runs with the same key (see get_feature_matrix_key),
+    so runs that change only the classifier params do not extract the features again.
+    Usage:
+        store = FeatureMatrixStore("resources/feature_store")
+        key = get_feature_matrix_key([dataset_file], embeddings_files, feature_flags)
+        for feat_vec in store.iter_rows(key, extract_features_generator, rows_cnt):
+            ...
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def _get_path(self, key, suffix):
+        return os.path.join(self.store_dir, "%s.%s" % (key, suffix))
+
+    def exists(self, key):
+        return os.path.exists(self._get_path(key, "meta.json"))
+
+    def load_meta(self, key):
+        with open(self._get_path(key, "meta.json"), mode="rb") as meta_file:
+            return json.load(meta_file)
+
+    def load(self, key, mmap_mode="r"):
+        """
+        :return: (feature matrix, meta dict)
+        """
+        return np.load(self._get_path(key, "features.npy"), mmap_mode=mmap_mode), self.load_meta(key)
+
+    def iter_rows(self, key, rows, rows_cnt, meta=None):
+        """
+        Yields the float32 rows of a feature matrix.
+        If the matrix is not in the store, the rows are taken from the rows iterable and written to the store.
+        The matrix is added to the store when all rows_cnt rows are consumed.
+        :param key: Matrix key
+        :param rows: Iterable of feature vectors, used if the matrix is not in the store
+        :param rows_cnt: Number of rows
+        :param meta: Dict saved with the matrix
+        :return: Generator of float32 arrays
+        """
+        if self.exists(key):
+            features, stored_meta = self.load(key)
+            logging.info("Features %s loaded from %s" % (features.shape, self._get_path(key, "features.npy")))
+            for feat_vec in features:
+                yield feat_vec
+            return
+
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+        tmp_file_path = self._get_path(key, "features.npy.tmp")
+        features = None
+        for row_id, feat_vec in enumerate(rows):
+            if features is None:
+                # the number of features is known from the first row
+                features = np.lib.format.open_memmap(tmp_file_path, mode="w+", dtype=np.float32,
+                                                     shape=(rows_cnt, len(feat_vec)))
+            features[row_id] = feat_vec
+            yield features[row_id]
+
+        if features is None:
+            return
+
+        features.flush()
+        del features
+        os.rename(tmp_file_path, self._get_path(key, "features.npy"))
+
+        meta = dict(meta if meta is not None else {})
+        meta["format_version"] = FEATURE_STORE_FORMAT_VERSION
+        meta["rows_cnt"] = rows_cnt
+
+        # meta is written last so a partially written matrix is not loaded
+        save_meta_file(self._get_path(key, "meta.json"), meta)
+
+        logging.info("Features saved to %s" % self._get_path(key, "features.npy"))
+
+
+class FeatureColumnGroups(object):
+    """
+    Named column ranges of a feature vector and the flags that include each range.
+    A matrix extracted with all flags on is sliced to the columns of any flags combination with get_columns.
+    Usage:
+        column_groups = FeatureColumnGroups()
+        column_groups.add("sentlast_embeddings", ["include_embeddings", "include_sentlast"], 600, 900)
+        ...
+        features_subset = features[:, column_groups.get_columns({"include_embeddings": True, ...})]
+    """
+
+    def __init__(self, groups=None):
+        """
+        :param groups: List of [name, required flags, start column, end column]
+        """
+        self.groups = [list(x) for x in groups] if groups is not None else []
+
+    def __len__(self):
+        return len(self.groups)
+
+    def get_width(self):
+        """
+        :return: Number of columns
+        """
+        return max([x[3] for x in self.groups]) if len(self.groups) > 0 else 0
+
+    def add(self, name, required_flags, start, end):
+        self.groups.append([name, list(required_flags), start, end])
+
+    def add_groups(self, column_groups, offset, name_pref=""):
+        """
+        Adds the groups of another vector that starts at column offset, ex. the features of the next embeddings
+        """
+        for name, required_flags, start, end in column_groups.groups:
+            self.add(name_pref + name, required_flags, start + offset, end + offset)
+
+    def get_columns(self, feature_flags):
+        """
+        :param feature_flags: Dict flag -> bool
+        :return: Array with the columns of the groups whose required flags are all on, in the column order
+        """
+        columns = [np.arange(start, end) for name, required_flags, start, end in self.groups
+                   if all([feature_flags.get(x, False) for x in required_flags])]
+        if len(columns) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.concatenate(columns).astype(np.int64)
+
+    def to_list(self):
+        return [list(x) for x in self.groups]
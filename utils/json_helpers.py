@@ -1,5 +1,6 @@
 import codecs
 import json
+import os
 
 def load_data_from_json_file(json_file):
     data_file = codecs.open(json_file, mode='r', encoding="utf-8")
@@ -11,4 +12,109 @@ def load_data_from_json_file(json_file):
 def save_data_to_json_file(data, output_json_file):
     data_file = codecs.open(output_json_file, mode='wb', encoding="utf-8")
     json.dump(data, data_file)
-    data_file.close()
\ No newline at end of file
+    data_file.close()
+
+def iter_data_from_json_lines_file(jsonl_file):
+    """
+    Reads a json lines file (one json object per line) item by item
+    :param jsonl_file: Json lines file
+    :return: Generator of items
+    """
+    with open(jsonl_file, mode='rb') as data_file:
+        for line in data_file:
+            if len(line.strip()) == 0:
+                continue
+            yield json.loads(line)
+
+
+def repair_json_lines_file(jsonl_file):
+    """
+    Truncates an incomplete last line (left by a crash while writing) from a json lines file.
+    :param jsonl_file: Json lines file
+    :return: (number of complete items, last complete item or None)
+    """
+    items_cnt = 0
+    last_line = None
+    committed_size = 0
+    with open(jsonl_file, mode='rb') as data_file:
+        for line in data_file:
+            if not line.endswith("\n"):
+                break
+            committed_size += len(line)
+            if len(line.strip()) > 0:
+                items_cnt += 1
+                last_line = line
+
+    with open(jsonl_file, mode='rb+') as data_file:
+        data_file.truncate(committed_size)
+
+    return items_cnt, (json.loads(last_line) if last_line is not None else None)
+
+
+def remove_meta_file(meta_file_path):
+    """
+    Removes the meta file of a saved directory before its files are overwritten,
+    so an interrupted save does not leave the old meta next to the new files (see save_meta_file)
+    """
+    if os.path.exists(meta_file_path):
+        os.remove(meta_file_path)
+
+
+def save_meta_file(meta_file_path, meta):
+    """
+    Writes the meta file of a saved directory. The meta file marks the directory as complete so it is written last,
+    through a temp file that is renamed, and the files it describes are loaded only if it exists.
+    Usage:
+        remove_meta_file(meta_file_path)
+        ... save the files
+        save_meta_file(meta_file_path, meta)
+    """
+    tmp_meta_file_path = meta_file_path + ".tmp"
+    with open(tmp_meta_file_path, mode="wb") as meta_file:
+        json.dump(meta, meta_file)
+
+    os.rename(tmp_meta_file_path, meta_file_path)
+
+
+class JsonLinesWriter(object):
+    """
+    Writes items to a json lines file (one json object per line) as they are produced.
+    The file is flushed to disk every flush_every items so a crash loses at most the last unflushed items.
+    """
+
+    def __init__(self, output_jsonl_file, append=False, flush_every=100):
+        self.output_file = output_jsonl_file
+        self.items_cnt = 0
+        self._flush_every = flush_every
+        self._not_flushed_cnt = 0
+        self._data_file = open(output_jsonl_file, mode='ab' if append else 'wb')
+
+    def write(self, item):
+        self._data_file.write(json.dumps(item))
+        self._data_file.write("\n")
+        self.items_cnt += 1
+
+        self._not_flushed_cnt += 1
+        if self._flush_every > 0 and self._not_flushed_cnt >= self._flush_every:
+            self.flush()
+
+    def write_all(self, items):
+        for item in items:
+            self.write(item)
+
+        return self.items_cnt
+
+    def flush(self):
+        self._data_file.flush()
+        os.fsync(self._data_file.fileno())
+        self._not_flushed_cnt = 0
+
+    def close(self):
+        self.flush()
+        self._data_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
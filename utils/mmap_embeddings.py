@@ -0,0 +1,507 @@
+import codecs
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+MMAP_EMBEDDINGS_META_FILE = "meta.json"
+MMAP_EMBEDDINGS_FORMAT_VERSION = 1
+
+# where the L2-normalized copy of the embeddings matrix is kept (see init_normalized_vectors)
+NORM_MODE_MEMORY = "memory"
+NORM_MODE_MMAP = "mmap"
+NORM_MODE_INPLACE = "inplace"
+NORM_MODES = [NORM_MODE_MEMORY, NORM_MODE_MMAP, NORM_MODE_INPLACE]
+
+
+def unitvec(vec):
+    norm = np.sqrt(np.dot(vec, vec))
+    if norm > 0:
+        return vec / norm
+
+    return vec
+
+
+def get_model_word_row(model, word):
+    """
+    Row of a word in the model matrix (syn0) or None if the word is not in the model
+    :param model: gensim Word2Vec or MmapEmbeddings
+    """
+    word_vocab = model.vocab.get(word)
+    if word_vocab is None:
+        return None
+
+    # gensim keeps Vocab objects, MmapEmbeddings keeps the row
+    return getattr(word_vocab, "index", word_vocab)
+
+
+def get_model_vectors(model, rows):
+    """
+    Raw vectors of rows of the model matrix.
+    When the matrix is normalized in place (see init_normalized_vectors) the vectors are rescaled with the cached norms.
+    :param model: gensim Word2Vec or MmapEmbeddings
+    :param rows: Row or array of rows
+    """
+    vectors = model.syn0[rows]
+    if getattr(model, "syn0_norms", None) is not None and model.syn0norm is model.syn0:
+        norms = model.syn0_norms[rows]
+        vectors = vectors * (norms[:, None] if np.ndim(norms) > 0 else norms)
+
+    return vectors
+
+
+def get_rows_mean_unitvec(syn0norm, norms, rows):
+    """
+    Unit vector of the average of the raw vectors of rows, computed from the normalized matrix and the norms
+    """
+    return unitvec(np.dot(norms[rows], syn0norm[rows]))
+
+
+def get_embeddings_fingerprint(model, sample_rows=1000):
+    """
+    Cheap id of an embeddings matrix: its shape, words and a sample of the rows
+    """
+    syn0 = model.syn0
+    sha = hashlib.sha1("%s_%s" % syn0.shape)
+    sha.update(u"\n".join(model.index2word).encode("utf-8"))
+    sha.update(np.ascontiguousarray(syn0[::max(1, len(syn0) // sample_rows)], dtype=np.float32).tobytes())
+
+    return sha.hexdigest()[:16]
+
+
+def _normalize_rows_to(vectors, output, norms, batch_size=100000):
+    for start in xrange(0, len(vectors), batch_size):
+        batch = np.asarray(vectors[start:start + batch_size], dtype=np.float32)
+        batch_norms = np.sqrt(np.einsum("ij,ij->i", batch, batch))
+        norms[start:start + len(batch)] = batch_norms
+        batch_norms[batch_norms == 0] = 1.0
+        output[start:start + len(batch)] = batch / batch_norms[:, None]
+
+
+def init_normalized_vectors(model, mode=NORM_MODE_MEMORY, norm_dir=""):
+    """
+    Builds the L2-normalized float32 copy of the model matrix (model.syn0norm, as in gensim)
+    and the norms of the vectors (model.syn0_norms), so cosine similarities are dot products.
+    Does nothing if they are already built.
+    :param model: gensim Word2Vec or MmapEmbeddings
+    :param mode: memory - the copy is in memory;
+     mmap - the copy is saved in norm_dir and memory mapped (reused while the embeddings do not change);
+     inplace - model.syn0 is normalized in place, no copy. get_model_vectors rescales the rows with the norms,
+     but model[word] of a gensim model returns the normalized vector
+    :param norm_dir: Directory for the mmap mode
+    :return: (syn0norm, syn0_norms)
+    """
+    if getattr(model, "syn0_norms", None) is not None:
+        return model.syn0norm, model.syn0_norms
+
+    syn0 = model.syn0
+    norms = np.zeros(len(syn0), dtype=np.float32)
+    if mode == NORM_MODE_MEMORY:
+        syn0norm = np.zeros(syn0.shape, dtype=np.float32)
+        _normalize_rows_to(syn0, syn0norm, norms)
+    elif mode == NORM_MODE_MMAP:
+        if not norm_dir:
+            raise Exception("norm_dir is required for the %s normalization mode" % mode)
+
+        file_pref = os.path.join(norm_dir, "syn0norm_%s" % get_embeddings_fingerprint(model))
+        if not os.path.exists(file_pref + ".norms.npy"):
+            if not os.path.exists(norm_dir):
+                os.makedirs(norm_dir)
+
+            logging.info("Saving the normalized embeddings to %s.npy" % file_pref)
+            syn0norm = np.lib.format.open_memmap(file_pref + ".npy", mode="w+", dtype=np.float32, shape=syn0.shape)
+            _normalize_rows_to(syn0, syn0norm, norms)
+            syn0norm.flush()
+            del syn0norm
+
+            # norms are written last so a partially written matrix is not loaded
+            np.save(file_pref + ".norms.npy", norms)
+
+        syn0norm = np.load(file_pref + ".npy", mmap_mode="r")
+        norms = np.load(file_pref + ".norms.npy")
+    elif mode == NORM_MODE_INPLACE:
+        if not isinstance(syn0, np.ndarray) or syn0.dtype != np.float32 or not syn0.flags.writeable:
+            raise Exception("The embeddings can not be normalized in place: a writable float32 matrix is required")
+
+        _normalize_rows_to(syn0, syn0, norms)
+        syn0norm = syn0
+    else:
+        raise Exception("Normalization mode %s is not supported (%s)" % (mode, ", ".join(NORM_MODES)))
+
+    model.syn0norm = syn0norm
+    model.syn0_norms = norms
+
+    return syn0norm, norms
+
+
+def get_normalized_vectors(model):
+    """
+    :return: (syn0norm, syn0_norms) of the model. Built in memory on the first call, see init_normalized_vectors
+    """
+    if getattr(model, "syn0_norms", None) is None:
+        return init_normalized_vectors(model)
+
+    return model.syn0norm, model.syn0_norms
+
+
+class _BinaryReader(object):
+    """
+    Buffered reader for the word2vec binary format: "<word> <dim float32 values>" records
+    """
+
+    def __init__(self, input_file, block_size=1 << 22):
+        self._input_file = input_file
+        self._block_size = block_size
+        self._buf = ""
+        self._pos = 0
+
+    def _fill(self, min_bytes):
+        if len(self._buf) - self._pos >= min_bytes:
+            return
+        self._buf = self._buf[self._pos:] + self._input_file.read(max(self._block_size, min_bytes))
+        self._pos = 0
+
+    def read_word(self):
+        while True:
+            space_pos = self._buf.find(" ", self._pos)
+            if space_pos >= 0:
+                break
+            buf_len = len(self._buf) - self._pos
+            self._fill(buf_len + 1)
+            if len(self._buf) - self._pos == buf_len:
+                raise EOFError("Unexpected end of the embeddings file")
+
+        word = self._buf[self._pos:space_pos].lstrip("\n")
+        self._pos = space_pos + 1
+
+        return word
+
+    def read_bytes(self, bytes_cnt):
+        self._fill(bytes_cnt)
+        if len(self._buf) - self._pos < bytes_cnt:
+            raise EOFError("Unexpected end of the embeddings file")
+
+        data = self._buf[self._pos:self._pos + bytes_cnt]
+        self._pos += bytes_cnt
+
+        return data
+
+
+def _iter_binary_records(input_file, words_cnt, vector_size):
+    reader = _BinaryReader(input_file)
+    for word_id in xrange(words_cnt):
+        word = reader.read_word().decode("utf-8", "ignore")
+        yield word, np.frombuffer(reader.read_bytes(4 * vector_size), dtype="<f4")
+
+
+def _iter_text_records(input_file, vector_size):
+    for line in input_file:
+        parts = line.rstrip().split(" ")
+        if len(parts) < vector_size + 1:
+            continue
+        # words with spaces (GloVe 840B)
+        yield u" ".join(parts[:-vector_size]), np.array(parts[-vector_size:], dtype=np.float32)
+
+
+def open_embeddings_file(embeddings_file, binary=False):
+    """
+    Opens a word2vec format embeddings file: binary, text with a header line or GloVe text without a header.
+    :param embeddings_file: Embeddings file
+    :param binary: The file is in the word2vec binary format
+    :return: (words count, vector size, generator of (word, vector) in the file order)
+    """
+    if binary:
+        input_file = open(embeddings_file, mode="rb")
+        words_cnt, vector_size = [int(x) for x in input_file.readline().split()]
+        records = _iter_binary_records(input_file, words_cnt, vector_size)
+    else:
+        input_file = codecs.open(embeddings_file, mode="rb", encoding="utf-8", errors="ignore")
+        first_line = input_file.readline().rstrip().split(" ")
+        if len(first_line) == 2:
+            words_cnt, vector_size = [int(x) for x in first_line]
+        else:
+            # GloVe format - no header line
+            vector_size = len(first_line) - 1
+            words_cnt = 1 + sum([1 for line in input_file if line.strip()])
+            input_file.seek(0)
+        records = _iter_text_records(input_file, vector_size)
+
+    def iter_records():
+        try:
+            for record in records:
+                yield record
+        finally:
+            input_file.close()
+
+    return words_cnt, vector_size, iter_records()
+
+
+def get_source_file_meta(embeddings_file):
+    source_stat = os.stat(embeddings_file)
+    return {"format_version": MMAP_EMBEDDINGS_FORMAT_VERSION,
+            "source_file": os.path.abspath(embeddings_file),
+            "source_size": source_stat.st_size,
+            "source_mtime": int(source_stat.st_mtime)}
+
+
+def is_converted_from(embeddings_dir, embeddings_file, binary=None):
+    """
+    :param binary: The format embeddings_file is read in. None to not check it
+    :return: True if embeddings_dir holds a complete conversion of the current version of embeddings_file
+    """
+    meta_file_path = os.path.join(embeddings_dir, MMAP_EMBEDDINGS_META_FILE)
+    if not os.path.exists(meta_file_path):
+        return False
+
+    with open(meta_file_path, mode="rb") as meta_file:
+        meta = json.load(meta_file)
+
+    if not os.path.exists(embeddings_file):
+        # only the converted copy is available
+        return meta.get("format_version") == MMAP_EMBEDDINGS_FORMAT_VERSION
+
+    if binary is not None and meta.get("binary") != bool(binary):
+        # converted with the other format flag
+        return False
+
+    source_meta = get_source_file_meta(embeddings_file)
+    return all([meta.get(k) == source_meta[k] for k in ["format_version", "source_size", "source_mtime"]])
+
+
+def _save_meta(output_dir, meta):
+    # meta is written last so a partially converted file is not loaded
+    with open(os.path.join(output_dir, MMAP_EMBEDDINGS_META_FILE), mode="wb") as meta_file:
+        json.dump(meta, meta_file)
+
+
+def convert_embeddings_to_npy(embeddings_file, output_dir, binary=False):
+    """
+    Converts a word2vec format embeddings file (binary, text with a header line or GloVe text without a header)
+    to vectors.npy (float32 matrix), vocab.json (words in row order) and meta.json in output_dir.
+    The vectors are written directly to the output file, the whole matrix is not kept in memory.
+    :param embeddings_file: Embeddings file
+    :param output_dir: Output directory
+    :param binary: The file is in the word2vec binary format
+    :return: Number of converted words
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    logging.info("Converting embeddings %s to %s" % (embeddings_file, output_dir))
+    words_cnt, vector_size, records = open_embeddings_file(embeddings_file, binary=binary)
+    vectors = np.lib.format.open_memmap(os.path.join(output_dir, "vectors.npy"), mode="w+", dtype=np.float32,
+                                        shape=(words_cnt, vector_size))
+    index2word = []
+    for word, vector in records:
+        vectors[len(index2word)] = vector
+        index2word.append(word)
+
+    if len(index2word) != words_cnt:
+        raise Exception("Embeddings file %s: %s words expected, %s read" % (embeddings_file, words_cnt,
+                                                                            len(index2word)))
+
+    vectors.flush()
+    del vectors
+
+    with open(os.path.join(output_dir, "vocab.json"), mode="wb") as vocab_file:
+        json.dump(index2word, vocab_file)
+
+    meta = get_source_file_meta(embeddings_file)
+    meta["binary"] = bool(binary)
+    meta["words_cnt"] = words_cnt
+    meta["vector_size"] = vector_size
+    _save_meta(output_dir, meta)
+
+    logging.info("%s words converted" % words_cnt)
+
+    return words_cnt
+
+
+def get_vocab_hash(words):
+    return hashlib.sha1(u"\n".join(sorted(words)).encode("utf-8")).hexdigest()[:16]
+
+
+def extract_vocab_embeddings(embeddings_file, vocab_words, output_dir, binary=False, lowercase_fallback=True):
+    """
+    Streams an embeddings file once and keeps only the vectors of the vocab words.
+    Saves vectors.npy, vocab.json, mean.npy (the average of all vectors in the file) and meta.json in output_dir.
+    :param embeddings_file: word2vec format embeddings file
+    :param vocab_words: Words to keep
+    :param output_dir: Output directory
+    :param binary: The file is in the word2vec binary format
+    :param lowercase_fallback: Keep also the lowercased vocab words
+    :return: Number of kept words
+    """
+    needed_words = set(vocab_words)
+    if lowercase_fallback:
+        needed_words.update([x.lower() for x in vocab_words])
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    logging.info("Extracting %s words from embeddings %s to %s" % (len(needed_words), embeddings_file, output_dir))
+    words_cnt, vector_size, records = open_embeddings_file(embeddings_file, binary=binary)
+    vectors_sum = np.zeros(vector_size, dtype=np.float64)
+    index2word = []
+    vectors = []
+    read_cnt = 0
+    for word, vector in records:
+        read_cnt += 1
+        vectors_sum += vector
+        if word in needed_words:
+            # the first vector of a duplicated word is used, as in gensim
+            needed_words.remove(word)
+            index2word.append(word)
+            vectors.append(vector)
+
+    vectors = np.array(vectors, dtype=np.float32).reshape((len(index2word), vector_size))
+    np.save(os.path.join(output_dir, "vectors.npy"), vectors)
+    np.save(os.path.join(output_dir, "mean.npy"), (vectors_sum / max(1, read_cnt)).astype(np.float32))
+    with open(os.path.join(output_dir, "vocab.json"), mode="wb") as vocab_file:
+        json.dump(index2word, vocab_file)
+
+    meta = get_source_file_meta(embeddings_file)
+    meta["binary"] = bool(binary)
+    meta["words_cnt"] = len(index2word)
+    meta["source_words_cnt"] = read_cnt
+    meta["vector_size"] = vector_size
+    _save_meta(output_dir, meta)
+
+    logging.info("%s of %s words kept" % (len(index2word), read_cnt))
+
+    return len(index2word)
+
+
+class MmapEmbeddings(object):
+    """
+    Word embeddings with a memory mapped float32 matrix, converted once with convert_embeddings_to_npy.
+    Loading is fast and the matrix pages are shared by all processes that load the same files.
+    Implements the part of the gensim Word2Vec interface used by the trainers and AverageVectorsUtilities:
+    model[word], model[words], word in model, similarity, n_similarity, index2word, vocab, syn0 and wv.
+    Usage:
+        model = load_mmap_embeddings("GoogleNews-vectors-negative300.bin", "resources/mmap_embeddings", binary=True)
+        vec = model["story"]
+    """
+
+    def __init__(self, syn0, index2word, mean_vector=None):
+        """
+        :param syn0: Matrix with a vector per word
+        :param index2word: Words in the matrix row order
+        :param mean_vector: Average of all vectors of the source file (set for vocab restricted embeddings)
+        """
+        self.syn0 = syn0
+        self.index2word = index2word
+        self.mean_vector = mean_vector
+        # built on the first similarity, see init_normalized_vectors
+        self.syn0norm = None
+        self.syn0_norms = None
+        self.vocab = {}
+        for word_id, word in enumerate(index2word):
+            # the first vector of a duplicated word is used, as in gensim
+            self.vocab.setdefault(word, word_id)
+
+    @staticmethod
+    def load(embeddings_dir, mmap_mode="r"):
+        """
+        :param embeddings_dir: Directory created with convert_embeddings_to_npy
+        :param mmap_mode: np.load mmap_mode for the matrix. None to read it in memory
+        :return: MmapEmbeddings
+        """
+        with open(os.path.join(embeddings_dir, "vocab.json"), mode="rb") as vocab_file:
+            index2word = json.load(vocab_file)
+
+        syn0 = np.load(os.path.join(embeddings_dir, "vectors.npy"), mmap_mode=mmap_mode)
+
+        mean_vector = None
+        if os.path.exists(os.path.join(embeddings_dir, "mean.npy")):
+            mean_vector = np.load(os.path.join(embeddings_dir, "mean.npy"))
+
+        return MmapEmbeddings(syn0, index2word, mean_vector=mean_vector)
+
+    @property
+    def wv(self):
+        return self
+
+    @property
+    def vector_size(self):
+        return self.syn0.shape[1]
+
+    def __len__(self):
+        return len(self.index2word)
+
+    def __contains__(self, word):
+        return word in self.vocab
+
+    def __getitem__(self, words):
+        if isinstance(words, basestring):
+            return get_model_vectors(self, self.vocab[words])
+
+        return get_model_vectors(self, [self.vocab[x] for x in words])
+
+    def similarity(self, w1, w2):
+        syn0norm, norms = get_normalized_vectors(self)
+        return np.dot(syn0norm[self.vocab[w1]], syn0norm[self.vocab[w2]])
+
+    def n_similarity(self, ws1, ws2):
+        if not len(ws1) or not len(ws2):
+            raise ZeroDivisionError("Atleast one of the passed list is empty.")
+
+        syn0norm, norms = get_normalized_vectors(self)
+        v1 = get_rows_mean_unitvec(syn0norm, norms, [self.vocab[x] for x in ws1])
+        v2 = get_rows_mean_unitvec(syn0norm, norms, [self.vocab[x] for x in ws2])
+
+        return np.dot(v1, v2)
+
+
+def get_mmap_embeddings_dir(embeddings_file, mmap_dir):
+    return os.path.join(mmap_dir, os.path.basename(embeddings_file) + ".mmap")
+
+
+def load_mmap_embeddings(embeddings_file, mmap_dir, binary=False):
+    """
+    Loads the memory mapped copy of an embeddings file from mmap_dir.
+    The copy is created on the first call and recreated when the embeddings file changes.
+    :param embeddings_file: word2vec format embeddings file
+    :param mmap_dir: Directory with the converted embeddings
+    :param binary: The file is in the word2vec binary format
+    :return: MmapEmbeddings
+    """
+    embeddings_dir = get_mmap_embeddings_dir(embeddings_file, mmap_dir)
+    if not is_converted_from(embeddings_dir, embeddings_file, binary=binary):
+        if os.path.exists(os.path.join(embeddings_dir, MMAP_EMBEDDINGS_META_FILE)):
+            os.remove(os.path.join(embeddings_dir, MMAP_EMBEDDINGS_META_FILE))
+        convert_embeddings_to_npy(embeddings_file, embeddings_dir, binary=binary)
+
+    logging.info("Loading memory mapped embeddings from %s" % embeddings_dir)
+    return MmapEmbeddings.load(embeddings_dir)
+
+
+def load_vocab_embeddings(embeddings_file, vocab_words, cache_dir, binary=False, lowercase_fallback=True):
+    """
+    Loads the vectors of the vocab words only (see extract_vocab_embeddings).
+    The extracted vectors are cached in cache_dir by (embeddings file, vocab hash) and rebuilt when the
+    embeddings file or the binary flag changes.
+    Words that are not in the vocab are not in the returned model, mean_vector is the average of the full file.
+    :param embeddings_file: word2vec format embeddings file
+    :param vocab_words: Words to keep, ex. the train vocabulary
+    :param cache_dir: Directory with the extracted embeddings
+    :param binary: The file is in the word2vec binary format
+    :param lowercase_fallback: Keep also the lowercased vocab words
+    :return: MmapEmbeddings with the matrix in memory
+    """
+    vocab_words = set(vocab_words)
+    if lowercase_fallback:
+        vocab_words.update([x.lower() for x in vocab_words])
+
+    embeddings_dir = os.path.join(cache_dir, "%s.vocab_%s" % (os.path.basename(embeddings_file),
+                                                               get_vocab_hash(vocab_words)))
+    if not is_converted_from(embeddings_dir, embeddings_file, binary=binary):
+        if os.path.exists(os.path.join(embeddings_dir, MMAP_EMBEDDINGS_META_FILE)):
+            os.remove(os.path.join(embeddings_dir, MMAP_EMBEDDINGS_META_FILE))
+        extract_vocab_embeddings(embeddings_file, vocab_words, embeddings_dir, binary=binary,
+                                 lowercase_fallback=False)
+
+    logging.info("Loading vocab embeddings from %s" % embeddings_dir)
+    return MmapEmbeddings.load(embeddings_dir, mmap_mode=None)
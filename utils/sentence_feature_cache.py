@@ -0,0 +1,84 @@
+import hashlib
+import logging
+from collections import OrderedDict
+
+
+def get_sentences_hash(sentences):
+    """
+    Content hash of parsed sentences (tokens and pos tags)
+    :param sentences: List of sentence dicts with "tokens" and "pos"
+    :return: sha1 digest
+    """
+    sha = hashlib.sha1()
+    for sentence in sentences:
+        sha.update(u"\x00".join(sentence["tokens"]).encode("utf-8"))
+        sha.update("\x01")
+        sha.update(u"\x00".join(sentence["pos"]).encode("utf-8"))
+        sha.update("\x02")
+
+    return sha.digest()
+
+
+class SentenceFeatureCache(object):
+    """
+    LRU cache for per sentence features, ex. the token lists and the average embeddings of the story sentences
+    that are the same in all items generated from a story.
+    Usage:
+        cache = SentenceFeatureCache(max_size=100000)
+        key = (get_sentences_hash(sentences), id(embeddings_model), lower_tokens, remove_stopwords)
+        value = cache.get(key)
+        if value is None:
+            value = ...
+            cache.put(key, value)
+        logging.info(cache.get_stats_str())
+    """
+
+    def __init__(self, max_size=100000):
+        """
+        :param max_size: Maximum number of entries. The least recently used entries are evicted
+        """
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        value = self._items.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return default
+
+        # move to the most recently used end
+        self._items[key] = value
+        self.hits += 1
+
+        return value
+
+    def put(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._items.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else 0.0
+
+    def get_stats_str(self):
+        return "SentenceFeatureCache: %s entries, %s hits, %s misses (hit rate %.4f), %s evictions" % (
+            len(self._items), self.hits, self.misses, self.hit_rate(), self.evictions)
+
+    def log_stats(self):
+        logging.info(self.get_stats_str())
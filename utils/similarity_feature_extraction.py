@@ -25,6 +25,7 @@ from datetime import datetime
 
 import logging #word2vec logging
 
+import numpy as np
 
 from sklearn import preprocessing
 
@@ -49,6 +50,7 @@ from gensim.models import LdaModel
 from sklearn.svm import SVC
 
 from embedding_vector_utilities import AverageVectorsUtilities
+from utils.mmap_embeddings import get_model_word_row, get_normalized_vectors
 
 import pickle
 
@@ -77,6 +79,51 @@ def starts_with_or_with(str_to_check, check_for):
     return starts_or
 
 
+# POS tag prefixes (lowercased) with a bit in the POS tag codes. Prefixes that are not in the list are added on first use
+POS_TAG_PREFIXES = ['nn', 'n', 'j', 'vb', 'rb', 'dt', 'pr', 'w', 'md']
+# mask of the '' prefix, all tags
+POS_TAG_MASK_ALL = -1
+
+_pos_tag_codes = {}
+
+
+def get_pos_tag_mask(tag_type_start):
+    """
+    Mask of the POS tag codes that match starts_with_or_with(tag, tag_type_start)
+    :param tag_type_start: Tag prefix or list of tag prefixes
+    """
+    if type(tag_type_start) is list:
+        mask = 0
+        for check in tag_type_start:
+            mask |= get_pos_tag_mask(check)
+        return mask
+
+    if tag_type_start == '':
+        return POS_TAG_MASK_ALL
+
+    prefix = tag_type_start.lower()
+    if prefix not in POS_TAG_PREFIXES:
+        POS_TAG_PREFIXES.append(prefix)
+        _pos_tag_codes.clear()
+
+    return 1 << POS_TAG_PREFIXES.index(prefix)
+
+
+def get_pos_tag_code(pos_tag):
+    """
+    Bit i of the code is set if the tag starts with POS_TAG_PREFIXES[i] (case insensitive)
+    """
+    code = _pos_tag_codes.get(pos_tag)
+    if code is None:
+        code = 0
+        for i, prefix in enumerate(POS_TAG_PREFIXES):
+            if pos_tag.lower().startswith(prefix):
+                code |= 1 << i
+        _pos_tag_codes[pos_tag] = code
+
+    return code
+
+
 class Similarity_FeatureExtraction(object):
     """Similarities feature extration
     """
@@ -91,15 +138,58 @@ class Similarity_FeatureExtraction(object):
                                                                   model,
                                                                   tag_type_start_1,
                                                                   tag_type_start_2):
-        res_sim = 0.00
-
-        text1_words_in_model = [x[0] for x in text1_tokens_in_vocab if starts_with_or_with(x[1], tag_type_start_1)]
-        text2_words_in_model = [x[0] for x in text2_tokens_in_vocab if starts_with_or_with(x[1], tag_type_start_2)]
+        return Similarity_FeatureExtraction.calculate_postagged_similarities(text1_tokens_in_vocab,
+                                                                             text2_tokens_in_vocab,
+                                                                             model,
+                                                                             [(tag_type_start_1, tag_type_start_2)])[0]
 
-        if len(text1_words_in_model) > 0 and len(text2_words_in_model) > 0:
-            res_sim = model.n_similarity(text1_words_in_model, text2_words_in_model)
+    @staticmethod
+    def get_postagged_vector_sums(tokens_in_vocab, model, tag_masks):
+        """
+        Sums of the word vectors of the tokens selected by each tag mask, from one masked matmul
+        :param tokens_in_vocab: List of (word, pos tag) with words in the model
+        :param model: gensim Word2Vec or MmapEmbeddings
+        :param tag_masks: Array of masks, see get_pos_tag_mask
+        :return: (matrix with a sum per mask, array with the selected tokens count per mask)
+        """
+        syn0norm, norms = get_normalized_vectors(model)
+        word_rows = np.array([get_model_word_row(model, x[0]) for x in tokens_in_vocab], dtype=np.int64)
+        tag_codes = np.array([get_pos_tag_code(x[1]) for x in tokens_in_vocab], dtype=np.int64)
+
+        selected = ((tag_codes[None, :] & tag_masks[:, None]) != 0) | (tag_masks[:, None] == POS_TAG_MASK_ALL)
+        vector_sums = np.dot(selected * norms[word_rows][None, :], syn0norm[word_rows])
+
+        return vector_sums, selected.sum(axis=1)
 
-        return res_sim
+    @staticmethod
+    def calculate_postagged_similarities(text1_tokens_in_vocab,
+                                         text2_tokens_in_vocab,
+                                         model,
+                                         pos_relations):
+        """
+        calculate_postagged_similarity_from_taggeddata_and_tokens for many tag pairs at once:
+        the cosine between the average vectors of the text1 words with tag_type_start_1
+        and the text2 words with tag_type_start_2 (0.00 if there are no such words)
+        :param text1_tokens_in_vocab: List of (word, pos tag) with words in the model
+        :param text2_tokens_in_vocab: List of (word, pos tag) with words in the model
+        :param model: gensim Word2Vec or MmapEmbeddings
+        :param pos_relations: List of (tag_type_start_1, tag_type_start_2). A tag type is a prefix or list of prefixes
+        :return: List of similarities in the pos_relations order
+        """
+        tag_masks_1 = np.array([get_pos_tag_mask(x[0]) for x in pos_relations], dtype=np.int64)
+        tag_masks_2 = np.array([get_pos_tag_mask(x[1]) for x in pos_relations], dtype=np.int64)
+
+        sums_1, counts_1 = Similarity_FeatureExtraction.get_postagged_vector_sums(text1_tokens_in_vocab, model,
+                                                                                  tag_masks_1)
+        sums_2, counts_2 = Similarity_FeatureExtraction.get_postagged_vector_sums(text2_tokens_in_vocab, model,
+                                                                                  tag_masks_2)
+
+        norms_prod = np.sqrt(np.einsum("ij,ij->i", sums_1, sums_1) * np.einsum("ij,ij->i", sums_2, sums_2))
+        norms_prod[norms_prod == 0] = 1.0
+        sims = np.einsum("ij,ij->i", sums_1, sums_2) / norms_prod
+        sims[(counts_1 == 0) | (counts_2 == 0)] = 0.00
+
+        return sims.tolist()
 
     @staticmethod
     def get_maxsims_sim_fetures(words1, words2, word2vec_model, word2vec_index2word_set, w2v_num_feats, pref):
@@ -107,41 +197,21 @@ class Similarity_FeatureExtraction(object):
         vec_feats_loc = []
         sparse_feats_dict_loc = {}
 
+        top_nums = [1, 2, 3, 5]
+        sim_avg_max, sim_avg_tops = AverageVectorsUtilities.get_aligned_and_top_words_avg_sims(words1, words2,
+                                                                                             word2vec_model,
+                                                                                             w2v_num_feats,
+                                                                                             word2vec_index2word_set,
+                                                                                             top_nums)
+
         feat_key = pref + "max_sim_aligned"
-        sim_avg_max = AverageVectorsUtilities.get_feature_vec_avg_aligned_sim(words1, words2, word2vec_model,
-                                                                              w2v_num_feats,
-                                                                              word2vec_index2word_set)
         vec_feats_loc.append(sim_avg_max)
         CommonUtilities.increment_feat_val(sparse_feats_dict_loc, feat_key, sim_avg_max)
 
-
-        feat_key = pref + "max_sim_avg_top1"
-        sim_avg_top1 = AverageVectorsUtilities.get_question_vec_to_top_words_avg_sim(words1, words2, word2vec_model,
-                                                                                     w2v_num_feats,
-                                                                                     word2vec_index2word_set, 1)
-        vec_feats_loc.append(sim_avg_top1)
-        CommonUtilities.increment_feat_val(sparse_feats_dict_loc, feat_key, sim_avg_top1)
-
-        feat_key = pref + "max_sim_avg_top2"
-        sim_avg_top2 = AverageVectorsUtilities.get_question_vec_to_top_words_avg_sim(words1, words2, word2vec_model,
-                                                                                     w2v_num_feats,
-                                                                                     word2vec_index2word_set, 2)
-        vec_feats_loc.append(sim_avg_top2)
-        CommonUtilities.increment_feat_val(sparse_feats_dict_loc, feat_key, sim_avg_top2)
-
-        feat_key = pref + "max_sim_avg_top3"
-        sim_avg_top3 = AverageVectorsUtilities.get_question_vec_to_top_words_avg_sim(words1, words2, word2vec_model,
-                                                                                     w2v_num_feats,
-                                                                                     word2vec_index2word_set, 3)
-        vec_feats_loc.append(sim_avg_top3)
-        CommonUtilities.increment_feat_val(sparse_feats_dict_loc, feat_key, sim_avg_top3)
-
-        feat_key = pref + "max_sim_avg_top5"
-        sim_avg_top5 = AverageVectorsUtilities.get_question_vec_to_top_words_avg_sim(words1, words2, word2vec_model,
-                                                                                     w2v_num_feats,
-                                                                                     word2vec_index2word_set, 5)
-        vec_feats_loc.append(sim_avg_top5)
-        CommonUtilities.increment_feat_val(sparse_feats_dict_loc, feat_key, sim_avg_top5)
+        for top_num, sim_avg_top in zip(top_nums, sim_avg_tops):
+            feat_key = pref + "max_sim_avg_top%s" % top_num
+            vec_feats_loc.append(sim_avg_top)
+            CommonUtilities.increment_feat_val(sparse_feats_dict_loc, feat_key, sim_avg_top)
 
         return vec_feats_loc, sparse_feats_dict_loc
 
@@ -161,247 +231,29 @@ class Similarity_FeatureExtraction(object):
         tokens_in_vocab_2 = [x for x in tokens_data_text2 if x[0] in word2vec_index2word_set]
         # print len(tokens_in_vocab_2) # debug
 
-        # similarity for  tag type
-        tag_type_start_1 = 'NN'
-        tag_type_start_2 = 'NN'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
-
-        # similarity for  tag type
-        tag_type_start_1 = 'J'
-        tag_type_start_2 = 'J'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
-
-        # similarity for  tag type
-        tag_type_start_1 = 'VB'
-        tag_type_start_2 = 'VB'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
-
-        # similarity for  tag type
-        tag_type_start_1 = 'RB'
-        tag_type_start_2 = 'RB'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
-
-        # similarity for  tag type
-        tag_type_start_1 = 'DT'
-        tag_type_start_2 = 'DT'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
-
-        # similarity for  tag type
-        tag_type_start_1 = 'PR'
-        tag_type_start_2 = 'PR'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
-
-        # similarity for  tag type
-        tag_type_start_1 = 'NN'
-        tag_type_start_2 = 'J'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
-
-        # similarity for  tag type
-        tag_type_start_1 = 'J'
-        tag_type_start_2 = 'NN'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
-
-        # similarity for  tag type
-        tag_type_start_1 = 'RB'
-        tag_type_start_2 = 'VB'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
-
-        # similarity for  tag type
-        tag_type_start_1 = 'VB'
-        tag_type_start_2 = 'RB'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
-
-        # similarity for  tag type
-        tag_type_start_1 = 'PR'
-        tag_type_start_2 = 'NN'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
-
-        # similarity for  tag type
-        tag_type_start_1 = 'NN'
-        tag_type_start_2 = 'PR'
-        postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-            text1_tokens_in_vocab=tokens_in_vocab_1,
-            text2_tokens_in_vocab=tokens_in_vocab_2,
-            model=model,
-            tag_type_start_1=tag_type_start_1,
-            tag_type_start_2=tag_type_start_2)
-
-        input_data_wordvectors.append(postagged_sim)
-        input_data_sparse_features[
-            pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-            postagged_sim
+        pos_relations = [('NN', 'NN'), ('J', 'J'), ('VB', 'VB'), ('RB', 'RB'), ('DT', 'DT'), ('PR', 'PR'),
+                         ('NN', 'J'), ('J', 'NN'), ('RB', 'VB'), ('VB', 'RB'), ('PR', 'NN'), ('NN', 'PR')]
 
         # Additional features
         include_modal = True
+        modal_pos_relations = []
         if include_modal:
-            # similarity for  tag type
-            tag_type_start_1 = 'MD'
-            tag_type_start_2 = 'VB'
-            postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-                text1_tokens_in_vocab=tokens_in_vocab_1,
-                text2_tokens_in_vocab=tokens_in_vocab_2,
-                model=model,
-                tag_type_start_1=tag_type_start_1,
-                tag_type_start_2=tag_type_start_2)
-
-            input_data_wordvectors.append(postagged_sim)
-            input_data_sparse_features[
-                'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-                postagged_sim
-
-            # similarity for  tag type
-            tag_type_start_1 = 'VB'
-            tag_type_start_2 = 'MD'
-            postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-                text1_tokens_in_vocab=tokens_in_vocab_1,
-                text2_tokens_in_vocab=tokens_in_vocab_2,
-                model=model,
-                tag_type_start_1=tag_type_start_1,
-                tag_type_start_2=tag_type_start_2)
-
-            input_data_wordvectors.append(postagged_sim)
-            input_data_sparse_features[
-                'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-                postagged_sim
-
-            # similarity for  tag type
-            tag_type_start_1 = ''
-            tag_type_start_2 = 'MD'
-            postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-                text1_tokens_in_vocab=tokens_in_vocab_1,
-                text2_tokens_in_vocab=tokens_in_vocab_2,
-                model=model,
-                tag_type_start_1=tag_type_start_1,
-                tag_type_start_2=tag_type_start_2)
+            modal_pos_relations = [('MD', 'VB'), ('VB', 'MD'), ('', 'MD'), ('MD', '')]
 
-            input_data_wordvectors.append(postagged_sim)
-            input_data_sparse_features[
-                'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
-                postagged_sim
+        postagged_sims = Similarity_FeatureExtraction.calculate_postagged_similarities(
+            text1_tokens_in_vocab=tokens_in_vocab_1,
+            text2_tokens_in_vocab=tokens_in_vocab_2,
+            model=model,
+            pos_relations=pos_relations + modal_pos_relations)
 
-            # similarity for  tag type
-            tag_type_start_1 = 'MD'
-            tag_type_start_2 = ''
-            postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-                text1_tokens_in_vocab=tokens_in_vocab_1,
-                text2_tokens_in_vocab=tokens_in_vocab_2,
-                model=model,
-                tag_type_start_1=tag_type_start_1,
-                tag_type_start_2=tag_type_start_2)
+        for rel_id, (tag_type_start_1, tag_type_start_2) in enumerate(pos_relations + modal_pos_relations):
+            postagged_sim = postagged_sims[rel_id]
+            # the modal features are without pref
+            feat_pref = pref if rel_id < len(pos_relations) else ''
 
             input_data_wordvectors.append(postagged_sim)
             input_data_sparse_features[
-                'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
+                feat_pref + 'sim_pos_arg1_%s_arg2_%s' % (tag_type_start_1, 'ALL' if tag_type_start_2 == '' else tag_type_start_2)] = \
                 postagged_sim
 
         return input_data_wordvectors, input_data_sparse_features
@@ -461,16 +313,17 @@ class Similarity_FeatureExtraction(object):
                 (['VB', 'MD'], ['VB', 'MD']),  # 0.633351149118
             ]
 
-        for pos_rel in pos_relations:
+        postagged_sims = Similarity_FeatureExtraction.calculate_postagged_similarities(
+            text1_tokens_in_vocab=tokens_in_vocab_1,
+            text2_tokens_in_vocab=tokens_in_vocab_2,
+            model=model,
+            pos_relations=pos_relations)
+
+        for rel_id, pos_rel in enumerate(pos_relations):
             # similarity for  tag type
             tag_type_start_1 = pos_rel[0]
             tag_type_start_2 = pos_rel[1]
-            postagged_sim = Similarity_FeatureExtraction.calculate_postagged_similarity_from_taggeddata_and_tokens(
-                text1_tokens_in_vocab=tokens_in_vocab_1,
-                text2_tokens_in_vocab=tokens_in_vocab_2,
-                model=model,
-                tag_type_start_1=tag_type_start_1,
-                tag_type_start_2=tag_type_start_2)
+            postagged_sim = postagged_sims[rel_id]
 
             input_data_wordvectors.append(postagged_sim)
             input_data_sparse_features[